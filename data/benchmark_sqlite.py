@@ -0,0 +1,83 @@
+# Measure concurrent read and write throughput of sqlite with the default and the tuned settings
+# Usage: python -m data.benchmark_sqlite [--seconds SECONDS] [--writers WRITERS] [--readers READERS]
+import argparse
+import os
+import tempfile
+import threading
+import time
+from typing import Dict
+
+from sqlalchemy import select, func, insert
+
+from data.database import SQLITE_DEFAULT_SETTINGS, SQLiteSettings, create_sqlite_engine, db_metadata_users_stocks
+from data.database_models import users_trades_table
+from utils.logger_script import logger
+
+
+def run_load(settings: SQLiteSettings, seconds: float, writers: int, readers: int) -> Dict[str, float]:
+    """
+    Write single trade transactions and read a user's trades from many threads at once on a new database file
+
+    :returns: Dict of writes and reads per second and errors (e.g. database is locked)
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_sqlite_engine(f"sqlite:///{os.path.join(directory, 'benchmark.sqlite')}", settings)
+        db_metadata_users_stocks.create_all(bind=engine, tables=[users_trades_table])
+        counts = {"writes": 0, "reads": 0, "errors": 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def write(worker: int) -> None:
+            done = errors = 0
+            while time.perf_counter() < deadline:
+                try:
+                    with engine.begin() as connection:
+                        connection.execute(insert(users_trades_table).values(
+                            user_id=f"user{worker}", timestamp=int(time.time()), ticker="AAPL", action="buy", amount=1.0, price=100.0,
+                        ))
+                    done += 1
+                except Exception:
+                    errors += 1
+            with lock:
+                counts["writes"] += done
+                counts["errors"] += errors
+
+        def read(worker: int) -> None:
+            done = errors = 0
+            stmt = select(func.count(), func.sum(users_trades_table.c.amount)).where(users_trades_table.c.user_id == f"user{worker % max(writers, 1)}")
+            while time.perf_counter() < deadline:
+                try:
+                    with engine.connect() as connection:
+                        connection.execute(stmt).first()
+                    done += 1
+                except Exception:
+                    errors += 1
+            with lock:
+                counts["reads"] += done
+                counts["errors"] += errors
+
+        threads = [threading.Thread(target=write, args=(worker,)) for worker in range(writers)]
+        threads += [threading.Thread(target=read, args=(worker,)) for worker in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+    return {"writes_per_second": counts["writes"] / seconds, "reads_per_second": counts["reads"] / seconds, "errors": counts["errors"]}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare concurrent sqlite throughput with the default and the tuned settings")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Seconds of load per run")
+    parser.add_argument("--writers", type=int, default=4, help="Threads writing trades")
+    parser.add_argument("--readers", type=int, default=8, help="Threads reading trades")
+    args = parser.parse_args()
+
+    for name, settings in (("default", SQLITE_DEFAULT_SETTINGS), ("tuned", SQLiteSettings())):
+        result = run_load(settings, args.seconds, args.writers, args.readers)
+        logger.info(
+            f"{name}: {result['writes_per_second']:.0f} writes/s, {result['reads_per_second']:.0f} reads/s, "
+            f"{result['errors']} errors ({args.writers} writers, {args.readers} readers)"
+        )
+
+if __name__ == "__main__":
+    main()
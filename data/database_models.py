@@ -1,13 +1,19 @@
 import uuid
-from typing import Union, Generator
+import time
+from typing import Union, Generator, List, Dict
 
-from sqlalchemy import insert, Column, String, Table, Integer, JSON, Float
+from sqlalchemy import insert, select, update, delete, and_, bindparam, Column, String, Table, Integer, JSON, Float, Index
 from sqlalchemy.orm import Session
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+import pandas as pd
 
-from data.database import (db_base_userbase,
+from data.database import (db_base_userbase, db_metadata, DATABASE_ENGINES, userbase_name,
                            db_metadata_users_stocks, db_engine_stocksbase, db_metadata_stocksbase, 
                            stocksbase_name, users_stocks_name,
                            db_sessionmaker_userbase, db_sessionmaker_users_stocks, db_engine_users_stocks)
+from data.positions import fold_trades
+from data.stock_record import StockRecord, stock_records_to_frame, validate_stock_records
 from utils.logger_script import logger
 
 def generate_uuid():
@@ -19,105 +25,538 @@ class Userbase(db_base_userbase):
     ID: guid | EMAIL: string | USERNAME: string | PASSWORD: string
     """
     __tablename__ = "Userbase"
+    __table_args__ = {"info": {"database": userbase_name}}
 
     id = Column(String, primary_key=True, default=generate_uuid, unique=True)
     
+    # users are looked up by email and (encoded) username, both through the index of their unique constraint
     email = Column(String, nullable=False, unique=True)
     username = Column(String, nullable=False, unique=True)
     password = Column(String, nullable=False)
 
+    def to_dict(self) -> dict:
+        """
+        :returns: id, email and (encoded) username of the user, never the password
+        """
+        return {"id": self.id, "email": self.email, "username": self.username}
+
     def __str__(self) -> str:
         try:
             return f"id: {self.id}, email: {self.email}, username: {self.username}, password: {self.password}"
         except Exception as error:
             return f"Failed creating string: {error}"
     
+# Emails waiting to be sent by the outbox worker (emails/outbox.py), lives next to the users in the userbase
+email_outbox_table = Table(
+    "email_outbox",
+    db_base_userbase.metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("email", String, nullable=False),
+    Column("message_type", String, nullable=False),
+    # pending -> sending (claimed by a worker) -> sent, or back to pending to retry, failed after the last attempt
+    Column("status", String, nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("next_attempt_at", Float, nullable=False),
+    Column("claim", String),
+    Column("claimed_at", Float),
+    Column("last_error", String),
+    Column("created_at", Float, nullable=False),
+    Column("sent_at", Float),
+    Index("ix_email_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+    info={"database": userbase_name},
+)
+
+# Trades of all users, replaces the old table per user (see data/migrate_users_stocks.py)
+users_trades_table_name = "trades"
+users_trades_table = Table(
+    users_trades_table_name,
+    db_metadata_users_stocks,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", String, nullable=False),
+    Column("timestamp", Integer, nullable=False),
+    Column("ticker", String, nullable=False),
+    Column("action", String, nullable=False),
+    Column("amount", Float, nullable=False),
+    Column("price", Float, nullable=False),
+    Index("ix_trades_user_id_timestamp", "user_id", "timestamp"),
+    Index("ix_trades_user_id_ticker", "user_id", "ticker"),
+    info={"database": users_stocks_name},
+)
+
 @staticmethod
-def generate_user_stocks_table_by_id(id: str):
+def generate_user_stocks_table_by_id(id: str) -> bool:
     """
-    Generate a table of a user to store stocks in
+    Make sure a user can store stocks. Trades of all users live in one trades table
+    keyed by user id, so no table is created per user anymore
     :param id: A user's GUID
+    :returns: True if the trades table exists
     """
-    new_table = Table(
-        id,
-        db_metadata_users_stocks,
-        Column("timestamp", Integer, primary_key=True, unique=True, nullable=False),
-        Column("ticker", String, nullable=False),
-        Column("action", String, nullable=False),
-        Column("amount", Float, nullable=False),
-        Column("price", Float, nullable=False),
-        extend_existing=True
-    )
-    logger.debug(f"Adding table for user {id}")
+    logger.debug(f"Making sure trades table exists for user {id}")
     try: 
-        new_table.create(db_engine_users_stocks)
-        if id in db_metadata_users_stocks.tables:
-            logger.debug(f"Successfully added table to user's stocks database{id}")
-        else:
-            logger.error(f"Failed adding table to user's stocks database{id}")
+        users_trades_table.create(db_engine_users_stocks, checkfirst=True)
+        return True
     except Exception as error:
-        logger.error(f"Error raised while adding table {id} to user's stocks database: {error}")
-    
-        
-    
+        logger.error(f"Error raised while creating trades table for user {id} in user's stocks database: {error}")
+        return False
+
+# Materialized holdings of every user, updated with every trade that is added
+users_positions_table = Table(
+    "positions",
+    db_metadata_users_stocks,
+    Column("user_id", String, primary_key=True),
+    Column("ticker", String, primary_key=True),
+    Column("quantity", Float, nullable=False),
+    Column("average_cost", Float, nullable=False),
+    Column("realized_pnl", Float, nullable=False),
+    Column("updated_at", Integer, nullable=False),
+    info={"database": users_stocks_name},
+)
 
 @staticmethod
-def add_stock_to_users_stocks_table(id: str, stock_data: dict):
+def add_stock_to_users_stocks_table(id: str, stock_data: Union[dict, List[dict]]) -> bool:
     """
-    
+    Add trade(s) of a user to the trades table and update the user's positions in the same transaction
+    :param id: A user's GUID
+    :param stock_data: Trade or list of trades - dicts of timestamp, ticker, action, amount and price
+    :returns: True if the trades were added
     """
-    global db_metadata_users_stocks
-    # Get user's stocks table reference from the database
-    users_stocks_table = get_users_stocks_table_by_name(id)
-
-    # If there was no table found
-    if users_stocks_table is None:
-        logger.error(f"Could not add user's stocks (id:{id}) table ")
+    rows = stock_data if isinstance(stock_data, list) else [stock_data]
+    rows = [{**row, "user_id": id} for row in rows]
     try:
-        # Create insert statement for the user stock's data
-        stmt = insert(users_stocks_table).values(stock_data)
-        # Get the database, execute and commit
-        db: Session = next(get_db_users_stocks())
-        db.execute(stmt)
-        db.commit()
-        db.close()
+        with db_engine_users_stocks.begin() as connection:
+            connection.execute(insert(users_trades_table), rows)
+            update_positions(connection, id, sorted(rows, key=lambda row: row["timestamp"]))
     except Exception as error:
-        logger.error(f"Could not add user's stock(s) data to database")
-        db.rollback()
+        logger.error(f"Could not add user's stock(s) data to database: {error}")
         logger.debug("Rolled back user's stocks database")
+        return False
+    logger.debug(f"Done adding stock data to user {id}'s trades")
+    return True
+
+@staticmethod
+def update_positions(connection: Connection, id: str, trades: List[Union[dict, tuple]]) -> Dict[str, dict]:
+    """
+    Incrementally update a user's positions with new trades - only the traded tickers' rows are read and written.
+    Trades are applied in the order given, so they should be sorted by timestamp. A ticker with a trade older than
+    its position (backfilled or imported history) is folded again from all of its trades, like rebuild_positions does
+    :param connection: Connection inside the transaction that added the trades
+    :param id: A user's GUID
+    :param trades: Trades - dicts (or tuples in this order) of timestamp, ticker, action, amount and price
+    :returns: Dict of ticker -> updated position
+    """
+    if not trades:
+        return {}
+    # timestamp and ticker of every trade
+    keys = [(trade["timestamp"], trade["ticker"]) if isinstance(trade, dict) else (trade[0], trade[1]) for trade in trades]
+    tickers = {ticker for _, ticker in keys}
+    stmt = select(users_positions_table).where(
+        and_(users_positions_table.c.user_id == id, users_positions_table.c.ticker.in_(tickers))
+    )
+    current = {row.ticker: dict(row._mapping) for row in connection.execute(stmt)}
+    late = {ticker for timestamp, ticker in keys if ticker in current and timestamp < current[ticker]["updated_at"]}
+    if late:
+        trades = [trade for trade, (_, ticker) in zip(trades, keys) if ticker not in late]
+    updated = fold_trades(current, trades)
+    if late:
+        logger.debug(f"Trades of user {id} older than their positions {sorted(late)}, folding them again")
+        updated.update(fold_stored_trades(connection, id, late))
+    write_positions(connection, id, updated)
+    return updated
+
+@staticmethod
+def fold_stored_trades(connection: Connection, id: str, tickers: set) -> Dict[str, dict]:
+    """
+    Compute positions of a user's tickers from all of their stored trades (uses the user_id, ticker index)
+    :param connection: Connection inside the transaction that added the trades
+    :param id: A user's GUID
+    :param tickers: Tickers to compute
+    :returns: Dict of ticker -> position
+    """
+    stmt = select(
+        users_trades_table.c.timestamp, users_trades_table.c.ticker, users_trades_table.c.action,
+        users_trades_table.c.amount, users_trades_table.c.price
+    ).where(and_(users_trades_table.c.user_id == id, users_trades_table.c.ticker.in_(list(tickers)))).order_by(
+        users_trades_table.c.timestamp, users_trades_table.c.id
+    )
+    return fold_trades({}, [tuple(row) for row in connection.execute(stmt)])
+
+@staticmethod
+def write_positions(connection: Connection, id: str, positions: Dict[str, dict]) -> None:
+    """
+    Replace the stored positions of a user's tickers
+    :param connection: Connection inside a transaction
+    :param id: A user's GUID
+    :param positions: Dict of ticker -> position
+    """
+    if not positions:
         return
-    logger.debug(f"Done adding stock data to user {id}'s table")
+    connection.execute(delete(users_positions_table).where(
+        and_(users_positions_table.c.user_id == id, users_positions_table.c.ticker.in_(list(positions)))
+    ))
+    connection.execute(insert(users_positions_table), [
+        {"user_id": id, **{key: position[key] for key in ("ticker", "quantity", "average_cost", "realized_pnl", "updated_at")}}
+        for position in positions.values()
+    ])
 
 @staticmethod
-def get_users_stocks_table_by_name(name: str) -> Union[Table, None]:
+def get_positions_by_id(id: str, include_closed: bool = False) -> List[dict]:
+    """
+    Get the materialized positions of a user - reads one row per position, never the trades
+    :param id: A user's GUID
+    :param include_closed: Whether to include positions with zero quantity (they still hold realized P&L)
+    :returns: List of positions - dicts of ticker, quantity, average_cost, realized_pnl and updated_at
+    """
+    stmt = select(
+        users_positions_table.c.ticker, users_positions_table.c.quantity, users_positions_table.c.average_cost,
+        users_positions_table.c.realized_pnl, users_positions_table.c.updated_at
+    ).where(users_positions_table.c.user_id == id)
+    if not include_closed:
+        stmt = stmt.where(users_positions_table.c.quantity != 0)
+    try:
+        with db_engine_users_stocks.connect() as connection:
+            return [dict(row._mapping) for row in connection.execute(stmt.order_by(users_positions_table.c.ticker))]
+    except Exception as error:
+        logger.error(f"Could not get positions of user {id}: {error}")
+        return []
+
+@staticmethod
+def get_held_tickers() -> List[str]:
+    """
+    Get every ticker someone holds or has an open order on - the tickers whose market data is needed soon
+    :returns: Sorted list of tickers
+    """
+    held = select(users_positions_table.c.ticker).where(users_positions_table.c.quantity != 0)
+    ordered = select(users_orders_table.c.ticker).where(users_orders_table.c.status.in_(OPEN_ORDER_STATUSES))
+    try:
+        with db_engine_users_stocks.connect() as connection:
+            return sorted({row.ticker for row in connection.execute(held.union(ordered))})
+    except Exception as error:
+        logger.error(f"Could not get held tickers: {error}")
+        return []
+
+@staticmethod
+def rebuild_positions(id: str = None) -> Dict[str, List[str]]:
+    """
+    Recompute positions from the whole trades table and overwrite the materialized ones.
+    Used to check that the incremental updates stayed consistent
+    :param id: A user's GUID, None to rebuild every user
+    :returns: Dict of user id -> tickers whose stored position did not match the recomputed one
+    """
+    trades_stmt = select(
+        users_trades_table.c.user_id, users_trades_table.c.timestamp, users_trades_table.c.ticker,
+        users_trades_table.c.action, users_trades_table.c.amount, users_trades_table.c.price
+    ).order_by(users_trades_table.c.user_id, users_trades_table.c.timestamp, users_trades_table.c.id)
+    positions_stmt = select(users_positions_table)
+    if id is not None:
+        trades_stmt = trades_stmt.where(users_trades_table.c.user_id == id)
+        positions_stmt = positions_stmt.where(users_positions_table.c.user_id == id)
+
+    mismatches: Dict[str, List[str]] = {}
+    with db_engine_users_stocks.begin() as connection:
+        stored: Dict[str, Dict[str, dict]] = {}
+        for row in connection.execute(positions_stmt):
+            stored.setdefault(row.user_id, {})[row.ticker] = dict(row._mapping)
+
+        trades_by_user: Dict[str, list] = {}
+        for row in connection.execute(trades_stmt):
+            trades_by_user.setdefault(row.user_id, []).append(tuple(row)[1:])
+
+        for user_id in set(stored) | set(trades_by_user):
+            rebuilt = fold_trades({}, trades_by_user.get(user_id, []))
+            user_stored = stored.get(user_id, {})
+            different = sorted(
+                ticker for ticker in set(rebuilt) | set(user_stored)
+                if ticker not in rebuilt or ticker not in user_stored
+                or any(abs(rebuilt[ticker][key] - user_stored[ticker][key]) > 1e-6 for key in ("quantity", "average_cost", "realized_pnl"))
+            )
+            if different:
+                mismatches[user_id] = different
+                logger.warning(f"Positions of user {user_id} did not match their trades: {different}")
+            connection.execute(delete(users_positions_table).where(users_positions_table.c.user_id == user_id))
+            write_positions(connection, user_id, rebuilt)
+    return mismatches
+
+@staticmethod
+def bulk_insert_frame(connection: Connection, table: Table, frame: pd.DataFrame) -> int:
+    """
+    Insert the rows of a dataframe (columns named like the table's columns) with a single executemany.
+    Rows are handed to the driver as tuples when its paramstyle is positional, skipping a dict per row
+    :param connection: Connection inside the transaction to insert in
+    :param table: Table to insert to
+    :param frame: Dataframe of rows
+    :returns: Number of rows inserted
+    """
+    if frame.empty:
+        return 0
+    columns = list(frame.columns)
+    column_lists = [frame[column].tolist() for column in columns]
+    compiled = insert(table).compile(dialect=connection.dialect, column_keys=columns)
+    if connection.dialect.positional:
+        order = [columns.index(column) for column in compiled.positiontup]
+        connection.exec_driver_sql(str(compiled), list(zip(*[column_lists[index] for index in order])))
+    else:
+        connection.execute(insert(table), [dict(zip(columns, row)) for row in zip(*column_lists)])
+    return len(frame)
+
+@staticmethod
+def bulk_add_stock_records_to_users_stocks_table(id: str, records: List[Union[StockRecord, dict]]) -> dict:
+    """
+    Add many trades of a user at once. The records are validated in one vectorized pass
+    and the valid ones are written with a single executemany in a single transaction,
+    together with the update of the user's positions
+    :param id: A user's GUID
+    :param records: List of stock records (or dicts with stock record fields)
+    :returns: Dict of success, inserted (count), rejected (row number -> reason), seconds and rows_per_second
+    """
+    start_time = time.perf_counter()
+    valid, rejected = validate_stock_records(stock_records_to_frame(records))
+    valid.insert(0, "user_id", id)
+
     try:
-        users_stocks_table = db_metadata_users_stocks.tables[name]
-        return users_stocks_table
+        with db_engine_users_stocks.begin() as connection:
+            bulk_insert_frame(connection, users_trades_table, valid)
+            ordered = valid.sort_values("timestamp", kind="stable")
+            update_positions(connection, id, list(zip(
+                ordered["timestamp"].tolist(), ordered["ticker"].tolist(), ordered["action"].tolist(),
+                ordered["amount"].tolist(), ordered["price"].tolist()
+            )))
     except Exception as error:
-        logger.error(f"Could not find table {name} in user's stocks database: {error}")
-        return None
+        logger.error(f"Could not bulk add {len(valid)} trades of user {id}: {error}")
+        return {"success": False, "inserted": 0, "rejected": rejected, "seconds": time.perf_counter() - start_time, "rows_per_second": 0.0}
+
+    seconds = time.perf_counter() - start_time
+    rows_per_second = len(valid) / seconds if seconds > 0 else 0.0
+    logger.info(f"Bulk added {len(valid)} trades of user {id} ({len(rejected)} rejected) at {rows_per_second:.0f} rows/s")
+    return {"success": True, "inserted": len(valid), "rejected": rejected, "seconds": seconds, "rows_per_second": rows_per_second}
+
+@staticmethod
+def get_users_stocks_by_id(id: str, ticker: str = None) -> List[dict]:
+    """
+    Get the trades of a user ordered by timestamp (uses the user_id indexes)
+    :param id: A user's GUID
+    :param ticker: Only get trades of this ticker
+    :returns: List of trades - dicts of timestamp, ticker, action, amount and price
+    """
+    stmt = select(
+        users_trades_table.c.timestamp, users_trades_table.c.ticker, users_trades_table.c.action,
+        users_trades_table.c.amount, users_trades_table.c.price
+    ).where(users_trades_table.c.user_id == id)
+    if ticker is not None:
+        stmt = stmt.where(users_trades_table.c.ticker == ticker)
+    stmt = stmt.order_by(users_trades_table.c.timestamp, users_trades_table.c.id)
+    try:
+        with db_engine_users_stocks.connect() as connection:
+            return [dict(row._mapping) for row in connection.execute(stmt)]
+    except Exception as error:
+        logger.error(f"Could not get trades of user {id}: {error}")
+        return []
     
 
+# Orders of every user, open ones are matched against bars by stocks/orders.py
+users_orders_table = Table(
+    "orders",
+    db_metadata_users_stocks,
+    Column("id", String, primary_key=True),
+    Column("user_id", String, nullable=False),
+    Column("ticker", String, nullable=False),
+    Column("side", String, nullable=False),
+    Column("order_type", String, nullable=False),
+    Column("amount", Float, nullable=False),
+    Column("filled", Float, nullable=False),
+    Column("average_fill_price", Float, nullable=False),
+    Column("limit_price", Float),
+    Column("stop_price", Float),
+    Column("triggered", Integer, nullable=False),
+    Column("status", String, nullable=False),
+    Column("created_at", Integer, nullable=False),
+    Column("updated_at", Integer, nullable=False),
+    Index("ix_orders_user_id_status", "user_id", "status"),
+    Index("ix_orders_status_ticker", "status", "ticker"),
+    info={"database": users_stocks_name},
+)
+
+# Statuses of orders that can still be filled
+OPEN_ORDER_STATUSES = ("open", "partially_filled")
+# Columns of an order that change while it is matched
+ORDER_STATE_COLUMNS = ("filled", "average_fill_price", "triggered", "status", "updated_at")
+
+@staticmethod
+def add_order(order: dict) -> bool:
+    """
+    Store a new order
+    :param order: Dict with a value for every column of the orders table
+    :returns: True if the order was stored
+    """
+    try:
+        with db_engine_users_stocks.begin() as connection:
+            connection.execute(insert(users_orders_table), [order])
+    except Exception as error:
+        logger.error(f"Could not add order {order.get('id')} of user {order.get('user_id')}: {error}")
+        return False
+    return True
+
+@staticmethod
+def get_orders_by_id(id: str, status: str = None) -> List[dict]:
+    """
+    Get the orders of a user, newest first
+    :param id: A user's GUID
+    :param status: Only get orders with this status, "open" also includes partially filled orders
+    :returns: List of orders - dicts of the orders table's columns
+    """
+    stmt = select(users_orders_table).where(users_orders_table.c.user_id == id)
+    if status == "open":
+        stmt = stmt.where(users_orders_table.c.status.in_(OPEN_ORDER_STATUSES))
+    elif status is not None:
+        stmt = stmt.where(users_orders_table.c.status == status)
+    try:
+        with db_engine_users_stocks.connect() as connection:
+            return [dict(row._mapping) for row in connection.execute(stmt.order_by(users_orders_table.c.created_at.desc()))]
+    except Exception as error:
+        logger.error(f"Could not get orders of user {id}: {error}")
+        return []
+
 @staticmethod
-def generate_stock_table_for_stocksbase_by_ticker(ticker: str):
+def get_open_orders() -> List[dict]:
     """
-    Generate a table for a specific stock in the stocksbase database
+    Get the open orders of every user (to load the order books), oldest first
+    :returns: List of orders - dicts of the orders table's columns
+    """
+    stmt = select(users_orders_table).where(users_orders_table.c.status.in_(OPEN_ORDER_STATUSES))
+    try:
+        with db_engine_users_stocks.connect() as connection:
+            return [dict(row._mapping) for row in connection.execute(stmt.order_by(users_orders_table.c.created_at))]
+    except Exception as error:
+        logger.error(f"Could not get open orders: {error}")
+        return []
+
+@staticmethod
+def cancel_order(id: str, order_id: str) -> bool:
+    """
+    Cancel an open order of a user
+    :param id: A user's GUID
+    :param order_id: The order's id
+    :returns: True if an open order was cancelled
+    """
+    stmt = update(users_orders_table).where(and_(
+        users_orders_table.c.id == order_id, users_orders_table.c.user_id == id,
+        users_orders_table.c.status.in_(OPEN_ORDER_STATUSES)
+    )).values(status="cancelled", updated_at=int(time.time()))
+    try:
+        with db_engine_users_stocks.begin() as connection:
+            return connection.execute(stmt).rowcount > 0
+    except Exception as error:
+        logger.error(f"Could not cancel order {order_id} of user {id}: {error}")
+        return False
+
+@staticmethod
+def record_order_fills(fills: List[dict], orders: List[dict]) -> bool:
+    """
+    Write fills of orders as trades, update the positions of the traded users and the state of the orders,
+    all in one transaction. Only orders that are still open are updated - an order cancelled since it was matched
+    (e.g. by another worker) keeps its status and its fills are not recorded
+    :param fills: Fills - dicts of order_id, user_id, timestamp, ticker, action, amount and price
+    :param orders: Orders that changed - dicts of id, filled, average_fill_price, triggered, status and updated_at
+    :returns: True if everything was written
+    """
+    if not fills and not orders:
+        return True
+    trade_columns = ("user_id", "timestamp", "ticker", "action", "amount", "price")
+    # bound parameters can not be named like the columns they set
+    update_order = update(users_orders_table).where(and_(
+        users_orders_table.c.id == bindparam("order_id"), users_orders_table.c.status.in_(OPEN_ORDER_STATUSES)
+    )).values({column: bindparam(f"new_{column}") for column in ORDER_STATE_COLUMNS})
+    try:
+        with db_engine_users_stocks.begin() as connection:
+            closed = set()
+            for order in orders:
+                # one statement per order, an executemany's rowcount would not tell which order was closed
+                parameters = {**{f"new_{column}": order[column] for column in ORDER_STATE_COLUMNS}, "order_id": order["id"]}
+                if connection.execute(update_order, parameters).rowcount == 0:
+                    closed.add(order["id"])
+            if closed:
+                logger.info(f"Orders {sorted(closed)} were closed since they were matched, their fills are not recorded")
+                fills = [fill for fill in fills if fill.get("order_id") not in closed]
+            if fills:
+                connection.execute(insert(users_trades_table), [{column: fill[column] for column in trade_columns} for fill in fills])
+            fills_by_user: Dict[str, List[dict]] = {}
+            for fill in fills:
+                fills_by_user.setdefault(fill["user_id"], []).append(fill)
+            for user_id, user_fills in fills_by_user.items():
+                update_positions(connection, user_id, sorted(user_fills, key=lambda fill: fill["timestamp"]))
+    except Exception as error:
+        logger.error(f"Could not record {len(fills)} order fills: {error}")
+        return False
+    return True
+    
+
+# Bars of every ticker and interval, timestamp is epoch seconds (UTC) of the bar's open
+stock_bars_table = Table(
+    "stock_bars",
+    db_metadata_stocksbase,
+    Column("ticker", String, primary_key=True),
+    Column("interval", String, primary_key=True),
+    Column("timestamp", Integer, primary_key=True),
+    Column("open", Float),
+    Column("high", Float),
+    Column("low", Float),
+    Column("close", Float),
+    Column("adj_close", Float),
+    Column("volume", Float),
+    info={"database": stocksbase_name},
+)
+
+# Time range [start, end) that was already downloaded for each ticker and interval
+stock_bars_coverage_table = Table(
+    "stock_bars_coverage",
+    db_metadata_stocksbase,
+    Column("ticker", String, primary_key=True),
+    Column("interval", String, primary_key=True),
+    Column("start", Integer, nullable=False),
+    Column("end", Integer, nullable=False),
+    info={"database": stocksbase_name},
+)
+
+# Engines the bar tables were created on, checked before every download so they are created once
+bar_tables_engines = set()
+
+@staticmethod
+def generate_stock_table_for_stocksbase_by_ticker(ticker: str, engine: Engine = db_engine_stocksbase) -> bool:
+    """
+    Make sure the stocksbase database can store bars of a specific stock.
+    Bars of all tickers live in the stock_bars table (keyed by ticker, interval and timestamp)
     :param ticker: A valid ticker (stock symbol, e.g: AAPL)
+    :param engine: Engine of the stocksbase database
+    :returns: True if the ticker is valid and the bar tables exist
     """
     # NOT COMPLETE - ADD VALIDATION FOR STOCKS TICKERS
-    possible_tickers = []
-    possible_tickers.append(ticker)
-    if ticker not in possible_tickers:
+    if not isinstance(ticker, str) or not ticker.strip():
         logger.warning("Specified ticker is not valid")
-        return 
+        return False
     
-    new_table = Table(
-        ticker,
-        # db_metadata_stocksbase,
-        Column("ticker", String, default=ticker, primary_key=True)
-    )
-    new_table.create(db_engine_stocksbase)
+    if engine in bar_tables_engines:
+        return True
+    try:
+        try:
+            db_metadata_stocksbase.create_all(bind=engine, tables=[stock_bars_table, stock_bars_coverage_table])
+        except OperationalError:
+            # another process created them between the check and the create, they exist now
+            db_metadata_stocksbase.create_all(bind=engine, tables=[stock_bars_table, stock_bars_coverage_table])
+        bar_tables_engines.add(engine)
+        return True
+    except Exception as error:
+        logger.error(f"Failed creating stock bar tables for {ticker}: {error}")
+        return False
 
+@staticmethod
+def create_schema() -> None:
+    """
+    Create the tables of the schema that do not exist yet, each in the database its info names
+    (all of them in one database when DATABASE_URL is set)
+    """
+    for database_name, engine in DATABASE_ENGINES.items():
+        tables = [table for table in db_metadata.sorted_tables if table.info.get("database") == database_name]
+        db_metadata.create_all(bind=engine, tables=tables)
+        logger.debug(f"Created schema of {database_name}: {[table.name for table in tables]}")
 
   
 # Get database with generator function
@@ -125,8 +564,10 @@ def get_db_userbase() -> Generator[Session, any, None]:
     try:
         db = db_sessionmaker_userbase()
         yield db
-    except Exception as error:
+    except SQLAlchemyError as error:
+        # errors of the request itself (e.g. HTTPException) pass through to FastAPI
         logger.critical(f"ERROR IN GETTING USERBASE DATABASE: {error}")
+        raise
     finally:
         db.close()
 
@@ -134,7 +575,9 @@ def get_db_users_stocks() -> Generator[Session, any, None]:
     try:
         db = db_sessionmaker_users_stocks()
         yield db
-    except Exception as error:
+    except SQLAlchemyError as error:
+        # errors of the request itself (e.g. HTTPException) pass through to FastAPI
         logger.critical(f"ERROR IN GETTING USER'S STOCKS DATABASE: {error}")
+        raise
     finally:
         db.close()
\ No newline at end of file
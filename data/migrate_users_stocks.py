@@ -0,0 +1,64 @@
+# Fold the old per user tables of the Users_Stocks database into the single trades table
+# Usage: python -m data.migrate_users_stocks [--keep-tables]
+import argparse
+from typing import Dict
+
+from sqlalchemy import MetaData, Table, insert, select, literal
+from sqlalchemy.engine import Engine
+
+from data.database import db_engine_users_stocks, db_metadata_users_stocks
+from data.database_models import users_trades_table
+from utils.logger_script import logger
+
+
+# Columns every old per user table had
+PER_USER_TABLE_COLUMNS = {"timestamp", "ticker", "action", "amount", "price"}
+
+def migrate_per_user_tables(engine: Engine = db_engine_users_stocks, drop_tables: bool = True) -> Dict[str, int]:
+    """
+    Copy the rows of every per user table (named by the user's GUID) into the trades table.
+    Each table is copied (and dropped) in its own transaction, so the migration can be rerun after a failure.
+    Tables that are kept (drop_tables=False) are copied again on a rerun
+
+    :param engine: Engine of the user's stocks database
+    :param drop_tables: Whether to drop the per user tables after copying them
+    :returns: Dict of user id -> number of trades migrated
+    """
+    db_metadata_users_stocks.create_all(bind=engine, tables=[users_trades_table])
+    reflected_metadata = MetaData()
+    reflected_metadata.reflect(bind=engine)
+
+    migrated: Dict[str, int] = {}
+    for table_name, table in reflected_metadata.tables.items():
+        if table_name in db_metadata_users_stocks.tables:
+            continue
+        if set(table.columns.keys()) != PER_USER_TABLE_COLUMNS:
+            logger.warning(f"Skipping table {table_name}, it is not a per user stocks table")
+            continue
+
+        user_id = table_name
+        try:
+            with engine.begin() as connection:
+                stmt = insert(users_trades_table).from_select(
+                    ["user_id", "timestamp", "ticker", "action", "amount", "price"],
+                    select(literal(user_id), table.c.timestamp, table.c.ticker, table.c.action, table.c.amount, table.c.price)
+                )
+                result = connection.execute(stmt)
+                if drop_tables:
+                    table.drop(connection)
+            migrated[user_id] = result.rowcount
+            logger.info(f"Migrated {result.rowcount} trades of user {user_id}")
+        except Exception as error:
+            logger.error(f"Failed migrating trades of user {user_id}: {error}")
+    return migrated
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fold per user stocks tables into the trades table")
+    parser.add_argument("--keep-tables", action="store_true", help="Do not drop the per user tables after copying them")
+    args = parser.parse_args()
+
+    migrated = migrate_per_user_tables(drop_tables=not args.keep_tables)
+    logger.info(f"Migrated {sum(migrated.values())} trades of {len(migrated)} users")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+from typing import Dict, Iterable, Union
+
+
+def empty_position(ticker: str) -> dict:
+    """
+    :param ticker: Stock ticker
+    :returns: Position of a ticker that was never traded
+    """
+    return {"ticker": ticker, "quantity": 0.0, "average_cost": 0.0, "realized_pnl": 0.0, "updated_at": 0}
+
+def apply_trade(position: dict, action: str, amount: float, price: float, timestamp: int = 0) -> dict:
+    """
+    Update a position with one trade. Quantity is signed (negative is short),
+    average cost is the cost of the open quantity and realized P&L grows when a position is reduced
+
+    :param position: Position dict (see empty_position)
+    :param action: buy or sell
+    :param amount: Amount of stocks traded (positive)
+    :param price: Price of a single stock
+    :param timestamp: Epoch seconds of the trade
+    :returns: The updated position (a new dict)
+    """
+    quantity: float = position["quantity"]
+    average_cost: float = position["average_cost"]
+    realized_pnl: float = position["realized_pnl"]
+    delta = amount if action == "buy" else -amount
+
+    if quantity == 0 or (quantity > 0) == (delta > 0):
+        # opening or adding to a position
+        average_cost = (abs(quantity) * average_cost + amount * price) / (abs(quantity) + amount)
+    else:
+        # reducing, closing or flipping a position
+        closed = min(amount, abs(quantity))
+        realized_pnl += closed * (price - average_cost) * (1 if quantity > 0 else -1)
+        if amount > abs(quantity):
+            average_cost = price
+
+    quantity += delta
+    if abs(quantity) < 1e-12:
+        quantity = 0.0
+        average_cost = 0.0
+    return {
+        "ticker": position["ticker"],
+        "quantity": quantity,
+        "average_cost": average_cost,
+        "realized_pnl": realized_pnl,
+        "updated_at": max(position["updated_at"], int(timestamp)),
+    }
+
+def fold_trades(positions: Dict[str, dict], trades: Iterable[Union[dict, tuple]]) -> Dict[str, dict]:
+    """
+    Apply trades (in the order given) to positions
+
+    :param positions: Dict of ticker -> position to start from, not modified
+    :param trades: Trades - dicts (or tuples in this order) of timestamp, ticker, action, amount and price
+    :returns: Dict of ticker -> updated position, only for tickers that were traded
+    """
+    updated: Dict[str, dict] = {}
+    for trade in trades:
+        if isinstance(trade, dict):
+            timestamp, ticker, action, amount, price = (
+                trade["timestamp"], trade["ticker"], trade["action"], trade["amount"], trade["price"]
+            )
+        else:
+            timestamp, ticker, action, amount, price = trade
+        position = updated.get(ticker) or positions.get(ticker) or empty_position(ticker)
+        updated[ticker] = apply_trade(position, action, amount, price, timestamp)
+    return updated
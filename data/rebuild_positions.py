@@ -0,0 +1,23 @@
+# Recompute the materialized positions of the Users_Stocks database from the trades table
+# Usage: python -m data.rebuild_positions [--user-id USER_ID]
+import argparse
+
+from data.database_models import create_schema, rebuild_positions
+from utils.logger_script import logger
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuild positions from trades and report the ones that were inconsistent")
+    parser.add_argument("--user-id", default=None, help="Only rebuild the positions of this user")
+    args = parser.parse_args()
+
+    create_schema()
+    mismatches = rebuild_positions(args.user_id)
+    if mismatches:
+        for user_id, tickers in mismatches.items():
+            logger.warning(f"User {user_id}: rebuilt inconsistent positions {tickers}")
+    else:
+        logger.info("All positions were consistent with the trades")
+
+if __name__ == "__main__":
+    main()
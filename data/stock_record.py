@@ -1,7 +1,10 @@
-from typing import Dict, Self, Literal
+from typing import Dict, Self, Literal, List, Tuple, Union
 from dataclasses import dataclass, asdict, fields
 from datetime import datetime
 
+import numpy as np
+import pandas as pd
+
 from utils.logger_script import logger
 
 @dataclass
@@ -10,6 +13,7 @@ class StockRecord:
     action: Literal["buy", "sell"] = "invalid"
     amount: float = 0.0
     price: float = 0.0
+    ticker: str = ""
     
     def to_dict(self) -> dict:
         return asdict(self)
@@ -24,3 +28,67 @@ class StockRecord:
         except Exception as error:
             logger.error(f"Couldn't create new stock record from input dict {dict}. Error: {error}")
             return None
+
+STOCK_RECORD_COLUMNS = [field.name for field in fields(StockRecord)]
+
+def stock_records_to_frame(records: List[Union[StockRecord, dict]]) -> pd.DataFrame:
+    """
+    Put stock records in one dataframe (a column per field) without converting each record to a dict
+
+    :param records: List of stock records or dicts with stock record fields
+    :returns: Dataframe with the stock record columns, one row per record
+    """
+    rows = [
+        tuple(getattr(record, column) for column in STOCK_RECORD_COLUMNS) if isinstance(record, StockRecord)
+        else tuple(record.get(column) for column in STOCK_RECORD_COLUMNS)
+        for record in records
+    ]
+    return pd.DataFrame.from_records(rows, columns=STOCK_RECORD_COLUMNS)
+
+def validate_stock_records(frame: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[int, str]]:
+    """
+    Validate stock records in one vectorized pass
+
+    :param frame: Dataframe created by stock_records_to_frame
+    :returns: Dataframe of the valid records (timestamp, ticker, action, amount, price - ready for the trades table),
+              dict of row number -> reason for every rejected record
+    """
+    # timeframes can be datetimes, iso strings or epoch seconds, naive datetimes are treated as UTC
+    timeframe = frame["timeframe"]
+    is_numeric = timeframe.map(lambda value: isinstance(value, (int, float, np.number)) and not isinstance(value, bool))
+    numeric_timeframe = pd.to_numeric(timeframe.where(is_numeric), errors="coerce")
+    is_numeric &= numeric_timeframe.notna()
+    parsed = pd.to_datetime(timeframe.where(~is_numeric), errors="coerce", utc=True, format="mixed")
+    timestamp = pd.Series(pd.NA, index=frame.index, dtype="Int64")
+    is_parsed = ~is_numeric & parsed.notna()
+    timestamp[is_parsed] = (parsed[is_parsed] - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+    timestamp[is_numeric] = numeric_timeframe[is_numeric].astype("int64")
+
+    ticker = frame["ticker"].astype("string").str.strip().str.upper()
+    action = frame["action"].astype("string").str.strip().str.lower()
+    amount = pd.to_numeric(frame["amount"], errors="coerce")
+    price = pd.to_numeric(frame["price"], errors="coerce")
+
+    checks = [
+        (timestamp.isna(), "Invalid timeframe"),
+        (ticker.isna() | (ticker == ""), "Missing ticker"),
+        (~action.isin(["buy", "sell"]).fillna(False), "Action must be buy or sell"),
+        (~(amount > 0).fillna(False), "Amount must be positive"),
+        (~(price > 0).fillna(False), "Price must be positive"),
+    ]
+    rejected: Dict[int, str] = {}
+    invalid = pd.Series(False, index=frame.index)
+    for failed, reason in checks:
+        failed = failed.fillna(True).astype(bool)
+        for row in failed[failed & ~invalid].index:
+            rejected[int(row)] = reason
+        invalid |= failed
+
+    valid = pd.DataFrame({
+        "timestamp": timestamp[~invalid].astype("int64"),
+        "ticker": ticker[~invalid].astype(str),
+        "action": action[~invalid].astype(str),
+        "amount": amount[~invalid].astype(float),
+        "price": price[~invalid].astype(float),
+    })
+    return valid, rejected
@@ -1,2 +1,2 @@
-__all__ = ["send_email"]
+__all__ = ["send_email", "outbox"]
 from . import *
\ No newline at end of file
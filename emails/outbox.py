@@ -0,0 +1,329 @@
+import asyncio
+import random
+import smtplib
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from enum import Enum
+from os import getenv
+from typing import Callable, Dict, List, Tuple, Union
+
+from sqlalchemy import and_, bindparam, func, insert, or_, select, update
+from sqlalchemy.engine import Engine
+
+from data.database import db_engine_userbase
+from data.database_models import email_outbox_table
+from emails.send_email import Message_Types, Message_Types_Titles, create_message, load_template
+from utils.logger_script import logger
+from utils.server_protocol import Constants as ServerConstants
+
+
+class Constants(Enum):
+    # 587 uses STARTTLS, 465 connects over SSL. A local stand-in, e.g: python -m aiosmtpd -n -l localhost:1025,
+    # is used with SMTP_SERVER_URL=localhost SMTP_PORT=1025 SMTP_STARTTLS=0
+    SMTP_PORT = int(getenv("SMTP_PORT", "587"))
+    SMTP_STARTTLS = getenv("SMTP_STARTTLS", "1") != "0"
+    smtp_timeout = 30.0
+    # Seconds the smtp session is kept open without sending, it is checked with NOOP before being reused after that
+    idle_seconds = 60.0
+    # Emails claimed and sent on one session at a time
+    batch_size = 50
+    # Seconds between checks of the outbox when nothing wakes the worker up
+    poll_seconds = 5.0
+    # Attempts before an email is given up on, the wait after a failed attempt doubles every time
+    max_attempts = 6
+    backoff_base = 30.0
+    backoff_max = 60.0 * 60
+    # Seconds after which emails claimed by a worker that never finished (crashed) are claimed again. The worker
+    # renews its claim while it sends, so this only has to be longer than one email can take: two connections,
+    # each a few smtp operations of up to smtp_timeout
+    claim_timeout = 15 * 60.0
+    # Seconds between renewals of a claim while its batch is being sent
+    claim_renew_seconds = 60.0
+
+class SMTPSession:
+    """
+    One SMTP connection reused for every email - connecting, STARTTLS and login happen once,
+    not per email. Broken connections are reopened once per email before the email counts as failed
+    """
+    def __init__(self, host: str = ServerConstants.SMTP_SERVER_URL.value, port: int = Constants.SMTP_PORT.value,
+                 username: str = ServerConstants.SERVER_EMAIL.value, password: str = ServerConstants.SERVER_PASSWORD.value,
+                 starttls: bool = Constants.SMTP_STARTTLS.value, sender: str = ServerConstants.SERVER_EMAIL.value):
+        self.host: str = host
+        self.port: int = port
+        self.username: str = username
+        self.password: str = password
+        self.starttls: bool = starttls
+        self.sender: str = sender or username
+        self.smtp: Union[smtplib.SMTP, None] = None
+        self.last_used: float = 0.0
+        self.connections: int = 0
+
+    def connect(self) -> smtplib.SMTP:
+        logger.info(f"Connecting to smtp server {self.host}:{self.port}")
+        if self.port == 465:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=Constants.smtp_timeout.value)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=Constants.smtp_timeout.value)
+            if self.starttls:
+                smtp.ehlo()
+                smtp.starttls()
+        smtp.ehlo()
+        if self.username and self.password:
+            smtp.login(self.username, self.password)
+        self.connections += 1
+        return smtp
+
+    def get_connection(self) -> smtplib.SMTP:
+        if self.smtp is not None and time.monotonic() - self.last_used > Constants.idle_seconds.value:
+            # servers drop idle connections, check it is still open
+            try:
+                if self.smtp.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+        if self.smtp is None:
+            self.smtp = self.connect()
+        return self.smtp
+
+    def send(self, messages: List[Tuple[str, MIMEMultipart]], on_progress: Callable[[], None] = None) -> Dict[int, str]:
+        """
+        Send emails on the session (blocking)
+
+        :param messages: List of (recipient, message)
+        :param on_progress: Called after every email, e.g. to renew the claim of the emails
+        :returns: Dict of index in messages -> error, for the emails that failed
+        """
+        errors: Dict[int, str] = {}
+        for index, (email, message) in enumerate(messages):
+            message["To"] = email
+            for attempt in range(2):
+                try:
+                    self.get_connection().sendmail(self.sender, email, message.as_string())
+                    break
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as error:
+                    # the server answered, the connection can be used for the next emails
+                    errors[index] = str(error)
+                    break
+                except (smtplib.SMTPException, OSError) as error:
+                    self.close()
+                    if attempt:
+                        errors[index] = str(error)
+            self.last_used = time.monotonic()
+            if on_progress is not None:
+                on_progress()
+        return errors
+
+    def close(self) -> None:
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.smtp = None
+
+class EmailOutbox:
+    """
+    Emails are stored in the outbox table and sent by a background worker, so requests never wait on the
+    mail server. The worker claims due emails in batches, sends them on one reused SMTP session and retries
+    failures with exponential backoff. Emails survive restarts, claims of a crashed worker expire
+    """
+    def __init__(self, engine: Engine = db_engine_userbase, session: SMTPSession = None, batch_size: int = Constants.batch_size.value):
+        self.engine: Engine = engine
+        self.session: SMTPSession = session or SMTPSession()
+        self.batch_size: int = batch_size
+        # one thread, the smtp session is not shared between threads
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="email_outbox")
+        self.loop: Union[asyncio.AbstractEventLoop, None] = None
+        self.wakeup: Union[asyncio.Event, None] = None
+        self.running: bool = False
+
+        # metrics
+        self.sent: int = 0
+        self.retried: int = 0
+        self.failed: int = 0
+
+    def enqueue(self, email: str, message_type: str) -> Union[int, None]:
+        """
+        Store an email to be sent by the worker
+
+        :param message_type: Name of a Message_Types member. E.g: sign_up
+        :returns: Id of the email in the outbox, None if it could not be stored
+        """
+        if message_type not in Message_Types.__members__:
+            logger.error(f"Unknown email message type {message_type}")
+            return None
+        now = time.time()
+        stmt = insert(email_outbox_table).values(
+            email=email, message_type=message_type, status="pending", attempts=0, next_attempt_at=now, created_at=now
+        )
+        try:
+            with self.engine.begin() as connection:
+                email_id = connection.execute(stmt).inserted_primary_key[0]
+        except Exception as error:
+            logger.error(f"Failed adding {message_type} email to {email} to the outbox: {error}")
+            return None
+        self.wake()
+        return email_id
+
+    def wake(self) -> None:
+        """
+        Wake the worker up to send right away (thread safe)
+        """
+        if self.loop is not None and self.wakeup is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def claim(self, now: float) -> list:
+        """
+        Mark a batch of due emails as being sent by this worker
+
+        :returns: Rows of the claimed emails
+        """
+        table = email_outbox_table
+        due = or_(
+            and_(table.c.status == "pending", table.c.next_attempt_at <= now),
+            and_(table.c.status == "sending", table.c.claimed_at < now - Constants.claim_timeout.value),
+        )
+        batch = select(table.c.id).where(due).order_by(table.c.next_attempt_at).limit(self.batch_size).scalar_subquery()
+        claim = uuid.uuid4().hex
+        with self.engine.begin() as connection:
+            # the due condition is checked again in the update, so two workers never claim the same email
+            connection.execute(update(table).where(and_(table.c.id.in_(batch), due)).values(status="sending", claim=claim, claimed_at=now))
+            return connection.execute(select(table).where(table.c.claim == claim)).all()
+
+    def renew_claim(self, claim: str) -> None:
+        """
+        Keep the emails of a claim from being claimed again by another worker while they are being sent
+        """
+        table = email_outbox_table
+        with self.engine.begin() as connection:
+            connection.execute(update(table).where(and_(table.c.claim == claim, table.c.status == "sending")).values(claimed_at=time.time()))
+
+    def create_messages(self, rows: list) -> Tuple[Dict[int, Tuple[str, MIMEMultipart]], Dict[int, str]]:
+        """
+        Create the message of every claimed email, an email whose message can not be created fails on its own
+
+        :returns: Dict of index in rows -> (recipient, message), dict of index in rows -> error
+        """
+        messages: Dict[int, Tuple[str, MIMEMultipart]] = {}
+        errors: Dict[int, str] = {}
+        for index, row in enumerate(rows):
+            try:
+                messages[index] = (row.email, create_message(Message_Types_Titles[row.message_type].value, Message_Types[row.message_type].value))
+            except Exception as error:
+                logger.error(f"Failed creating {row.message_type} email {row.id}: {error!r}")
+                errors[index] = f"Failed creating message: {error!r}"
+        return messages, errors
+
+    def send_due(self) -> dict:
+        """
+        Send one batch of due emails (blocking)
+
+        :returns: Dict of claimed, sent, retried and failed counts
+        """
+        now = time.time()
+        rows = self.claim(now)
+        if not rows:
+            return {"claimed": 0, "sent": 0, "retried": 0, "failed": 0}
+        claim = rows[0].claim
+        messages, errors = self.create_messages(rows)
+        indexes = list(messages)
+        last_renewal = time.monotonic()
+
+        def renew() -> None:
+            nonlocal last_renewal
+            if time.monotonic() - last_renewal >= Constants.claim_renew_seconds.value:
+                last_renewal = time.monotonic()
+                try:
+                    self.renew_claim(claim)
+                except Exception as error:
+                    logger.error(f"Failed renewing claim of {len(rows)} emails: {error}")
+
+        send_errors = self.session.send([messages[index] for index in indexes], on_progress=renew)
+        errors.update({indexes[position]: error for position, error in send_errors.items()})
+
+        updates = []
+        retried = failed = 0
+        for index, row in enumerate(rows):
+            attempts = row.attempts + 1
+            values = {"email_id": row.id, "new_attempts": attempts, "new_sent_at": None, "new_last_error": errors.get(index), "new_next_attempt_at": row.next_attempt_at}
+            if index not in errors:
+                values.update(new_status="sent", new_sent_at=time.time())
+            elif attempts >= Constants.max_attempts.value:
+                values.update(new_status="failed")
+                failed += 1
+            else:
+                backoff = min(Constants.backoff_base.value * 2 ** (attempts - 1), Constants.backoff_max.value)
+                values.update(new_status="pending", new_next_attempt_at=now + random.uniform(backoff / 2, backoff))
+                retried += 1
+            updates.append(values)
+        table = email_outbox_table
+        # a worker whose claim expired anyway does not overwrite the worker that claimed the emails again
+        stmt = update(table).where(and_(table.c.id == bindparam("email_id"), table.c.claim == claim)).values(
+            status=bindparam("new_status"), attempts=bindparam("new_attempts"), sent_at=bindparam("new_sent_at"),
+            last_error=bindparam("new_last_error"), next_attempt_at=bindparam("new_next_attempt_at"), claim=None,
+        )
+        with self.engine.begin() as connection:
+            connection.execute(stmt, updates)
+
+        sent = len(rows) - retried - failed
+        self.sent += sent
+        self.retried += retried
+        self.failed += failed
+        if errors:
+            logger.warning(f"Sent {sent} of {len(rows)} emails, {retried} will be retried and {failed} failed: {set(errors.values())}")
+        else:
+            logger.info(f"Sent {sent} emails")
+        return {"claimed": len(rows), "sent": sent, "retried": retried, "failed": failed}
+
+    async def run_forever(self) -> None:
+        """
+        Send due emails until cancelled - right after an email is enqueued, otherwise every poll_seconds
+        """
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.running = True
+        for message_type in Message_Types:
+            try:
+                load_template(message_type.value)
+            except OSError as error:
+                logger.error(f"Failed loading {message_type.value} email templates: {error}")
+        try:
+            while True:
+                self.wakeup.clear()
+                try:
+                    result = await self.loop.run_in_executor(self.executor, self.send_due)
+                except Exception as error:
+                    logger.error(f"Failed sending emails from the outbox: {error}")
+                    result = {"claimed": 0}
+                if result["claimed"] == self.batch_size:
+                    # more emails are probably due
+                    continue
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=Constants.poll_seconds.value)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.running = False
+            self.executor.submit(self.session.close)
+
+    def get_status(self) -> dict:
+        """
+        :returns: Dict of running, emails per status, sent, retried and failed counts and smtp connections opened
+        """
+        stmt = select(email_outbox_table.c.status, func.count()).group_by(email_outbox_table.c.status)
+        with self.engine.connect() as connection:
+            statuses = {status: count for status, count in connection.execute(stmt)}
+        return {
+            "running": self.running,
+            "statuses": statuses,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "connections": self.session.connections,
+        }
+
+# Outbox the server's worker sends from
+email_outbox = EmailOutbox()
@@ -1,5 +1,7 @@
 import os
 from enum import Enum
+from functools import lru_cache
+from typing import Tuple
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import smtplib
@@ -17,6 +19,29 @@ class Message_Types_Titles(Enum):
   reset_password = "Reset Your O.G Papertrading Account's Password"
   sign_up = "Welcome to O.G Papertrading"
 
+@lru_cache(maxsize=None)
+def load_template(message_type: str) -> Tuple[str, str]:
+  """
+  Reads the plain text and html templates of a message type from disk, once per message type
+
+  Parameters:
+    message_type (str): Type of message; e.g reset_password, sign_up
+
+  Returns:
+    The plain text and html of the message
+  """
+  # get absoulte path of email message
+  script_dir: str = os.path.dirname(__file__)
+  absolute_path: str = os.path.join(script_dir, message_type, message_type)
+
+  # in plain text
+  with open(f"{absolute_path}.txt", "r") as file:
+    text = str(file.read())
+  # in html
+  with open(f"{absolute_path}.html", "r") as file:
+    html = str(file.read())
+  return text, html
+
 def create_message(message_title: str, message_type: str) -> MIMEMultipart:
   """
   Creates an email message with the given message type
@@ -34,26 +59,12 @@ def create_message(message_title: str, message_type: str) -> MIMEMultipart:
   message["Subject"] = message_title
   message["From"] = Constants.SERVER_EMAIL.value
   
-  # get absoulte path of email message
-  script_dir: str = os.path.dirname(__file__)
-  relative_path: str = f"{message_type}\\{message_type}"
-  absolute_path: str = os.path.join(script_dir, relative_path)
-
-  # get email message
-  # in plain text
-  text = None
-  try:
-    with open(f"{absolute_path}.txt", "r") as file:
-      text = str(file.read())
-  except Exception as error:
-    logger.error(f"Error reading reset password text file {error}")
-  # in html
-  html = None
+  # get email message, the templates are read from disk once
+  text, html = None, None
   try:
-    with open(f"{absolute_path}.html", "r") as file:
-      html = str(file.read())
+    text, html = load_template(message_type)
   except Exception as error:
-    logger.error(f"Error reading reset password html file {error}")
+    logger.error(f"Error reading {message_type} template files {error}")
   
   # Turn the plain text/html to MIMEText objects
   part1 = MIMEText(text, "plain")
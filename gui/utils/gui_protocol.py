@@ -14,6 +14,7 @@ class Constants(Enum):
     content_width = default_width
     welcome_image_path = gui_root_path + r"\assets\welcome.jpg"
     server_url = "http://127.0.0.1:5555" # Needs to be dynamic!!!!
+    server_timeout = (3.05, 30) # (connect, read) seconds, a server that does not answer falls back to getting stocks locally
 
 class ImageSizes(Enum):
     welcome = (1920, 850)
@@ -1,25 +1,27 @@
 from typing import Union, List
 import datetime
 
-import matplotlib
 import flet as ft
-from flet.matplotlib_chart import MatplotlibChart
+import pandas as pd
+import requests
 
 from gui.router import Router
 import gui.utils.gui_protocol as gp
 import stocks.stock_script as stock_script
+import stocks.serialization as serialization
+import stocks.charts as charts
 
 
-matplotlib.use("svg")
-
 class Stocks:
     def __init__(self, router: Router):
         self._router: Router = router
         self.page: Union[ft.Page, None] = None
         
         # Fields for sign up - email, username, password
-        self.chart: Union[MatplotlibChart, None]= None
+        self.chart: Union[ft.LineChart, None]= None
+        self.chart_row: ft.Row = self.init_chart_row()
         self.create_graph_button: ft.ElevatedButton = self.init_create_graph_button()
+        self.plot_type_dropdown: ft.Dropdown = self.init_plot_type_dropdown()
         
         self.date_picker_button: ft.ElevatedButton = self.init_date_picker_button()
         self.date_picker: ft.DatePicker = self.init_date_picker()
@@ -76,19 +78,31 @@ class Stocks:
         )
         return create_graph_button
     
+    def init_plot_type_dropdown(self) -> ft.Dropdown:
+        plot_type_dropdown = ft.Dropdown(
+            label="Plot type",
+            value="Adj Close",
+            width=150,
+            options=[ft.dropdown.Option(plot_type) for plot_type in charts.PLOT_TYPES],
+        )
+        return plot_type_dropdown
+
+    def init_chart_row(self) -> ft.Row:
+        chart_row = ft.Row(
+            width=gp.Constants.default_width.value / 2,
+            height=gp.Constants.default_height.value / 2,
+            spacing=10,
+            run_spacing=10,
+            controls=[],
+        )
+        return chart_row
+
     def init_chart(self, ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None):
-        self.chart = self.get_chart_from_stockpuller(ticker=ticker, start=start, end=end, interval=interval)
-        self._content.controls.append(
-            ft.Row(
-                width=gp.Constants.default_width.value / 2,
-                height=gp.Constants.default_height.value / 2,
-                spacing=10,
-                run_spacing=10,
-                controls = [
-                    self.chart,
-                ]
-            )
+        # the chart replaces the previous one instead of adding another chart on every click
+        self.chart = self.get_chart_from_stockpuller(
+            ticker=ticker, start=start, end=end, interval=interval, plot_type=self.plot_type_dropdown.value or "Adj Close"
         )
+        self.chart_row.controls = [self.chart] if self.chart is not None else []
         self.page.update()
 
     def change_time(self, e) -> None:
@@ -136,11 +150,90 @@ class Stocks:
         else:
             self.init_chart()
         
-    def get_chart_from_stockpuller(self, ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None) -> MatplotlibChart:
-        my_stock = stock_script.StockPuller.get_stock(ticker=ticker, start=start, end=end, interval=interval)
-        print(my_stock)
-        fig = stock_script.StockPuller.get_stock_plt_figure(df=my_stock)
-        flet_chart = MatplotlibChart(fig, expand=True)
+    def get_stock_from_server(self, ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, max_points: int = None) -> Union[pd.DataFrame, None]:
+        """
+        Get a stock's dataframe from the server in the column oriented format
+
+        :param max_points: Bars the server downsamples the stock to (merging bars), None for every bar
+        :returns: Dataframe of the stock, None if the server could not be reached or failed
+        """
+        params = {"ticker": ticker, "interval": interval, "format": serialization.DataFormats.columns.name, "max_points": max_points}
+        if start is not None:
+            params["start"] = start.isoformat()
+        if end is not None:
+            params["end"] = end.isoformat()
+        try:
+            response = requests.get(
+                url=f"{gp.Constants.server_url.value}/stock_data",
+                params={key: value for key, value in params.items() if value is not None},
+                headers={"Accept": serialization.DataFormats.columns.value},
+                timeout=gp.Constants.server_timeout.value,
+            )
+        except Exception as error:
+            print(f"Server is currently down, getting stock locally: {error}")
+            return None
+        if response.status_code != 200 or not response.headers.get("content-type", "").startswith(serialization.DataFormats.columns.value):
+            print(f"Failed getting stock from server: {response.status_code}, {response.text[:200]}")
+            return None
+        return serialization.from_columns(response.json())
+
+    def get_chart_points(self, ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, plot_type: str = "Adj Close", max_points: int = None) -> Union[dict, None]:
+        """
+        Get downsampled points of a chart, cached per (ticker, range, interval, plot_type, max_points)
+
+        :param max_points: Points of the chart, defaults to the chart's width in pixels
+        :returns: {"x": epoch milliseconds, "y": values}, None if the stock could not be fetched
+        """
+        if max_points is None:
+            max_points = int(self.chart_row.width)
+        start, end, interval = stock_script.StockPuller.get_default_range(start, end, interval)
+        key = ("points", ticker, start, end, interval, plot_type, max_points)
+        points = charts.chart_cache.get(key)
+        if points is not None:
+            return points
+
+        # the server merges bars down to a few per point, the chart then picks the points that keep its shape
+        my_stock = self.get_stock_from_server(ticker=ticker, start=start, end=end, interval=interval, max_points=max_points * 4)
+        if my_stock is None:
+            my_stock = stock_script.StockPuller.get_stock(ticker=ticker, start=start, end=end, interval=interval)
+        if my_stock is None or my_stock.empty:
+            print(f"No data to chart for {ticker}")
+            return None
+        points = charts.get_chart_points(my_stock, plot_type, max_points=max_points)
+        charts.chart_cache.set(key, points, ttl=charts.get_chart_ttl(end, interval))
+        return points
+
+    def get_chart_from_stockpuller(self, ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, plot_type: str = "Adj Close", max_points: int = None) -> Union[ft.LineChart, None]:
+        points = self.get_chart_points(ticker=ticker, start=start, end=end, interval=interval, plot_type=plot_type, max_points=max_points)
+        if points is None or not points["x"]:
+            return None
+        x_values, y_values = points["x"], points["y"]
+
+        # a few time labels spread over the x axis
+        label_indexes = sorted({round(index * (len(x_values) - 1) / 5) for index in range(6)})
+        bottom_labels = [
+            ft.ChartAxisLabel(
+                value=x_values[index],
+                label=ft.Text(pd.Timestamp(x_values[index], unit="ms").strftime("%d/%m %H:%M"), size=10),
+            )
+            for index in label_indexes
+        ]
+        flet_chart = ft.LineChart(
+            data_series=[
+                ft.LineChartData(
+                    data_points=[ft.LineChartDataPoint(x, y) for x, y in zip(x_values, y_values)],
+                    stroke_width=2,
+                    color=ft.colors.BLUE,
+                )
+            ],
+            left_axis=ft.ChartAxis(labels_size=50, title=ft.Text(f"{plot_type} value")),
+            bottom_axis=ft.ChartAxis(labels=bottom_labels, labels_size=32),
+            min_x=x_values[0],
+            max_x=x_values[-1],
+            min_y=min(y_values),
+            max_y=max(y_values),
+            expand=True,
+        )
         return flet_chart
 
     def init_content(self) -> ft.Column:
@@ -154,8 +247,10 @@ class Stocks:
                         self.create_graph_button,
                         self.date_picker_button,
                         self.time_picker_button,
+                        self.plot_type_dropdown,
                     ]
                 ),
+                self.chart_row,
             ]
         )
         return content
@@ -1,33 +1,56 @@
 from typing import List, Dict, TypedDict
+import argparse
 import datetime
+import asyncio
+import json
+import os
+import secrets
+from functools import partial
 from io import StringIO
 
+import anyio
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException, Response
+from fastapi import FastAPI, Depends, HTTPException, Response, Query, Request, Body, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from sqlalchemy import or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 import pandas as pd
 from pandas import DataFrame
 import utils.server_protocol as sp
+import utils.auth as auth
+import utils.email_validation as email_validation
+import utils.shared_cache as shared_cache
 from utils.logger_script import logger
 import data.database_models as db_m
-from data.database import (db_base_userbase, db_engine_userbase,
-                      db_engine_users_stocks, db_metadata_users_stocks,
-                      db_engine_stocksbase, db_metadata_stocksbase)
+from data.database import get_async_db_userbase
 import emails.send_email as send_email
+import emails.outbox as outbox
 from stocks.stock_script import StockPuller
+import stocks.stock_script as stock_script
+import stocks.serialization as serialization
+import stocks.valuation as valuation_script
+import stocks.backtest as backtest
+import stocks.orders as orders_script
+import stocks.refresher as refresher
+import stocks.live as live
+import stocks.charts as charts
+import stocks.downsampling as downsampling
+import stocks.indicators as indicators_script
 
 # CONSTANTS
 HOST_IP = sp.Constants.HOST_IP.value
 HOST_PORT = sp.Constants.HOST_PORT.value
+# Users per page of /database
+DATABASE_PAGE_SIZE = 100
+DATABASE_MAX_PAGE_SIZE = 1000
 
 # Create FastAPI app
 papertrading_app = FastAPI()
-# Create database 
-db_base_userbase.metadata.create_all(bind=db_engine_userbase)
-# Create Stocksbase
-db_metadata_stocksbase.create_all(bind=db_engine_stocksbase)
-#create users stocks
-db_metadata_users_stocks.create_all(bind=db_engine_users_stocks)
+# Create the tables of the userbase, stocksbase and users stocks, one worker at a time
+with shared_cache.get_process_lock("schema"):
+    db_m.create_schema()
 
 def does_username_and_password_match(user_model, username: str, password: str):
     """
@@ -39,10 +62,10 @@ def does_username_and_password_match(user_model, username: str, password: str):
         :param password: password
     
     Returns:
-        True: if the encoded username matches the user's username in the database and the encoded password matches the user's password in the database
+        True: if the encoded username matches the user's username in the database and the password matches the user's password hash in the database
     """
     try:
-        return sp.encode_string(username) == user_model.username and sp.encode_string(password) == user_model.password
+        return sp.encode_string(username) == user_model.username and auth.verify_password(password, user_model.password)[0]
     except Exception as error:
         return False
 
@@ -51,34 +74,44 @@ def root():
     return {"message": "Hello World"}
 
 @papertrading_app.get("/get_user_by_username")
-def get_user_by_username(username: str, db: Session = Depends(db_m.get_db_userbase)) -> List[Dict]:
+def get_user_by_username(username: str, db: Session = Depends(db_m.get_db_userbase)) -> Dict:
+    """
+    Get a user by username - one lookup on the unique index of the stored (SHA-256 encoded) usernames
+
+    :returns: id, email and username (encoded) of the user
+    """
     try:
-        # get user with id from database
-        user_model = db.query(db_m.Userbase).filter(db_m.Userbase.username == username).first()
-        
-        # check if there is no such user
-        if user_model is None:
-            raise HTTPException(
-                status_code=404,
-                detail=f"ID: {username} does not exist"
-            )
-        
-        try: 
-            user = db.query(db_m.Userbase).all()
-            return user
-        except Exception as error:
-            logger.error(f"Failed querying user in database: {error}")
-            return None
+        user_model = db.query(db_m.Userbase).filter(db_m.Userbase.username == sp.encode_string(username)).first()
     except Exception as error:
         logger.error(f"Failed getting user: {error}")
+        return {"error": True}
+    if user_model is None:
+        raise HTTPException(status_code=404, detail=f"Username: {username} does not exist")
+    return user_model.to_dict()
 
 # FINAL (for now)
 @papertrading_app.get("/database")
-def get_whole_database(db: Session = Depends(db_m.get_db_userbase)) -> List[Dict]:
+async def get_whole_database(after: str = None, limit: int = Query(DATABASE_PAGE_SIZE, gt=0, le=DATABASE_MAX_PAGE_SIZE), claims: dict = Depends(auth.get_admin_claims), db: AsyncSession = Depends(get_async_db_userbase)) -> Dict:
+    """
+    Get the users a page at a time, ordered by id - admins only (a token of a user in ADMIN_USER_IDS).
+    Pages continue after the last id of the previous page (keyset pagination), so every page is one
+    range read on the primary key however many users there are. Passwords are never listed
+
+    :param after: next_after of the previous page, None for the first page
+    :returns: users (id, email and username) and next_after (None after the last page)
+    """
+    table = db_m.Userbase.__table__
+    stmt = select(table.c.id, table.c.email, table.c.username).order_by(table.c.id).limit(limit + 1)
+    if after is not None:
+        stmt = stmt.where(table.c.id > after)
     try:
-        return db.query(db_m.Userbase).all()
+        users = [dict(row._mapping) for row in await db.execute(stmt)]
     except Exception as error:
         logger.error(f"Failed getting database: {error}")
+        return {"error": True}
+    # one user more than the page tells whether there is a next page
+    next_after = users[limit - 1]["id"] if len(users) > limit else None
+    return {"users": users[:limit], "next_after": next_after}
 
 # working fine
 @papertrading_app.post("/sign_up")
@@ -87,22 +120,32 @@ def sign_up(email: str, username: str, password: str, db: Session = Depends(db_m
         logger.debug(f"Received sign up request")
         return_dict = sp.Response()
         user_model = db_m.Userbase()
+        email = email.strip().lower()
+        encoded_username = sp.encode_string(username)
 
-        # filter out using email or username that is already being used
-        if db.query(db_m.Userbase).filter(db_m.Userbase.email == email).first() is not None:
+        # filter out using email or username that is already being used, one query on both unique indexes
+        taken = db.query(db_m.Userbase.email, db_m.Userbase.username).filter(
+            or_(db_m.Userbase.email == email, db_m.Userbase.username == encoded_username)
+        ).limit(2).all()
+        if any(user.email == email for user in taken):
             return_dict.error = "Failed to sign up. Email associated with existing user"
             return return_dict.to_dict()
-        # save email as string, save username and password encoded sha256 to database
+        if taken:
+            return_dict.error = "Failed to sign up. Username associated with existing user"
+            return return_dict.to_dict()
+        # save email as string, username encoded sha256 and password hashed with scrypt to database
         logger.info("Checking if email exists by SMTP and DNS")
-        if not sp.is_valid_email_external(email):
+        # run on the event loop, cached verdicts and well known domains answer without waiting on any server
+        verdict = anyio.from_thread.run(email_validation.email_validator.validate, email)
+        if not verdict.valid:
             return_dict.error = "Invalid email address"
             return return_dict.to_dict()
-        logger.info(f"Email exists: {email}")
+        logger.info(f"Email exists: {email} ({verdict.reason})")
         
         # create user with email, username and password 
-        user_model.email = email.lower()
-        user_model.username = sp.encode_string(username)
-        user_model.password = sp.encode_string(password)
+        user_model.email = email
+        user_model.username = encoded_username
+        user_model.password = auth.hash_password(password)
 
         # add user to database
         try:
@@ -110,6 +153,11 @@ def sign_up(email: str, username: str, password: str, db: Session = Depends(db_m
             db.add(user_model)
             db.commit()
             logger.info(f"Added new user to the database: {user_model.email}")
+        except IntegrityError:
+            # signed up with the same email or username since the check
+            db.rollback()
+            return_dict.error = "Failed to sign up. Email or username associated with existing user"
+            return return_dict.to_dict()
         except Exception as error:
             logger.error(f"Failed adding user to database")
             return_dict.error = "Internal Server Error"
@@ -118,11 +166,10 @@ def sign_up(email: str, username: str, password: str, db: Session = Depends(db_m
                 detail=return_dict
             )
             
-        # send mail to user
-        flag: bool = send_email.send_email(email, send_email.Message_Types["sign_up"].value)
-        if not flag:
+        # queue mail to user, the outbox worker sends it in the background
+        if outbox.email_outbox.enqueue(email, send_email.Message_Types["sign_up"].value) is None:
             # Unsure weather to return false if email failed to send
-            logger.error(f"Failed sending email to user")
+            logger.error(f"Failed queueing email to user")
         return_dict.success = True
     except Exception as error:
         return_dict.success = False
@@ -130,9 +177,65 @@ def sign_up(email: str, username: str, password: str, db: Session = Depends(db_m
     finally:
         return return_dict.to_dict()
 
+@papertrading_app.post("/login")
+def login(username: str, password: str, db: Session = Depends(db_m.get_db_userbase)) -> dict:
+    """
+    Check a user's password once and issue a short lived token, sent as "Authorization: Bearer <token>"
+    so later calls skip the password hash. Passwords stored with plain SHA-256 are upgraded to scrypt
+
+    :returns: success, user_id, token and expires_at (epoch seconds)
+    """
+    return_dict = {"success": False, "user_id": None, "token": None, "expires_at": None}
+    try:
+        user_model = db.query(db_m.Userbase).filter(db_m.Userbase.username == sp.encode_string(username)).first()
+        if user_model is None:
+            # hash anyway, so unknown usernames take as long as wrong passwords
+            auth.hash_password(password)
+            return return_dict
+        matches, outdated = auth.verify_password(password, user_model.password)
+        if not matches:
+            return return_dict
+        if outdated:
+            user_model.password = auth.hash_password(password)
+            db.commit()
+            logger.info(f"Upgraded password hash of user {user_model.id}")
+        token, expires_at = auth.token_signer.issue(user_model.id)
+        return_dict.update(success=True, user_id=user_model.id, token=token, expires_at=expires_at)
+    except Exception as error:
+        logger.error(f"Failed logging in: {error}")
+    return return_dict
+
+@papertrading_app.get("/outbox/status")
+def get_outbox_status() -> dict:
+    """
+    :returns: Emails per status in the outbox, sent, retried and failed counts and smtp connections opened
+    """
+    try:
+        return outbox.email_outbox.get_status()
+    except Exception as error:
+        logger.error(f"Failed getting outbox status: {error}")
+        return {"error": True}
+
+@papertrading_app.get("/email_validation/metrics")
+def get_email_validation_metrics() -> dict:
+    """
+    :returns: Mail hosts and verdicts cache sizes, hits and misses, probes made and background verifications running
+    """
+    return email_validation.email_validator.get_metrics()
+
+@papertrading_app.get("/auth/metrics")
+def get_auth_metrics() -> dict:
+    """
+    :returns: Cached token claims, their hits and misses and revoked users
+    """
+    return auth.token_signer.get_metrics()
+
 # currently deleted with username and not email / both
 @papertrading_app.delete("/delete_user")
-def delete_user(user_id: str, username: str, password: str, db: Session = Depends(db_m.get_db_userbase)):
+def delete_user(user_id: str, username: str = None, password: str = None, claims: dict = Depends(auth.get_token_claims), db: Session = Depends(db_m.get_db_userbase)):
+    """
+    Delete a user, authorized by a token of the user (Authorization header) or by the user's username and password
+    """
     try: 
         return_dict = sp.Response()
         # get user with id from database
@@ -145,11 +248,12 @@ def delete_user(user_id: str, username: str, password: str, db: Session = Depend
                 detail=f"ID: {user_id} does not exist"
             )
         
-        # delete user if the username and password match the ones in the database
-        if does_username_and_password_match(user_model, username, password):
+        # delete user if the token is the user's or the username and password match the ones in the database
+        if (claims is not None and claims["sub"] == user_id) or does_username_and_password_match(user_model, username, password):
             # delete user
             db.query(db_m.Userbase).filter(db_m.Userbase.id == user_id).delete()
             db.commit()
+            auth.token_signer.revoke(user_id)
             return_dict.message = "Deleted user successfully"
             return_dict.success = True
         else:
@@ -189,15 +293,13 @@ def force_delete_user(user_id: str, db: Session = Depends(db_m.get_db_userbase))
         return return_dict.to_dict()
 # working fine
 @papertrading_app.put("/update_user")
-def update_user(user_id: str, username: str, password: str, new_username, new_password: str, db: Session = Depends(db_m.get_db_userbase)):
+def update_user(user_id: str, username: str, password: str = None, new_username: str = None, new_password: str = None, claims: dict = Depends(auth.get_token_claims), db: Session = Depends(db_m.get_db_userbase)):
+    """
+    Update a user's username or password. With a token of the user (Authorization header) only the username
+    is checked, without one the password is checked too
+    """
     try: 
         return_dict = sp.Response()
-        # don't update user if there is nothing to change
-        if new_username == username and new_password == password:
-            return_dict.message = "There is nothing to change"
-            return_dict.success = False
-            return return_dict.to_dict()
-        
         # get user with id from database
         user_model = db.query(db_m.Userbase).filter(db_m.Userbase.id == user_id).first()
         # raise exception if there is no such user
@@ -206,29 +308,43 @@ def update_user(user_id: str, username: str, password: str, new_username, new_pa
                 status_code=404,
                 detail=f"ID: {user_id} does not exist"
             )
-        # if username and password do not match user don't continue
-        if not does_username_and_password_match(user_model, username, password):
+        # if username and password do not match user don't continue, a token of the user stands in for the password
+        if claims is not None and claims["sub"] == user_id:
+            authorized = sp.encode_string(username) == user_model.username
+        else:
+            authorized = does_username_and_password_match(user_model, username, password)
+        if not authorized:
             return_dict.message = "Username and password do not match with existing user"
             return_dict.success = False
             return return_dict.to_dict()
+
+        # the new password is checked against the stored hash, the password of the request may be missing (token)
+        changes_username = new_username is not None and new_username != username
+        changes_password = new_password is not None and not auth.verify_password(new_password, user_model.password)[0]
+        # don't update user if there is nothing to change
+        if not changes_username and not changes_password:
+            return_dict.message = "There is nothing to change"
+            return_dict.success = False
+            return return_dict.to_dict()
         
         # don't allow to change both username and password at the same time
-        # used return because if / elif would change the first 
-        if new_username != username and new_password != password:
+        if changes_username and changes_password:
             return_dict.message = "Cannot update both username and password at the same time"
             return_dict.success = False
             return return_dict.to_dict()
         
         # change username or password to new username or new password
-        if new_username != username:
+        if changes_username:
             user_model.username = sp.encode_string(new_username)
-        elif new_password != password:
-            user_model.password = sp.encode_string(new_password)
-            
+        else:
+            user_model.password = auth.hash_password(new_password)
 
         # add User to database
         db.add(user_model)
         db.commit()
+        if changes_password:
+            # tokens issued with the old password stop working
+            auth.token_signer.revoke(user_id)
 
         return_dict.message = f"Updated user {username} successfully"
         return_dict.success = True
@@ -239,21 +355,419 @@ def update_user(user_id: str, username: str, password: str, new_username, new_pa
     finally:
         return return_dict.to_dict()
 
+@papertrading_app.post("/users_stocks/bulk")
+def bulk_add_users_stocks(user_id: str, records: List[dict] = Body(...)) -> dict:
+    """
+    Add many trades of a user in one request - e.g. importing a history or replaying a strategy.
+    The body is a list of stock records: {"timeframe", "ticker", "action", "amount", "price"}
+
+    :returns: success, inserted count, rejected records (row number -> reason), seconds and rows_per_second
+    """
+    try:
+        logger.info(f"Got bulk trades request of {len(records)} records for user {user_id}")
+        return db_m.bulk_add_stock_records_to_users_stocks_table(user_id, records)
+    except Exception as error:
+        logger.error(f"Failed bulk adding trades of user {user_id}: {error}")
+        return {"success": False, "inserted": 0, "rejected": {}, "seconds": 0.0, "rows_per_second": 0.0}
+
+@papertrading_app.get("/portfolio")
+def get_portfolio(user_id: str, include_closed: bool = False) -> dict:
+    """
+    Get what a user holds right now, from the materialized positions (never scans the trades)
+
+    :returns: user_id and positions - ticker, quantity, average_cost, realized_pnl and updated_at
+    """
+    try:
+        return {"user_id": user_id, "positions": db_m.get_positions_by_id(user_id, include_closed=include_closed)}
+    except Exception as error:
+        logger.error(f"Failed getting portfolio of user {user_id}: {error}")
+        return {"user_id": user_id, "positions": [], "error": True}
+
+@papertrading_app.get("/portfolio/valuation")
+async def get_portfolio_valuation(user_id: str, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None) -> dict:
+    """
+    Mark a user's portfolio to market: market value, unrealized P&L and weight of every position,
+    and an equity curve (market_value, cash_flow, pnl per bar) over the requested range
+
+    :returns: user_id, positions, totals, equity_curve (column oriented, timestamps in epoch seconds) and errors
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        valuation = await loop.run_in_executor(
+            StockPuller.executor, partial(valuation_script.get_portfolio_valuation, user_id, start=start, end=end, interval=interval)
+        )
+        return {
+            "user_id": user_id,
+            "positions": json.loads(valuation["positions"].to_json(orient="records")),
+            "totals": valuation["totals"],
+            "equity_curve": serialization.to_columns(valuation["equity_curve"].reset_index()),
+            "errors": valuation["errors"],
+        }
+    except Exception as error:
+        logger.error(f"Failed valuing portfolio of user {user_id}: {error}")
+        return {"user_id": user_id, "error": True}
+
+@papertrading_app.post("/backtest")
+async def run_backtest(tickers: List[str] = Query(...), strategy: str = "sma_crossover", params: dict = Body(default={}), start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, amount: float = 1.0, fee: float = 0.0, user_id: str = None) -> dict:
+    """
+    Replay a strategy over the cached bars of tickers. The body holds the strategy's parameters. E.g: {"fast": 10, "slow": 30}
+    If user_id is given, the resulting trades are written to the user's trades
+
+    :returns: metrics, trades (stock records) and the bulk insert result if the trades were written
+    """
+    tickers = [ticker.strip().upper() for item in tickers for ticker in item.split(",") if ticker.strip()]
+    if strategy not in backtest.STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"Unknown strategy {strategy}, one of {list(backtest.STRATEGIES)}")
+    try:
+        loop = asyncio.get_running_loop()
+        prices, errors = await loop.run_in_executor(
+            StockPuller.executor, partial(backtest.get_backtest_prices, tickers, start=start, end=end, interval=interval)
+        )
+        if prices.empty:
+            return {"metrics": {}, "trades": [], "errors": errors}
+        _, _, interval = StockPuller.get_default_range(start, end, interval)
+        result = await loop.run_in_executor(
+            StockPuller.executor, partial(backtest.run_backtest, prices, strategy, params, interval=interval, amount=amount, fee=fee)
+        )
+        response = {
+            "metrics": result["metrics"],
+            "trades": [trade.to_dict() for trade in result["trades"]],
+            "errors": errors,
+        }
+        if user_id is not None:
+            response["recorded"] = await loop.run_in_executor(
+                None, db_m.bulk_add_stock_records_to_users_stocks_table, user_id, result["trades"]
+            )
+        return response
+    except Exception as error:
+        logger.error(f"Failed running backtest of {strategy} on {tickers}: {error}")
+        return {"error": True}
+
+@papertrading_app.post("/backtest/sweep")
+async def run_backtest_sweep(tickers: List[str] = Query(...), strategy: str = "sma_crossover", param_grid: Dict[str, list] = Body(...), start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, amount: float = 1.0, fee: float = 0.0, top: int = 20) -> dict:
+    """
+    Run a strategy for every combination of parameters across a process pool.
+    The body maps parameter names to values to try. E.g: {"fast": [5, 10, 20], "slow": [30, 50, 100]}
+
+    :returns: The best parameter sets (by sharpe) with their metrics
+    """
+    tickers = [ticker.strip().upper() for item in tickers for ticker in item.split(",") if ticker.strip()]
+    if strategy not in backtest.STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"Unknown strategy {strategy}, one of {list(backtest.STRATEGIES)}")
+    try:
+        loop = asyncio.get_running_loop()
+        prices, errors = await loop.run_in_executor(
+            StockPuller.executor, partial(backtest.get_backtest_prices, tickers, start=start, end=end, interval=interval)
+        )
+        if prices.empty:
+            return {"results": [], "errors": errors}
+        _, _, interval = StockPuller.get_default_range(start, end, interval)
+        results = await loop.run_in_executor(
+            None, partial(backtest.sweep, prices, strategy, param_grid, interval=interval, amount=amount, fee=fee)
+        )
+        return {"combinations": len(results), "results": results.head(top).to_dict(orient="records"), "errors": errors}
+    except Exception as error:
+        logger.error(f"Failed running backtest sweep of {strategy} on {tickers}: {error}")
+        return {"error": True}
+
+@papertrading_app.on_event("startup")
+async def start_background_tasks() -> None:
+    # the tasks are kept on the app so they are not garbage collected
+    papertrading_app.state.background_tasks = [
+        # one worker matches orders and refreshes market data for all of them, another takes over when it stops
+        asyncio.create_task(shared_cache.run_exclusively(
+            "background_tasks", [orders_script.order_matcher.run_forever, refresher.market_data_refresher.run_forever]
+        )),
+        # every worker sends from the outbox, emails are claimed so each is sent once
+        asyncio.create_task(outbox.email_outbox.run_forever()),
+    ]
+
+@papertrading_app.on_event("shutdown")
+async def stop_background_tasks() -> None:
+    for task in getattr(papertrading_app.state, "background_tasks", []):
+        task.cancel()
+    backtest.shutdown_sweep_executor()
+
+@papertrading_app.post("/orders")
+def place_order(user_id: str, ticker: str, side: str, order_type: str = "market", amount: float = 1.0, limit_price: float = None, stop_price: float = None) -> dict:
+    """
+    Place an order. It rests on the ticker's book and is filled by the matching loop against the next completed bars.
+    Order types are market, limit, stop and stop_limit
+
+    :returns: The order - id, status, filled, average_fill_price, ...
+    """
+    try:
+        order = orders_script.Order.new(user_id, ticker, side, order_type, amount, limit_price=limit_price, stop_price=stop_price)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    if not orders_script.order_matcher.place(order):
+        return {"error": True}
+    return order.to_dict()
+
+@papertrading_app.get("/orders")
+def get_orders(user_id: str, status: str = None) -> dict:
+    """
+    Get a user's orders, newest first. status filters them - open (including partially filled), filled or cancelled
+
+    :returns: user_id and orders
+    """
+    return {"user_id": user_id, "orders": db_m.get_orders_by_id(user_id, status=status)}
+
+@papertrading_app.delete("/orders")
+def cancel_order(user_id: str, order_id: str) -> dict:
+    """
+    Cancel an open order, what was filled already stays filled
+
+    :returns: success
+    """
+    return {"success": orders_script.order_matcher.cancel(user_id, order_id)}
+
+@papertrading_app.post("/orders/match")
+async def match_orders() -> dict:
+    """
+    Run a matching round now instead of waiting for the matching loop
+
+    :returns: tickers matched, fills and errors (ticker -> error)
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(StockPuller.executor, orders_script.order_matcher.run_once)
+    except Exception as error:
+        logger.error(f"Failed matching orders: {error}")
+        return {"error": True}
+
 @papertrading_app.get("/stock_data")
-def get_stock_data(ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None) -> List[dict]:
+async def get_stock_data(request: Request, response: Response, ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, timeout: float = None, data_format: str = Query(None, alias="format"), max_points: int = Query(None, gt=0), downsample: str = "ohlc", indicators: str = None) -> List[dict] | dict:
+    """
+    Get data of a stock. The response format is picked with ?format= or the Accept header:
+    records (default, list of dicts), columns (one array per column), arrow (Arrow IPC stream) or parquet.
+    max_points bounds the number of bars returned, whatever the range - downsample picks how:
+    ohlc (default, merges bars keeping every high and low), lttb or minmax (keep the bars that shape the close).
+    indicators adds a column per indicator output, computed before downsampling. E.g: ?indicators=sma:50,rsi,macd:12:26:9
+    """
+    if downsample not in downsampling.DOWNSAMPLING_METHODS:
+        raise HTTPException(status_code=400, detail=f"Downsampling method must be one of {downsampling.DOWNSAMPLING_METHODS}")
     try:
-        # get stock data
+        requested_indicators = indicators_script.parse_indicators(indicators)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    try:
+        # get stock data without blocking the event loop, give up if the client leaves
         logger.info(f"Got stock data request for {ticker}, Start: {start}, End: {end}, interval: {interval}")
-        stock_data: DataFrame | None = StockPuller.get_stock(ticker=ticker, start=start, end=end, interval=interval)
+        stock_data: DataFrame | None = await sp.run_until_disconnected(
+            request, StockPuller.get_stock_async(ticker=ticker, start=start, end=end, interval=interval, timeout=get_request_timeout(timeout))
+        )
         logger.debug(f"Stock data request for {ticker} complete:\n{stock_data}")
+        if requested_indicators:
+            loop = asyncio.get_running_loop()
+            stock_data = await loop.run_in_executor(StockPuller.executor, partial(
+                indicators_script.add_indicators, stock_data, requested_indicators, ticker, StockPuller.get_default_range(start, end, interval)[2]
+            ))
+        stock_data = downsampling.downsample_frame(stock_data, max_points, method=downsample)
 
-        # output to json
+        # output in the format the client asked for, columnar formats skip building a dict per bar
+        response_format = serialization.negotiate_format(data_format, request.headers.get("accept"))
+        if response_format != serialization.DataFormats.records:
+            return serialization.dataframe_response(stock_data, response_format)
+
+        # output to json, indicators are NaN until their window is full and NaN is not valid json
+        if requested_indicators:
+            stock_data = stock_data.astype(object).where(stock_data.notna(), None)
         stock_data_json = stock_data.to_dict(orient="records")
         return stock_data_json
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out getting {ticker}, Start: {start}, End: {end}, interval: {interval}")
+        response.status_code = 504
+        return {"error": True}
+    except sp.ClientDisconnected:
+        logger.info(f"Client disconnected, cancelled stock data request for {ticker}")
+        response.status_code = 499
+        return {"error": True}
     except Exception as error:
         logger.error(f"Error getting for {ticker}, Start: {start}, End: {end}, interval: {interval}")
         return {"error": True}
 
+@papertrading_app.get("/stock_data/batch")
+async def get_stocks_data(request: Request, response: Response, tickers: List[str] = Query(...), start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, timeout: float = None, data_format: str = Query(None, alias="format")) -> dict:
+    """
+    Get data of many stocks with one range and interval in a single request.
+    Tickers can be repeated (?tickers=AAPL&tickers=AMZN) or comma separated (?tickers=AAPL,AMZN)
+    The format of each stock's data is picked like in /stock_data. Arrow and parquet responses hold one
+    table with a Ticker column, and the errors are sent json encoded in the X-Stock-Errors header
+
+    :returns: {"data": {ticker: records}, "errors": {ticker: error}}
+    """
+    # split comma separated tickers
+    tickers = [ticker.strip().upper() for item in tickers for ticker in item.split(",") if ticker.strip()]
+    try:
+        logger.info(f"Got stock data batch request for {len(tickers)} tickers, Start: {start}, End: {end}, interval: {interval}")
+        frames, errors = await sp.run_until_disconnected(
+            request, StockPuller.get_stocks_async(tickers=tickers, start=start, end=end, interval=interval, timeout=get_request_timeout(timeout))
+        )
+        logger.debug(f"Stock data batch request complete, {len(frames)} succeeded and {len(errors)} failed")
+
+        response_format = serialization.negotiate_format(data_format, request.headers.get("accept"))
+        if response_format == serialization.DataFormats.columns:
+            return {
+                "data": {ticker: serialization.to_columns(frame) for ticker, frame in frames.items()},
+                "errors": errors
+            }
+        if response_format in (serialization.DataFormats.arrow, serialization.DataFormats.parquet):
+            combined = pd.concat([frame.assign(Ticker=ticker) for ticker, frame in frames.items()], ignore_index=True) if frames else pd.DataFrame()
+            binary_response = serialization.dataframe_response(combined, response_format)
+            binary_response.headers["X-Stock-Errors"] = json.dumps(errors)
+            return binary_response
+
+        # output to json
+        return {
+            "data": {ticker: frame.to_dict(orient="records") for ticker, frame in frames.items()},
+            "errors": errors
+        }
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out getting batch for {tickers}, Start: {start}, End: {end}, interval: {interval}")
+        response.status_code = 504
+        return {"data": {}, "errors": {ticker: "Timed out" for ticker in tickers}}
+    except sp.ClientDisconnected:
+        logger.info(f"Client disconnected, cancelled stock data batch request for {tickers}")
+        response.status_code = 499
+        return {"data": {}, "errors": {}}
+    except Exception as error:
+        logger.error(f"Error getting batch for {tickers}, Start: {start}, End: {end}, interval: {interval}: {error}")
+        return {"data": {}, "errors": {ticker: "Internal Server Error" for ticker in tickers}}
+
+@papertrading_app.get("/stock_data/stream")
+async def stream_stock_data(request: Request, ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, chunk_bars: int = None, data_format: str = Query(None, alias="format")) -> StreamingResponse:
+    """
+    Stream data of a stock in time sliced chunks, so large ranges never sit in memory at once
+    and the client can start rendering on the first chunk.
+    ?format=ndjson (default) sends one column oriented json object per line, ?format=arrow sends
+    one Arrow IPC stream with a record batch per chunk
+    """
+    logger.info(f"Got stock data stream request for {ticker}, Start: {start}, End: {end}, interval: {interval}")
+    try:
+        stream_format = serialization.StreamFormats[(data_format or "ndjson").lower()]
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Unknown stream format {data_format}")
+    # checked before the response starts, the stream can not report an error once it did
+    start, end, interval = StockPuller.get_default_range(start, end, interval)
+    try:
+        StockPuller.validate_range(start, end, interval)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+    chunks = StockPuller.stream_stock_async(ticker=ticker, start=start, end=end, interval=interval, chunk_bars=chunk_bars)
+    if stream_format == serialization.StreamFormats.arrow:
+        content = serialization.arrow_stream(chunks)
+    else:
+        content = serialization.ndjson_stream(chunks)
+    # StreamingResponse stops pulling chunks once the client disconnects
+    return StreamingResponse(content, media_type=stream_format.value)
+
+@papertrading_app.get("/chart")
+async def get_chart(ticker: str = None, start: datetime.datetime = None, end: datetime.datetime = None, interval: str = None, plot_type: str = "Adj Close") -> Response:
+    """
+    Get a chart of a stock as SVG, rendered once per (ticker, range, interval, plot_type) and then served from memory.
+    plot_type is one of Open, High, Low, Close, Adj Close and Volume
+    """
+    if plot_type not in charts.PLOT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Plot type must be one of {charts.PLOT_TYPES}")
+    loop = asyncio.get_running_loop()
+    svg = await loop.run_in_executor(
+        StockPuller.executor, partial(charts.get_chart_svg, ticker=ticker, start=start, end=end, interval=interval, plot_type=plot_type)
+    )
+    if svg is None:
+        raise HTTPException(status_code=404, detail=f"No data to chart for {ticker}")
+    return Response(content=svg, media_type="image/svg+xml")
+
+@papertrading_app.get("/chart/metrics")
+def get_chart_metrics() -> dict:
+    """
+    :returns: Size, hits and misses of the rendered charts cache
+    """
+    return charts.chart_cache.get_metrics()
+
+@papertrading_app.get("/indicators/metrics")
+def get_indicators_metrics() -> dict:
+    """
+    :returns: Size, hits and misses of the cached indicator series
+    """
+    return indicators_script.indicator_cache.get_metrics()
+
+@papertrading_app.get("/stock_data/metrics")
+def get_stock_data_metrics() -> dict:
+    """
+    :returns: Coalescing metrics of stock data requests - how many requests shared an in flight fetch
+    """
+    return StockPuller.flights.get_metrics()
+
+@papertrading_app.get("/refresher/status")
+def get_refresher_status() -> dict:
+    """
+    Status of the background market data refresher - schedule of every interval, state of every refreshed ticker
+    (last success, last error, failures in a row, backoff) and the provider rate limiter
+    """
+    return refresher.market_data_refresher.get_status()
+
+@papertrading_app.websocket("/ws/stock_data")
+async def stock_data_websocket(websocket: WebSocket) -> None:
+    """
+    Push new bars of subscribed tickers. Clients send {"action": "subscribe" | "unsubscribe", "tickers": [...], "interval": "1m"}
+    and receive {"type": "bars", "ticker", "interval", "bars": column oriented bars (see serialization.to_columns)}.
+    A client that reads slower than bars arrive loses its oldest queued messages, it never slows down other clients
+    """
+    await websocket.accept()
+    feed = live.live_feed
+    client = live.ClientQueue()
+    feed.clients.add(client)
+    sender = asyncio.create_task(send_live_messages(websocket, client))
+    try:
+        while True:
+            try:
+                action, tickers, interval = live.parse_subscription(json.loads(await websocket.receive_text()))
+            except (ValueError, AttributeError) as error:
+                client.put(json.dumps({"type": "error", "error": f"Invalid message: {error}"}))
+                continue
+            client.put(json.dumps({"type": f"{action}d", "tickers": tickers, "interval": interval}))
+            for ticker in tickers:
+                if action == "subscribe":
+                    feed.subscribe(client, ticker, interval)
+                else:
+                    feed.unsubscribe(client, ticker, interval)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        feed.unsubscribe_all(client)
+        feed.clients.discard(client)
+
+async def send_live_messages(websocket: WebSocket, client: live.ClientQueue) -> None:
+    try:
+        while True:
+            await websocket.send_text(await client.get())
+    except asyncio.CancelledError:
+        raise
+    except Exception as error:
+        logger.debug(f"Stopped sending live updates to a client: {error}")
+
+@papertrading_app.get("/ws/metrics")
+def get_live_metrics() -> dict:
+    """
+    :returns: Metrics of the live feed - clients, subscriptions, pollers (one per ticker and interval), messages and dropped messages
+    """
+    return live.live_feed.get_metrics()
+
+def get_request_timeout(timeout: float | None) -> float:
+    """
+    Clamp a client requested timeout to the server's provider timeout
+
+    :param timeout: Seconds the client is willing to wait, None for the default
+    :returns: Seconds to wait for the provider
+    """
+    max_timeout = stock_script.Constants.provider_timeout.value
+    if timeout is None or timeout <= 0:
+        return max_timeout
+    return min(timeout, max_timeout)
+
 @papertrading_app.post("/check")
 def send_stock_update(data: dict):
     try:
@@ -265,8 +779,30 @@ def send_stock_update(data: dict):
         print(error)
         return "bad"
 
-def run_app() -> None:
-    uvicorn.run(papertrading_app,host=HOST_IP, port=HOST_PORT)
+def run_app(workers: int = None, reload: bool = False) -> None:
+    """
+    Serve the app on worker processes sharing the port. The bar cache is in the database and the chart and indicator
+    caches are shared on disk (utils/shared_cache.py), so every worker serves what one of them fetched.
+    SIGHUP replaces the workers one by one without dropping requests (graceful reload), SIGTTIN and SIGTTOU
+    add and remove a worker
+
+    :param workers: Worker processes, defaults to SERVER_WORKERS or one per CPU
+    :param reload: Run one worker that restarts when the code changes (development)
+    """
+    workers = 1 if reload else workers or sp.Constants.SERVER_WORKERS.value or os.cpu_count() or 1
+    if workers > 1 and not auth.Constants.TOKEN_SECRET.value:
+        # the workers inherit the environment, so they sign and verify tokens with one key
+        logger.warning("TOKEN_SECRET is not set, tokens are signed with a random key and will not survive a restart")
+        os.environ["TOKEN_SECRET"] = secrets.token_hex(32)
+    logger.info(f"Serving on {HOST_IP}:{HOST_PORT} with {workers} workers")
+    uvicorn.run(
+        "server:papertrading_app", host=HOST_IP, port=HOST_PORT, workers=workers, reload=reload,
+        timeout_graceful_shutdown=sp.Constants.SERVER_GRACEFUL_SHUTDOWN_SECONDS.value,
+    )
 
 if __name__ == "__main__":
-    run_app()
+    parser = argparse.ArgumentParser(description="Run the papertrading server")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to SERVER_WORKERS or one per CPU")
+    parser.add_argument("--reload", action="store_true", help="Run one worker that restarts when the code changes")
+    args = parser.parse_args()
+    run_app(workers=args.workers, reload=args.reload)
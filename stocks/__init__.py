@@ -1,2 +1,2 @@
-__all__ = ["stock_script"]
+__all__ = ["stock_script", "providers", "bar_store", "serialization", "valuation", "backtest", "orders", "refresher", "live", "charts", "downsampling", "indicators"]
 from . import *
\ No newline at end of file
@@ -0,0 +1,270 @@
+import itertools
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Tuple, Union
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from data.stock_record import StockRecord
+from stocks.bar_store import interval_to_seconds
+from stocks.stock_script import StockPuller
+from stocks.valuation import close_prices
+from utils.logger_script import logger
+
+
+# Bars per year of an interval are needed to annualize the sharpe ratio, trading days * bars per day
+TRADING_DAYS_PER_YEAR = 252
+
+def rolling_mean(prices: np.ndarray, window: int) -> np.ndarray:
+    """
+    Rolling mean over the rows of a (bars x tickers) array, NaN until the window holds only real prices
+    (e.g. the leading NaNs of a ticker whose history starts later)
+
+    :param prices: Array of prices, a column per ticker
+    :param window: Bars in the window
+    :returns: Array of the same shape
+    """
+    window = max(int(window), 1)
+    result = np.full(prices.shape, np.nan)
+    if window > len(prices):
+        return result
+    is_valid = ~np.isnan(prices)
+    # sums and counts of the valid prices, so a NaN neither adds a 0 to a window nor counts towards it
+    cumulative = np.cumsum(np.where(is_valid, prices, 0.0), axis=0)
+    counts = np.cumsum(is_valid, axis=0)
+    sums = cumulative[window - 1:].copy()
+    valid = counts[window - 1:].copy()
+    sums[1:] -= cumulative[:-window]
+    valid[1:] -= counts[:-window]
+    result[window - 1:] = np.where(valid == window, sums / window, np.nan)
+    return result
+
+def sma_crossover(prices: np.ndarray, fast: int = 10, slow: int = 30) -> np.ndarray:
+    """
+    Long while the fast moving average is above the slow one, flat otherwise
+
+    :returns: Array of target positions (0 or 1), a column per ticker
+    """
+    if fast >= slow:
+        return np.zeros(prices.shape)
+    fast_mean = rolling_mean(prices, fast)
+    slow_mean = rolling_mean(prices, slow)
+    return np.where(fast_mean > slow_mean, 1.0, 0.0)
+
+def momentum(prices: np.ndarray, lookback: int = 20, threshold: float = 0.0) -> np.ndarray:
+    """
+    Long while the return over the lookback is above the threshold, short while it is below minus the threshold
+
+    :returns: Array of target positions (-1, 0 or 1), a column per ticker
+    """
+    lookback = max(int(lookback), 1)
+    returns = np.full(prices.shape, np.nan)
+    returns[lookback:] = prices[lookback:] / prices[:-lookback] - 1
+    return np.where(returns > threshold, 1.0, np.where(returns < -threshold, -1.0, 0.0))
+
+def mean_reversion(prices: np.ndarray, window: int = 20, width: float = 2.0) -> np.ndarray:
+    """
+    Long below the lower bollinger band, short above the upper one, flat once the price crosses the mean.
+    Vectorized by forward filling the entry and exit signals
+
+    :returns: Array of target positions (-1, 0 or 1), a column per ticker
+    """
+    mean = rolling_mean(prices, window)
+    deviation = np.sqrt(np.maximum(rolling_mean(prices ** 2, window) - mean ** 2, 0.0))
+    signals = np.full(prices.shape, np.nan)
+    signals[prices < mean - width * deviation] = 1.0
+    signals[prices > mean + width * deviation] = -1.0
+    crossed_mean = np.zeros(prices.shape, dtype=bool)
+    crossed_mean[1:] = np.sign(prices[1:] - mean[1:]) != np.sign(prices[:-1] - mean[:-1])
+    signals[crossed_mean & np.isnan(signals)] = 0.0
+    return pd.DataFrame(signals).ffill().fillna(0.0).to_numpy()
+
+# Strategy name -> function of (prices, **params) -> target positions
+STRATEGIES: Dict[str, Callable[..., np.ndarray]] = {
+    "sma_crossover": sma_crossover,
+    "momentum": momentum,
+    "mean_reversion": mean_reversion,
+}
+
+def bars_per_year(interval: str) -> float:
+    """
+    :param interval: Interval (yFinance Interval). E.g: 30m, 1d
+    :returns: Number of bars of the interval in a trading year (6.5 hour trading days)
+    """
+    seconds = interval_to_seconds(interval)
+    if seconds < 24 * 60 * 60:
+        return TRADING_DAYS_PER_YEAR * 6.5 * 60 * 60 / seconds
+    return TRADING_DAYS_PER_YEAR * 24 * 60 * 60 / seconds
+
+def simulate(prices: np.ndarray, targets: np.ndarray, amount: float = 1.0, fee: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Simulate holding the target positions. A target decided on a bar's close is filled on the next bar's close,
+    so signals never use prices they could not have seen
+
+    :param prices: Array of prices (bars x tickers)
+    :param targets: Array of target positions in units of amount (bars x tickers)
+    :param amount: Stocks held per unit of target position
+    :param fee: Fee per traded stock
+    :returns: Held positions (bars x tickers) and P&L per bar (bars)
+    """
+    held = np.zeros(targets.shape)
+    held[1:] = targets[:-1] * amount
+    price_changes = np.zeros(prices.shape)
+    price_changes[1:] = np.nan_to_num(prices[1:] - prices[:-1])
+    traded = np.abs(np.diff(held, axis=0, prepend=0.0))
+    pnl = (np.roll(held, 1, axis=0) * price_changes)
+    pnl[0] = 0.0
+    return held, pnl.sum(axis=1) - (traded * fee).sum(axis=1)
+
+def metrics(pnl: np.ndarray, held: np.ndarray, periods_per_year: float) -> dict:
+    """
+    :param pnl: P&L per bar
+    :param held: Held positions (bars x tickers)
+    :param periods_per_year: Bars per year, to annualize the sharpe ratio
+    :returns: Dict of total_pnl, sharpe, max_drawdown and trades
+    """
+    equity = np.cumsum(pnl)
+    drawdown = np.maximum.accumulate(np.concatenate([[0.0], equity]))[1:] - equity
+    deviation = pnl.std()
+    return {
+        "total_pnl": float(equity[-1]) if len(equity) else 0.0,
+        "sharpe": float(pnl.mean() / deviation * np.sqrt(periods_per_year)) if deviation > 0 else 0.0,
+        "max_drawdown": float(drawdown.max()) if len(drawdown) else 0.0,
+        "trades": int(np.count_nonzero(np.diff(held, axis=0, prepend=0.0))),
+    }
+
+def trades_from_positions(held: np.ndarray, prices: pd.DataFrame) -> List[StockRecord]:
+    """
+    Turn changes of held positions into trades
+
+    :param held: Held positions (bars x tickers)
+    :param prices: Prices dataframe from close_prices (indexed by epoch seconds, a column per ticker)
+    :returns: List of stock records, one per position change, ordered by time
+    """
+    changes = np.diff(held, axis=0, prepend=0.0)
+    bars, columns = np.nonzero(changes)
+    timestamps = prices.index.to_numpy()[bars]
+    fill_prices = prices.to_numpy()[bars, columns]
+    tickers = np.asarray(prices.columns)[columns]
+    return [
+        StockRecord(
+            timeframe=datetime.fromtimestamp(int(timestamp), tz=timezone.utc),
+            action="buy" if change > 0 else "sell",
+            amount=float(abs(change)),
+            price=float(price),
+            ticker=str(ticker),
+        )
+        for timestamp, change, price, ticker in zip(timestamps, changes[bars, columns], fill_prices, tickers)
+    ]
+
+def run_backtest(prices: pd.DataFrame, strategy: str, params: dict = None, interval: str = "30m", amount: float = 1.0, fee: float = 0.0) -> dict:
+    """
+    Run a strategy over the prices of many tickers at once
+
+    :param prices: Prices dataframe from close_prices (indexed by epoch seconds, a column per ticker)
+    :param strategy: Name of a strategy in STRATEGIES
+    :param params: Parameters of the strategy
+    :param interval: Interval of the bars (used to annualize the sharpe ratio)
+    :param amount: Stocks traded per unit of target position
+    :param fee: Fee per traded stock
+    :returns: Dict of metrics, trades (list of stock records) and equity (series of cumulative P&L)
+    """
+    params = params or {}
+    values = prices.to_numpy(dtype=float)
+    targets = STRATEGIES[strategy](values, **params)
+    held, pnl = simulate(values, targets, amount=amount, fee=fee)
+    return {
+        "metrics": metrics(pnl, held, bars_per_year(interval)),
+        "trades": trades_from_positions(held, prices),
+        "equity": pd.Series(np.cumsum(pnl), index=prices.index, name="equity"),
+    }
+
+def get_backtest_prices(tickers: List[str], start: datetime = None, end: datetime = None, interval: str = None, price_column: str = "Adj Close") -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """
+    Get aligned prices of tickers for a backtest through the bar cache (one batched lookup)
+
+    :returns: Prices dataframe (indexed by epoch seconds, a column per ticker), dict of ticker -> error
+    """
+    frames, errors = StockPuller.get_stocks(tickers=tickers, start=start, end=end, interval=interval)
+    return close_prices(frames, price_column=price_column), errors
+
+
+# Worker processes of the sweeps' pool, e.g: SWEEP_MAX_WORKERS=4 to leave cores to the server's workers
+SWEEP_MAX_WORKERS = int(os.getenv("SWEEP_MAX_WORKERS", "0")) or os.cpu_count() or 1
+
+# One process pool shared by every sweep of the process, created on the first sweep that needs it
+sweep_executor: Union[ProcessPoolExecutor, None] = None
+sweep_executor_lock = threading.Lock()
+
+def get_sweep_executor() -> ProcessPoolExecutor:
+    """
+    :returns: The process' sweep pool (SWEEP_MAX_WORKERS processes), created on first use
+    """
+    global sweep_executor
+    with sweep_executor_lock:
+        if sweep_executor is None:
+            sweep_executor = ProcessPoolExecutor(max_workers=SWEEP_MAX_WORKERS)
+        return sweep_executor
+
+def shutdown_sweep_executor() -> None:
+    global sweep_executor
+    with sweep_executor_lock:
+        executor, sweep_executor = sweep_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def run_sweep_chunk(prices: np.ndarray, strategy: str, params_chunk: List[dict], periods_per_year: float, amount: float, fee: float) -> List[dict]:
+    """
+    Run a chunk of parameter sets on a worker process
+
+    :returns: List of metrics dicts, one per parameter set (with the parameters)
+    """
+    results = []
+    for params in params_chunk:
+        targets = STRATEGIES[strategy](prices, **params)
+        held, pnl = simulate(prices, targets, amount=amount, fee=fee)
+        results.append({**params, **metrics(pnl, held, periods_per_year)})
+    return results
+
+def sweep(prices: pd.DataFrame, strategy: str, param_grid: Dict[str, list], interval: str = "30m", amount: float = 1.0, fee: float = 0.0, max_workers: int = None) -> pd.DataFrame:
+    """
+    Run a strategy for every combination of parameters, fanned out across the process' sweep pool
+
+    :param prices: Prices dataframe from close_prices (indexed by epoch seconds, a column per ticker)
+    :param strategy: Name of a strategy in STRATEGIES
+    :param param_grid: Parameter name -> list of values to try. E.g: {"fast": [5, 10], "slow": [20, 50]}
+    :param max_workers: Worker processes to spread the parameter sets over (the pool has SWEEP_MAX_WORKERS), defaults to SWEEP_MAX_WORKERS. 1 runs in this process
+    :returns: Dataframe of parameters and metrics, a row per parameter set, best sharpe first
+    """
+    names = list(param_grid)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*param_grid.values())]
+    if not combinations:
+        return pd.DataFrame()
+    max_workers = max_workers or SWEEP_MAX_WORKERS
+    values = prices.to_numpy(dtype=float)
+    periods_per_year = bars_per_year(interval)
+
+    # a few chunks per worker keeps them busy without sending every parameter set (and the prices) separately
+    chunk_size = max(1, len(combinations) // (max_workers * 4))
+    chunks = [combinations[index:index + chunk_size] for index in range(0, len(combinations), chunk_size)]
+    logger.info(f"Sweeping {len(combinations)} parameter sets of {strategy} on {max_workers} processes")
+
+    results: List[dict] = []
+    if max_workers == 1:
+        for chunk in chunks:
+            results.extend(run_sweep_chunk(values, strategy, chunk, periods_per_year, amount, fee))
+    else:
+        executor = get_sweep_executor()
+        try:
+            futures = [executor.submit(run_sweep_chunk, values, strategy, chunk, periods_per_year, amount, fee) for chunk in chunks]
+            for future in futures:
+                results.extend(future.result())
+        except BrokenProcessPool:
+            # a worker process died, the next sweep starts a new pool
+            shutdown_sweep_executor()
+            raise
+    return pd.DataFrame(results).sort_values("sharpe", ascending=False, ignore_index=True)
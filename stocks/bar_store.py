@@ -0,0 +1,362 @@
+from contextlib import ExitStack
+from typing import Dict, List, Tuple, Union
+from datetime import datetime
+import time
+
+import pandas as pd
+from sqlalchemy import select, and_
+from sqlalchemy.engine import Engine
+
+from data.database import db_engine_stocksbase, get_upsert_insert
+from data.database_models import (stock_bars_table, stock_bars_coverage_table,
+                                  generate_stock_table_for_stocksbase_by_ticker)
+from stocks.providers import StockProvider, OHLCV_COLUMNS, to_utc_timestamp
+from utils.logger_script import logger
+from utils.shared_cache import ProcessLock, get_process_lock
+
+
+# Database column name -> dataframe column name
+BAR_COLUMNS = {
+    "open": "Open",
+    "high": "High",
+    "low": "Low",
+    "close": "Close",
+    "adj_close": "Adj Close",
+    "volume": "Volume",
+}
+
+# yFinance interval suffix -> length of the suffix unit in seconds
+INTERVAL_UNITS = {
+    "m": 60,
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+    "wk": 7 * 24 * 60 * 60,
+    "mo": 30 * 24 * 60 * 60,
+}
+
+def interval_to_seconds(interval: str) -> int:
+    """
+    Convert a yFinance interval to its length in seconds
+
+    :param interval: Interval (yFinance Interval). E.g: 1d, 30m, 1wk
+    :returns: Length of the interval in seconds
+    """
+    for suffix in sorted(INTERVAL_UNITS, key=len, reverse=True):
+        if interval.endswith(suffix) and interval[:-len(suffix)].isdigit():
+            return int(interval[:-len(suffix)]) * INTERVAL_UNITS[suffix]
+    raise ValueError(f"Unsupported interval: {interval}")
+
+def is_intraday_interval(interval: str) -> bool:
+    """
+    :param interval: Interval (yFinance Interval)
+    :returns: True if bars of the interval are shorter than a day
+    """
+    return interval_to_seconds(interval) < INTERVAL_UNITS["d"]
+
+def to_epoch_seconds(moment: Union[datetime, pd.Timestamp]) -> int:
+    """
+    :param moment: Datetime (naive datetimes are treated as local time, like yfinance does)
+    :returns: Epoch seconds (UTC)
+    """
+    return int(to_utc_timestamp(moment).timestamp())
+
+def from_epoch_seconds(seconds: int) -> datetime:
+    """
+    :param seconds: Epoch seconds (UTC)
+    :returns: Tz aware (UTC) datetime
+    """
+    return pd.Timestamp(seconds, unit="s", tz="UTC").to_pydatetime()
+
+def get_bars_lock(ticker: str, interval: str) -> ProcessLock:
+    """
+    :returns: Lock of the cached bars and coverage of a ticker and interval, shared by the server's worker processes
+    """
+    return get_process_lock(f"bars:{ticker}:{interval}")
+
+
+class BarStore:
+    """
+    Persistent OHLCV bar cache stored in the stocksbase database.
+
+    Bars are keyed by ticker and interval. For every ticker and interval the store
+    remembers which time range was already downloaded, so a request only downloads
+    the missing gaps at the edges of that range and reads everything else locally.
+    """
+    # Upper limit of tickers in a single provider call
+    max_tickers_per_download: int = 50
+
+    def __init__(self, provider: StockProvider, engine: Engine = db_engine_stocksbase):
+        self.provider: StockProvider = provider
+        self.engine: Engine = engine
+
+    def get_bars(self, ticker: str, start: datetime, end: datetime, interval: str) -> pd.DataFrame:
+        """
+        Get bars of a stock, downloading only what is missing from the cache
+
+        :param ticker: Stock ticker. E.g: AMZN, AAPL
+        :param start: Datetime of start (inclusive)
+        :param end: Datetime of end (exclusive)
+        :param interval: Interval (yFinance Interval). E.g: 1d, 30m
+        :returns: Dataframe of bars indexed by datetime
+        """
+        frames, errors = self.get_bars_many([ticker], start, end, interval)
+        if ticker in errors:
+            raise ValueError(errors[ticker])
+        return frames[ticker]
+
+    def get_bars_many(self, tickers: List[str], start: datetime, end: datetime, interval: str) -> Tuple[Dict[str, pd.DataFrame], Dict[str, str]]:
+        """
+        Get bars of many stocks with one range and interval.
+        Tickers that miss the same range are downloaded together in one provider call.
+
+        :param tickers: List of stock tickers. E.g: [AMZN, AAPL]
+        :param start: Datetime of start (inclusive)
+        :param end: Datetime of end (exclusive)
+        :param interval: Interval (yFinance Interval). E.g: 1d, 30m
+        :returns: Dict of ticker -> dataframe of bars, dict of ticker -> error for tickers that failed
+        """
+        frames: Dict[str, pd.DataFrame] = {}
+        errors: Dict[str, str] = {}
+        start_ts = to_epoch_seconds(start)
+        end_ts = max(to_epoch_seconds(end), start_ts)
+
+        valid: List[str] = []
+        for ticker in dict.fromkeys(tickers):
+            if not generate_stock_table_for_stocksbase_by_ticker(ticker, self.engine):
+                errors[ticker] = f"Invalid ticker: {ticker}"
+            else:
+                valid.append(ticker)
+
+        missing = [ticker for ticker in valid if end_ts > start_ts and self.is_missing(ticker, interval, start_ts, end_ts)]
+        if missing:
+            # one process downloads a ticker's missing range at a time, the others wait and find it covered
+            with ExitStack() as stack:
+                for ticker in sorted(missing):
+                    stack.enter_context(get_bars_lock(ticker, interval))
+                self.download_missing(missing, start_ts, end_ts, interval, errors)
+
+        for ticker in valid:
+            if ticker in errors:
+                continue
+            try:
+                frames[ticker] = self.read_bars(ticker, interval, start_ts, end_ts)
+            except Exception as error:
+                logger.error(f"Failed reading bars of {ticker} ({interval}): {error}")
+                errors[ticker] = f"Failed reading data: {error}"
+        return frames, errors
+
+    def is_missing(self, ticker: str, interval: str, start_ts: int, end_ts: int) -> bool:
+        """
+        :returns: Whether bars of [start_ts, end_ts) have to be downloaded or the coverage changes
+        """
+        coverage = self.get_coverage(ticker, interval)
+        gaps, new_coverage = self.find_gaps(coverage, start_ts, end_ts, interval)
+        return bool(gaps) or (new_coverage is not None and new_coverage != coverage)
+
+    def download_missing(self, tickers: List[str], start_ts: int, end_ts: int, interval: str, errors: Dict[str, str]) -> None:
+        """
+        Download the missing ranges of tickers and store them with their new coverage.
+        Tickers that miss the same ranges are downloaded together in one provider call
+
+        :param errors: Dict of ticker -> error, the tickers that failed are added to it
+        """
+        # Find the missing ranges of every ticker and group tickers that miss the same ranges
+        groups: Dict[Tuple[Tuple[int, int], ...], List[str]] = {}
+        new_coverages: Dict[str, Tuple[int, int]] = {}
+        for ticker in tickers:
+            coverage = self.get_coverage(ticker, interval)
+            gaps, new_coverage = self.find_gaps(coverage, start_ts, end_ts, interval)
+            if new_coverage is not None and new_coverage != coverage:
+                new_coverages[ticker] = new_coverage
+            if gaps:
+                groups.setdefault(tuple(gaps), []).append(ticker)
+
+        for gaps, group in groups.items():
+            for chunk_start in range(0, len(group), self.max_tickers_per_download):
+                chunk = group[chunk_start:chunk_start + self.max_tickers_per_download]
+                for gap_start, gap_end in gaps:
+                    logger.debug(f"Cache miss for {chunk} ({interval}) between {gap_start} and {gap_end}, downloading")
+                    try:
+                        downloaded: Dict[str, pd.DataFrame] = self.provider.download(
+                            chunk, from_epoch_seconds(gap_start), from_epoch_seconds(gap_end), interval
+                        )
+                    except Exception as error:
+                        logger.error(f"Failed downloading {chunk} ({interval}): {error}")
+                        for ticker in chunk:
+                            errors[ticker] = f"Failed downloading data: {error}"
+                        continue
+                    for ticker in chunk:
+                        if ticker not in downloaded:
+                            errors[ticker] = f"No data found for {ticker}"
+                            continue
+                        try:
+                            self.store_bars(ticker, interval, downloaded[ticker])
+                        except Exception as error:
+                            logger.error(f"Failed storing bars of {ticker} ({interval}): {error}")
+                            errors[ticker] = f"Failed storing data: {error}"
+
+        for ticker, new_coverage in new_coverages.items():
+            if ticker in errors:
+                continue
+            try:
+                self.set_coverage(ticker, interval, new_coverage)
+            except Exception as error:
+                logger.error(f"Failed storing coverage of {ticker} ({interval}): {error}")
+                errors[ticker] = f"Failed storing data: {error}"
+
+    def get_coverages(self, tickers: List[str], interval: str) -> Dict[str, Tuple[int, int]]:
+        """
+        :returns: Dict of ticker -> covered [start, end) range, tickers without cached bars are left out
+        """
+        stmt = select(stock_bars_coverage_table.c.ticker, stock_bars_coverage_table.c.start, stock_bars_coverage_table.c.end).where(
+            and_(stock_bars_coverage_table.c.interval == interval, stock_bars_coverage_table.c.ticker.in_(list(tickers)))
+        )
+        with self.engine.connect() as connection:
+            return {row.ticker: (row.start, row.end) for row in connection.execute(stmt)}
+
+    def update_bars(self, tickers: List[str], interval: str, start_ts: int, end_ts: int) -> Tuple[Dict[str, int], Dict[str, str]]:
+        """
+        Download [start_ts, end_ts) of many tickers in one provider call, store the bars and extend their coverage.
+        Used to keep cached tickers up to date without waiting for a request to miss the cache,
+        the tickers' bar tables must exist (see generate_stock_table_for_stocksbase_by_ticker)
+
+        :returns: Dict of ticker -> number of bars stored, dict of ticker -> error for tickers that failed
+        """
+        stored: Dict[str, int] = {}
+        errors: Dict[str, str] = {}
+        try:
+            downloaded: Dict[str, pd.DataFrame] = self.provider.download(
+                list(tickers), from_epoch_seconds(start_ts), from_epoch_seconds(end_ts), interval
+            )
+        except Exception as error:
+            logger.error(f"Failed updating {tickers} ({interval}): {error}")
+            return stored, {ticker: f"Failed downloading data: {error}" for ticker in tickers}
+
+        for ticker in tickers:
+            if ticker not in downloaded:
+                errors[ticker] = f"No data found for {ticker}"
+                continue
+            try:
+                with get_bars_lock(ticker, interval):
+                    stored[ticker] = self.store_bars(ticker, interval, downloaded[ticker])
+                    _, new_coverage = self.find_gaps(self.get_coverage(ticker, interval), start_ts, end_ts, interval)
+                    if new_coverage is not None:
+                        self.set_coverage(ticker, interval, new_coverage)
+            except Exception as error:
+                logger.error(f"Failed storing bars of {ticker} ({interval}): {error}")
+                errors[ticker] = f"Failed storing data: {error}"
+        return stored, errors
+
+    @staticmethod
+    def find_gaps(coverage: Union[Tuple[int, int], None], start_ts: int, end_ts: int, interval: str) -> Tuple[List[Tuple[int, int]], Union[Tuple[int, int], None]]:
+        """
+        Find the time ranges of a request that are not covered by the cache
+
+        :param coverage: Covered [start, end) range or None if nothing is cached
+        :param start_ts: Requested start in epoch seconds
+        :param end_ts: Requested end in epoch seconds
+        :param interval: Interval (yFinance Interval)
+        :returns: List of [start, end) gaps to download and the coverage after downloading them
+        """
+        # The latest bar may still be forming, so it is never marked as covered
+        covered_end_limit = min(end_ts, int(time.time()) - interval_to_seconds(interval))
+
+        if coverage is None or start_ts > coverage[1] or end_ts < coverage[0]:
+            # Nothing cached or the request does not touch the cached range
+            new_coverage = (start_ts, covered_end_limit) if covered_end_limit > start_ts else None
+            return [(start_ts, end_ts)], new_coverage
+
+        covered_start, covered_end = coverage
+        gaps: List[Tuple[int, int]] = []
+        if start_ts < covered_start:
+            gaps.append((start_ts, covered_start))
+        if end_ts > covered_end:
+            gaps.append((covered_end, end_ts))
+        new_coverage = (min(start_ts, covered_start), max(covered_end, covered_end_limit))
+        return gaps, new_coverage
+
+    def get_coverage(self, ticker: str, interval: str) -> Union[Tuple[int, int], None]:
+        """
+        :returns: Covered [start, end) range of ticker and interval, None if nothing is cached
+        """
+        stmt = select(stock_bars_coverage_table.c.start, stock_bars_coverage_table.c.end).where(
+            and_(stock_bars_coverage_table.c.ticker == ticker, stock_bars_coverage_table.c.interval == interval)
+        )
+        with self.engine.connect() as connection:
+            row = connection.execute(stmt).first()
+        if row is None:
+            return None
+        return (row.start, row.end)
+
+    def set_coverage(self, ticker: str, interval: str, coverage: Tuple[int, int]) -> None:
+        stmt = get_upsert_insert(self.engine)(stock_bars_coverage_table).values(
+            ticker=ticker, interval=interval, start=coverage[0], end=coverage[1]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["ticker", "interval"],
+            set_={"start": stmt.excluded.start, "end": stmt.excluded.end}
+        )
+        with self.engine.begin() as connection:
+            connection.execute(stmt)
+
+    def store_bars(self, ticker: str, interval: str, bars: Union[pd.DataFrame, None]) -> int:
+        """
+        Insert (or replace) bars of a ticker in the cache
+
+        :param ticker: Stock ticker
+        :param interval: Interval (yFinance Interval)
+        :param bars: Dataframe indexed by datetime with OHLCV_COLUMNS columns
+        :returns: Number of bars stored
+        """
+        if bars is None or bars.empty:
+            return 0
+        index = pd.DatetimeIndex(bars.index)
+        if index.tz is None:
+            index = index.tz_localize("UTC")
+        timestamps = (index.tz_convert("UTC").as_unit("s").asi8).tolist()
+
+        frame = bars.reindex(columns=OHLCV_COLUMNS).astype(float)
+        frame.columns = list(BAR_COLUMNS.keys())
+        frame = frame.astype(object).where(frame.notna(), None)
+        rows = frame.to_dict(orient="records")
+        for row, timestamp in zip(rows, timestamps):
+            row["ticker"] = ticker
+            row["interval"] = interval
+            row["timestamp"] = timestamp
+
+        stmt = get_upsert_insert(self.engine)(stock_bars_table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["ticker", "interval", "timestamp"],
+            set_={column: stmt.excluded[column] for column in BAR_COLUMNS}
+        )
+        with self.engine.begin() as connection:
+            connection.execute(stmt, rows)
+        logger.debug(f"Stored {len(rows)} {interval} bars of {ticker}")
+        return len(rows)
+
+    def read_bars(self, ticker: str, interval: str, start_ts: int, end_ts: int) -> pd.DataFrame:
+        """
+        Read cached bars of a ticker in [start_ts, end_ts)
+
+        :returns: Dataframe of bars indexed by datetime (named Datetime for intraday intervals, otherwise Date)
+        """
+        stmt = select(
+            stock_bars_table.c.timestamp, *[stock_bars_table.c[column] for column in BAR_COLUMNS]
+        ).where(
+            and_(
+                stock_bars_table.c.ticker == ticker,
+                stock_bars_table.c.interval == interval,
+                stock_bars_table.c.timestamp >= start_ts,
+                stock_bars_table.c.timestamp < end_ts,
+            )
+        ).order_by(stock_bars_table.c.timestamp)
+        with self.engine.connect() as connection:
+            rows = connection.execute(stmt).all()
+
+        frame = pd.DataFrame(rows, columns=["timestamp", *BAR_COLUMNS.keys()])
+        index = pd.to_datetime(frame["timestamp"].astype("int64"), unit="s", utc=True)
+        if not is_intraday_interval(interval):
+            index = index.dt.tz_localize(None)
+        frame = frame.drop(columns="timestamp").rename(columns=BAR_COLUMNS).astype(float)
+        frame.index = pd.DatetimeIndex(index, name="Datetime" if is_intraday_interval(interval) else "Date")
+        return frame
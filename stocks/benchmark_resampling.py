@@ -0,0 +1,84 @@
+# Measure serving coarse bars by resampling cached fine bars against downloading them
+# Usage: python -m stocks.benchmark_resampling [--days DAYS] [--latency SECONDS] [--interval INTERVAL] [--source INTERVAL]
+import argparse
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from stocks.bar_store import BarStore
+from stocks.providers import StaticProvider
+from stocks.stock_script import StockPuller, resample_ohlcv
+from utils.logger_script import logger
+
+
+class SlowProvider(StaticProvider):
+    """
+    Offline provider serving any interval of 1m session bars (9:30 to 16:00 New York time),
+    waiting latency seconds per call like a network download
+    """
+    def __init__(self, frames: Dict[str, pd.DataFrame], latency: float):
+        super().__init__(frames)
+        self.latency: float = latency
+
+    def download(self, tickers: List[str], start: datetime, end: datetime, interval: str) -> Dict[str, pd.DataFrame]:
+        time.sleep(self.latency)
+        frames = super().download(tickers, start, end, interval)
+        return {ticker: resample_ohlcv(frame, interval) for ticker, frame in frames.items()}
+
+def make_session_bars(days: int) -> pd.DataFrame:
+    sessions = pd.bdate_range(end=pd.Timestamp.now(tz="America/New_York").normalize() - pd.Timedelta(days=1), periods=days)
+    index = pd.DatetimeIndex(np.concatenate([
+        pd.date_range(session + pd.Timedelta(hours=9, minutes=30), periods=390, freq="1min").tz_convert("UTC").to_numpy()
+        for session in sessions
+    ]), tz="UTC", name="Datetime")
+    close = 100 * np.exp(np.cumsum(np.random.default_rng(0).normal(0, 0.0005, len(index))))
+    return pd.DataFrame({
+        "Open": np.roll(close, 1), "High": close * 1.001, "Low": close * 0.999,
+        "Close": close, "Adj Close": close, "Volume": np.full(len(index), 1000.0),
+    }, index=index)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare downloading coarse bars with resampling cached finer bars")
+    parser.add_argument("--days", type=int, default=20, help="Trading days of bars")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds every simulated download takes")
+    parser.add_argument("--interval", default="1h", help="Coarse interval to request")
+    parser.add_argument("--source", default="5m", help="Finer interval requested (and cached) first")
+    args = parser.parse_args()
+
+    bars = make_session_bars(args.days)
+    start = bars.index[0].to_pydatetime()
+    end = (bars.index[-1] + pd.Timedelta(minutes=1)).to_pydatetime()
+
+    def make_store() -> BarStore:
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        return BarStore(SlowProvider({"BENCH": bars}, args.latency), engine)
+
+    # coarse bars that are not cached at all are downloaded
+    StockPuller.bar_store = make_store()
+    started = time.perf_counter()
+    downloaded = StockPuller.fetch_stock("BENCH", start, end, args.interval)
+    download_seconds = time.perf_counter() - started
+
+    # after the finer bars of the range were requested, coarse bars are resampled from them
+    StockPuller.bar_store = make_store()
+    StockPuller.fetch_stock("BENCH", start, end, args.source)
+    calls = len(StockPuller.bar_store.provider.calls)
+    started = time.perf_counter()
+    resampled = StockPuller.fetch_stock("BENCH", start, end, args.interval)
+    resample_seconds = time.perf_counter() - started
+
+    if not downloaded.equals(resampled):
+        logger.warning("Resampled bars differ from the downloaded bars")
+    logger.info(
+        f"{args.interval} bars of {args.days} days: downloaded {len(downloaded)} bars in {download_seconds:.4f}s, "
+        f"resampled {len(resampled)} bars from {args.source} in {resample_seconds:.4f}s "
+        f"({len(StockPuller.bar_store.provider.calls) - calls} downloads, {download_seconds / resample_seconds:.0f}x faster)"
+    )
+
+if __name__ == "__main__":
+    main()
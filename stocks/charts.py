@@ -0,0 +1,144 @@
+import threading
+import time
+from datetime import datetime
+from enum import Enum
+from io import StringIO
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.figure import Figure
+
+from stocks.bar_store import interval_to_seconds, to_epoch_seconds
+from stocks.downsampling import lttb_indexes, minmax_indexes
+from stocks.providers import OHLCV_COLUMNS
+from stocks.stock_script import StockPuller
+from utils.logger_script import logger
+from utils.shared_cache import SharedCache
+
+
+class Constants(Enum):
+    # Rendered charts kept in the cache shared by the server's workers
+    cache_size = 256
+    # Seconds a chart of a range that is still growing (its end is after the last completed bar) stays cached
+    live_chart_ttl = 60.0
+    # Points a chart is downsampled to before it is drawn
+    max_points = 2000
+    figure_size = (10, 6)
+
+# Every column of a stock's dataframe that can be charted
+PLOT_TYPES = list(OHLCV_COLUMNS)
+
+# Every thread draws on its own figure, cleared and reused for every chart instead of creating one per chart
+thread_figures = threading.local()
+
+def get_thread_figure() -> Figure:
+    figure = getattr(thread_figures, "figure", None)
+    if figure is None:
+        # a Figure that is not created through pyplot is not kept alive by pyplot's figure registry
+        figure = thread_figures.figure = Figure(figsize=Constants.figure_size.value)
+        FigureCanvasSVG(figure)
+    figure.clear()
+    return figure
+
+def get_chart_series(df: pd.DataFrame, plot_type: str = "Adj Close", max_points: int = Constants.max_points.value, normalize: bool = None) -> pd.Series:
+    """
+    Get the values a chart shows - the plot type's column indexed by time, downsampled to about max_points
+    (LTTB for prices, min/max per bucket for volume so no spike is lost).
+    Prices are normalized to their growth since the first bar, volume is shown as is
+
+    :param df: Dataframe of a stock (time in the first column)
+    :param plot_type: One of PLOT_TYPES
+    :param normalize: Whether to show growth instead of values, defaults to True for prices
+    :returns: Series of values indexed by time
+    """
+    if plot_type not in PLOT_TYPES:
+        raise ValueError(f"Plot type must be one of {PLOT_TYPES}, got {plot_type}")
+    if normalize is None:
+        normalize = plot_type != "Volume"
+    series = pd.Series(df[plot_type].to_numpy(dtype=float), index=pd.DatetimeIndex(df[df.columns[0]]), name=plot_type)
+    if normalize:
+        first = series.dropna()
+        if not first.empty and first.iloc[0] != 0:
+            series = series / first.iloc[0]
+    if plot_type == "Volume":
+        return series.iloc[minmax_indexes(series.to_numpy(), max_points)]
+    times = series.index.tz_convert("UTC") if series.index.tz is not None else series.index.tz_localize("UTC")
+    x = ((times - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+    return series.iloc[lttb_indexes(x, series.to_numpy(), max_points)]
+
+def draw_chart(figure: Figure, series: pd.Series, plot_type: str, title: str = None) -> None:
+    ax = figure.subplots()
+    if plot_type == "Volume":
+        # one filled step polygon instead of a bar patch per point
+        ax.fill_between(series.index, series.to_numpy(), step="mid", label=plot_type)
+    else:
+        ax.plot(series.index, series.to_numpy(), label=plot_type)
+    ax.legend()
+    ax.set_title(title or plot_type, fontsize=16)
+    ax.set_ylabel(f"{plot_type} value", fontsize=14)
+    ax.set_xlabel('Time', fontsize=14)
+    ax.grid(which="major", color='k', linestyle='-.', linewidth=0.5)
+    figure.autofmt_xdate()
+
+def render_svg(df: pd.DataFrame, plot_type: str = "Adj Close", title: str = None, max_points: int = Constants.max_points.value) -> str:
+    """
+    Render a chart of a stock to SVG on the thread's reused figure, which is cleared right after
+
+    :param df: Dataframe of a stock (time in the first column)
+    :param plot_type: One of PLOT_TYPES
+    :returns: SVG document
+    """
+    figure = get_thread_figure()
+    try:
+        draw_chart(figure, get_chart_series(df, plot_type, max_points=max_points), plot_type, title=title)
+        buffer = StringIO()
+        figure.savefig(buffer, format="svg")
+        return buffer.getvalue()
+    finally:
+        figure.clear()
+
+# Rendered charts (and the GUI's chart points), shared by the server's worker processes
+chart_cache = SharedCache("charts", Constants.cache_size.value)
+
+def get_chart_ttl(end: datetime, interval: str) -> Union[float, None]:
+    """
+    :returns: Seconds a chart may be cached - None (until evicted) if its range ended before the last completed bar
+    """
+    if to_epoch_seconds(end) <= time.time() - interval_to_seconds(interval):
+        return None
+    return Constants.live_chart_ttl.value
+
+def get_chart_svg(ticker: str = None, start: datetime = None, end: datetime = None, interval: str = None, plot_type: str = "Adj Close") -> Union[str, None]:
+    """
+    Get a rendered chart of a stock, cached per (ticker, range, interval, plot_type)
+
+    :returns: SVG document, None if the stock could not be fetched
+    """
+    start, end, interval = StockPuller.get_default_range(start, end, interval)
+    key = ("svg", ticker, to_epoch_seconds(start), to_epoch_seconds(end), interval, plot_type)
+    svg = chart_cache.get(key)
+    if svg is not None:
+        return svg
+    df = StockPuller.get_stock(ticker=ticker, start=start, end=end, interval=interval)
+    if df is None or df.empty:
+        logger.warning(f"No data to chart for {ticker} ({interval})")
+        return None
+    svg = render_svg(df, plot_type, title=f"{ticker} {plot_type}")
+    chart_cache.set(key, svg, ttl=get_chart_ttl(end, interval))
+    return svg
+
+def get_chart_points(df: pd.DataFrame, plot_type: str = "Adj Close", max_points: int = Constants.max_points.value) -> Dict[str, List[float]]:
+    """
+    Get downsampled points of a chart for native (client side) charts
+
+    :param df: Dataframe of a stock (time in the first column)
+    :returns: {"x": epoch milliseconds, "y": values}, NaN values are left out
+    """
+    series = get_chart_series(df, plot_type, max_points=max_points).dropna()
+    index = series.index.tz_convert("UTC").tz_localize(None) if series.index.tz is not None else series.index
+    return {
+        "x": index.to_numpy().astype("datetime64[ms]").astype("int64").tolist(),
+        "y": series.to_numpy().tolist(),
+    }
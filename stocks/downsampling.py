@@ -0,0 +1,133 @@
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+
+
+# Downsampling methods of a stock's dataframe
+DOWNSAMPLING_METHODS = ("ohlc", "lttb", "minmax")
+
+def get_bucket_starts(length: int, buckets: int) -> np.ndarray:
+    """
+    :returns: Start index of each of buckets consecutive, (almost) equally sized buckets of length rows
+    """
+    return np.unique(np.linspace(0, length, buckets, endpoint=False).astype(int))
+
+def lttb_indexes(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Largest triangle three buckets - keep the first and last points and, from every bucket in between,
+    the point forming the largest triangle with the point kept before it and the average of the next bucket.
+    Work inside a bucket is vectorized, only the walk over buckets is a loop
+
+    :param x: Point positions (increasing), e.g. epoch seconds
+    :param y: Point values, NaN values are treated as the mean value
+    :param max_points: Points to keep (at least 3)
+    :returns: Sorted indexes of the kept points
+    """
+    length = len(y)
+    if max_points >= length or max_points < 3:
+        return np.arange(length)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    y = np.where(np.isnan(y), np.nanmean(y) if np.isfinite(y).any() else 0.0, y)
+
+    # the points between the first and the last are split into max_points - 2 buckets, each bucket
+    # is compared with the average of the next one (the last bucket with the last point)
+    edges = np.linspace(1, length - 1, max_points - 1).astype(int)
+    next_starts = np.append(edges[1:-1], length - 1)
+    next_ends = np.append(edges[2:], length)
+    cumulative_x = np.concatenate([[0.0], np.cumsum(x)])
+    cumulative_y = np.concatenate([[0.0], np.cumsum(y)])
+    average_x = (cumulative_x[next_ends] - cumulative_x[next_starts]) / (next_ends - next_starts)
+    average_y = (cumulative_y[next_ends] - cumulative_y[next_starts]) / (next_ends - next_starts)
+
+    indexes = np.empty(max_points, dtype=int)
+    indexes[0] = 0
+    indexes[-1] = length - 1
+    previous = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # twice the area of the triangle (previous point, candidate, next bucket's average)
+        areas = np.abs(
+            (x[previous] - average_x[bucket]) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (average_y[bucket] - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        indexes[bucket + 1] = previous
+    return indexes
+
+def minmax_indexes(y: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Keep the lowest and highest point of every bucket (two points per bucket), so no spike is lost.
+    Fully vectorized by padding the buckets to one size
+
+    :param y: Point values
+    :param max_points: Points to keep (at least 2)
+    :returns: Sorted indexes of the kept points
+    """
+    length = len(y)
+    if max_points >= length or max_points < 2:
+        return np.arange(length)
+    buckets = max_points // 2
+    bucket_size = -(-length // buckets)
+    padded = np.full(buckets * bucket_size, np.nan)
+    padded[:length] = y
+    padded = padded.reshape(buckets, bucket_size)
+    all_nan = np.isnan(padded).all(axis=1)
+    padded[all_nan, 0] = 0.0
+    offsets = np.arange(buckets) * bucket_size
+    lows = offsets + np.nanargmin(padded, axis=1)
+    highs = offsets + np.nanargmax(padded, axis=1)
+    indexes = np.concatenate([lows[~all_nan], highs[~all_nan], [0, length - 1]])
+    return np.unique(indexes[indexes < length])
+
+def aggregate_ohlcv(df: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    """
+    Merge consecutive bars into at most max_points bars - first open, highest high, lowest low,
+    last close and summed volume, stamped with the time of the first merged bar. Vectorized with ufunc.reduceat
+
+    :param df: Dataframe of a stock (time in the first column and OHLCV columns)
+    :returns: Dataframe with the same columns
+    """
+    length = len(df)
+    if max_points >= length or max_points < 1:
+        return df
+    starts = get_bucket_starts(length, max_points)
+    ends = np.append(starts[1:], length) - 1
+    # time, open and any other column take the first bar's value
+    aggregated = df.iloc[starts].reset_index(drop=True)
+    for column in df.columns:
+        if column == "High":
+            aggregated[column] = np.fmax.reduceat(df[column].to_numpy(dtype=float), starts)
+        elif column == "Low":
+            aggregated[column] = np.fmin.reduceat(df[column].to_numpy(dtype=float), starts)
+        elif column == "Volume":
+            aggregated[column] = np.add.reduceat(np.nan_to_num(df[column].to_numpy(dtype=float)), starts)
+        elif column in ("Close", "Adj Close"):
+            aggregated[column] = df[column].to_numpy()[ends]
+    return aggregated
+
+def downsample_frame(df: pd.DataFrame, max_points: int, method: Literal["ohlc", "lttb", "minmax"] = "ohlc", value_column: str = "Close") -> pd.DataFrame:
+    """
+    Downsample a stock's dataframe to at most max_points rows (about max_points for lttb and minmax)
+
+    :param df: Dataframe of a stock (time in the first column)
+    :param max_points: Rows to keep, no downsampling if None or if the dataframe is small enough
+    :param method: ohlc merges bars (keeps every high and low), lttb and minmax keep original rows picked by value_column
+    :param value_column: Column lttb and minmax pick rows by
+    :returns: Downsampled dataframe
+    """
+    if df is None or not max_points or len(df) <= max_points:
+        return df
+    if method == "ohlc":
+        return aggregate_ohlcv(df, max_points)
+    values = df[value_column].to_numpy(dtype=float)
+    if method == "lttb":
+        times = pd.to_datetime(df[df.columns[0]], utc=True)
+        x = ((times - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+        indexes = lttb_indexes(x, values, max_points)
+    elif method == "minmax":
+        indexes = minmax_indexes(values, max_points)
+    else:
+        raise ValueError(f"Downsampling method must be one of {DOWNSAMPLING_METHODS}, got {method}")
+    return df.iloc[indexes].reset_index(drop=True)
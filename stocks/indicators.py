@@ -0,0 +1,285 @@
+from enum import Enum
+from typing import Callable, Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from stocks.backtest import bars_per_year
+from stocks.bar_store import is_intraday_interval
+from utils.logger_script import logger
+from utils.shared_cache import SharedCache
+
+
+class Constants(Enum):
+    # (ticker, interval, range start, indicator) series kept in the shared cache
+    cache_size = 512
+
+# Every indicator state is a dict of what its computation needs to continue on the next bars:
+# the inputs' last window - 1 values for rolling windows, the last smoothed value and count for moving averages
+
+def rolling_window(values: np.ndarray, tail: Union[np.ndarray, None], window: int, statistic: Callable[[pd.core.window.Rolling], pd.Series]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rolling statistic of values continuing after tail, NaN until the window is full
+
+    :param values: New values
+    :param tail: Last window - 1 values before values, None on the first bars
+    :param statistic: Statistic of a pandas Rolling. E.g: lambda rolling: rolling.mean()
+    :returns: Statistic of every new value, new tail
+    """
+    tail = tail if tail is not None else np.empty(0)
+    joined = np.concatenate([tail, values])
+    result = statistic(pd.Series(joined).rolling(window)).to_numpy()[len(tail):]
+    return result, joined[len(joined) - (window - 1):] if window > 1 else joined[:0]
+
+def moving_average(values: np.ndarray, state: Union[Tuple[float, int], None], alpha: float, min_periods: int) -> Tuple[np.ndarray, Tuple[float, int]]:
+    """
+    Exponential moving average (y = alpha * x + (1 - alpha) * previous y) continuing after state,
+    NaN until min_periods values were seen
+
+    :param state: (last average, values seen) before values, None on the first bars
+    :returns: Average of every new value, new state
+    """
+    last, count = state if state is not None else (np.nan, 0)
+    if not len(values):
+        return values.astype(float), (last, count)
+    # the previous average is the first point, so pandas continues the recursion from it
+    averages = pd.Series(np.concatenate([[last], values])).ewm(alpha=alpha, adjust=False).mean().to_numpy()[1:]
+    counts = count + np.cumsum(~np.isnan(values))
+    return np.where(counts >= min_periods, averages, np.nan), (float(averages[-1]), int(counts[-1]))
+
+def get_timestamps(frame: pd.DataFrame) -> np.ndarray:
+    """
+    :param frame: Dataframe of a stock (time in the first column, naive times are UTC)
+    :returns: Epoch seconds of the bars
+    """
+    times = pd.DatetimeIndex(frame[frame.columns[0]])
+    times = times.tz_convert("UTC") if times.tz is not None else times.tz_localize("UTC")
+    return times.as_unit("s").asi8
+
+def get_close(frame: pd.DataFrame) -> np.ndarray:
+    return frame["Close"].to_numpy(dtype=float)
+
+def previous_values(values: np.ndarray, last: Union[float, None]) -> np.ndarray:
+    """
+    :returns: Values shifted by one bar, starting with last (NaN if None)
+    """
+    return np.concatenate([[last if last is not None else np.nan], values[:-1]])
+
+def sma(frame: pd.DataFrame, state: dict, interval: str, window: int = 20) -> Tuple[Dict[str, np.ndarray], dict]:
+    result, tail = rolling_window(get_close(frame), state.get("tail"), window, lambda rolling: rolling.mean())
+    return {f"SMA_{window}": result}, {"tail": tail}
+
+def ema(frame: pd.DataFrame, state: dict, interval: str, window: int = 20) -> Tuple[Dict[str, np.ndarray], dict]:
+    result, average = moving_average(get_close(frame), state.get("average"), 2 / (window + 1), window)
+    return {f"EMA_{window}": result}, {"average": average}
+
+def rsi(frame: pd.DataFrame, state: dict, interval: str, window: int = 14) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Relative strength index with Wilder's smoothing of gains and losses
+    """
+    close = get_close(frame)
+    change = close - previous_values(close, state.get("close"))
+    gains, gain_average = moving_average(np.where(np.isnan(change), np.nan, np.maximum(change, 0.0)), state.get("gains"), 1 / window, window)
+    losses, loss_average = moving_average(np.where(np.isnan(change), np.nan, np.maximum(-change, 0.0)), state.get("losses"), 1 / window, window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.where(losses == 0, 100.0, 100 - 100 / (1 + gains / losses))
+    result[np.isnan(gains) | np.isnan(losses)] = np.nan
+    last_close = close[-1] if len(close) else state.get("close")
+    return {f"RSI_{window}": result}, {"close": last_close, "gains": gain_average, "losses": loss_average}
+
+def macd(frame: pd.DataFrame, state: dict, interval: str, fast: int = 12, slow: int = 26, signal: int = 9) -> Tuple[Dict[str, np.ndarray], dict]:
+    close = get_close(frame)
+    fast_average, fast_state = moving_average(close, state.get("fast"), 2 / (fast + 1), fast)
+    slow_average, slow_state = moving_average(close, state.get("slow"), 2 / (slow + 1), slow)
+    line = fast_average - slow_average
+    signal_line, signal_state = moving_average(line, state.get("signal"), 2 / (signal + 1), signal)
+    name = f"{fast}_{slow}_{signal}"
+    return (
+        {f"MACD_{name}": line, f"MACD_signal_{name}": signal_line, f"MACD_histogram_{name}": line - signal_line},
+        {"fast": fast_state, "slow": slow_state, "signal": signal_state},
+    )
+
+def bollinger(frame: pd.DataFrame, state: dict, interval: str, window: int = 20, deviations: float = 2.0) -> Tuple[Dict[str, np.ndarray], dict]:
+    close = get_close(frame)
+    middle, tail = rolling_window(close, state.get("tail"), window, lambda rolling: rolling.mean())
+    deviation, _ = rolling_window(close, state.get("tail"), window, lambda rolling: rolling.std(ddof=0))
+    name = f"{window}_{deviations:g}"
+    return (
+        {f"BB_middle_{name}": middle, f"BB_upper_{name}": middle + deviations * deviation, f"BB_lower_{name}": middle - deviations * deviation},
+        {"tail": tail},
+    )
+
+def vwap(frame: pd.DataFrame, state: dict, interval: str) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Volume weighted average of the typical price (high + low + close) / 3, restarting every (UTC) day for intraday
+    intervals and running over the whole range otherwise
+    """
+    typical = (frame["High"].to_numpy(dtype=float) + frame["Low"].to_numpy(dtype=float) + get_close(frame)) / 3
+    volume = np.nan_to_num(frame["Volume"].to_numpy(dtype=float))
+    weighted = np.nan_to_num(typical * volume)
+    if is_intraday_interval(interval):
+        sessions = get_timestamps(frame) // (24 * 60 * 60)
+    else:
+        sessions = np.zeros(len(frame), dtype=int)
+    session, weighted_sum, volume_sum = state.get("session", None), state.get("weighted", 0.0), state.get("volume", 0.0)
+    # the sums carried over only count towards the bars of the session they belong to
+    carried = sessions == session
+    cumulative_weighted = pd.Series(weighted).groupby(sessions).cumsum().to_numpy() + np.where(carried, weighted_sum, 0.0)
+    cumulative_volume = pd.Series(volume).groupby(sessions).cumsum().to_numpy() + np.where(carried, volume_sum, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.where(cumulative_volume > 0, cumulative_weighted / cumulative_volume, np.nan)
+    if not len(frame):
+        return {"VWAP": result}, state
+    return {"VWAP": result}, {"session": sessions[-1], "weighted": float(cumulative_weighted[-1]), "volume": float(cumulative_volume[-1])}
+
+def atr(frame: pd.DataFrame, state: dict, interval: str, window: int = 14) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Average true range with Wilder's smoothing, the first bar's true range is its high - low
+    """
+    high, low, close = frame["High"].to_numpy(dtype=float), frame["Low"].to_numpy(dtype=float), get_close(frame)
+    previous_close = previous_values(close, state.get("close"))
+    true_range = np.fmax(high - low, np.fmax(np.abs(high - previous_close), np.abs(low - previous_close)))
+    result, average = moving_average(true_range, state.get("average"), 1 / window, window)
+    last_close = close[-1] if len(close) else state.get("close")
+    return {f"ATR_{window}": result}, {"close": last_close, "average": average}
+
+def volatility(frame: pd.DataFrame, state: dict, interval: str, window: int = 20) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Annualized rolling standard deviation of log returns
+    """
+    close = get_close(frame)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = np.log(close / previous_values(close, state.get("close")))
+    result, tail = rolling_window(returns, state.get("tail"), window, lambda rolling: rolling.std())
+    last_close = close[-1] if len(close) else state.get("close")
+    return {f"Volatility_{window}": result * np.sqrt(bars_per_year(interval))}, {"close": last_close, "tail": tail}
+
+# Indicator name -> function, its parameters' types and defaults.
+# Functions take the new bars, the state after the previous bars and the interval, and return
+# the indicator's columns for the new bars and the state after them
+INDICATORS: Dict[str, Tuple[Callable[..., Tuple[Dict[str, np.ndarray], dict]], Tuple[type, ...], tuple]] = {
+    "sma": (sma, (int,), (20,)),
+    "ema": (ema, (int,), (20,)),
+    "rsi": (rsi, (int,), (14,)),
+    "macd": (macd, (int, int, int), (12, 26, 9)),
+    "bollinger": (bollinger, (int, float), (20, 2.0)),
+    "vwap": (vwap, (), ()),
+    "atr": (atr, (int,), (14,)),
+    "volatility": (volatility, (int,), (20,)),
+}
+
+def parse_indicators(text: Union[str, None]) -> List[Tuple[str, tuple]]:
+    """
+    :param text: Comma separated indicators with colon separated parameters, missing ones take their defaults.
+                 E.g: sma:50,rsi,macd:12:26:9,bollinger:20:2
+    :returns: List of (name, parameters)
+    :raises ValueError: If an indicator is unknown or its parameters are invalid
+    """
+    indicators = []
+    for item in (text or "").split(","):
+        if not item.strip():
+            continue
+        name, *values = [part.strip() for part in item.strip().lower().split(":")]
+        if name not in INDICATORS:
+            raise ValueError(f"Unknown indicator {name}, expected one of {list(INDICATORS)}")
+        _, types, defaults = INDICATORS[name]
+        if len(values) > len(types):
+            raise ValueError(f"Indicator {name} takes at most {len(types)} parameters, got {len(values)}")
+        try:
+            params = tuple(kind(value) for kind, value in zip(types, values)) + defaults[len(values):]
+        except ValueError:
+            raise ValueError(f"Invalid parameters of indicator {name}: {values}")
+        if any(param <= 0 for param in params):
+            raise ValueError(f"Parameters of indicator {name} must be positive, got {params}")
+        indicators.append((name, params))
+    return indicators
+
+class IndicatorSeries:
+    """
+    An indicator computed over the bars of one (ticker, interval, range start). The state after the last completed
+    bar is kept, so bars that arrive later are computed from it instead of from the first bar again.
+    The last bar of a frame may still be forming, so it is computed from the state but never folded into it
+    """
+    def __init__(self, name: str, params: tuple, interval: str):
+        self.name: str = name
+        self.params: tuple = params
+        self.interval: str = interval
+        self.timestamps: np.ndarray = np.empty(0, dtype="int64")
+        self.columns: Dict[str, np.ndarray] = {}
+        self.state: dict = {}
+
+    @property
+    def function(self) -> Callable[..., Tuple[Dict[str, np.ndarray], dict]]:
+        return INDICATORS[self.name][0]
+
+    def compute(self, frame: pd.DataFrame, timestamps: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        :param frame: Dataframe of a stock (time in the first column)
+        :param timestamps: Epoch seconds of the frame's bars
+        :returns: Indicator columns for every bar of the frame
+        """
+        known = len(self.timestamps)
+        if known and (len(timestamps) < known or not np.array_equal(timestamps[:known], self.timestamps)):
+            # only a range's older bars are asked for, or the bars changed - served from scratch
+            if np.array_equal(timestamps, self.timestamps[:len(timestamps)]):
+                return {name: values[:len(timestamps)] for name, values in self.columns.items()}
+            logger.debug(f"Bars under {self.function.__name__}{self.params} changed, computing it again")
+            known = 0
+            self.timestamps, self.columns, self.state = self.timestamps[:0], {}, {}
+
+        completed = max(len(frame) - 1, known)
+        if completed > known:
+            new, self.state = self.function(frame.iloc[known:completed], self.state, self.interval, *self.params)
+            self.columns = {name: np.concatenate([self.columns.get(name, np.empty(0)), values]) for name, values in new.items()}
+            self.timestamps = timestamps[:completed]
+        if completed == len(frame):
+            return {name: values[:completed] for name, values in self.columns.items()}
+        forming, _ = self.function(frame.iloc[completed:], self.state, self.interval, *self.params)
+        if not self.columns:
+            return forming
+        return {name: np.concatenate([self.columns[name], forming[name]]) for name in self.columns}
+
+class IndicatorCache:
+    """
+    Indicator series per (ticker, interval, range start, indicator, parameters), kept in the cache shared by the
+    server's workers. A range's end is not part of the key - requests for a range that grew extend the cached series
+    """
+    def __init__(self, size: int = Constants.cache_size.value):
+        self.cache: SharedCache = SharedCache("indicators", size)
+
+    def get_series(self, key: tuple, name: str, params: tuple, interval: str) -> IndicatorSeries:
+        """
+        :returns: A copy of the cached series, a new one if it is not cached. Extended series are stored with store_series
+        """
+        series = self.cache.get(key)
+        return series if series is not None else IndicatorSeries(name, params, interval)
+
+    def store_series(self, key: tuple, series: IndicatorSeries) -> None:
+        self.cache.set(key, series)
+
+    def get_metrics(self) -> dict:
+        return self.cache.get_metrics()
+
+indicator_cache = IndicatorCache()
+
+def add_indicators(frame: pd.DataFrame, indicators: List[Tuple[str, tuple]], ticker: str, interval: str) -> pd.DataFrame:
+    """
+    Add indicator columns to a stock's dataframe, computed incrementally from the cached series of its range
+
+    :param frame: Dataframe from StockPuller.get_stock (time in the first column, OHLCV columns)
+    :param indicators: List of (name, parameters), see parse_indicators
+    :returns: Copy of the dataframe with a column per indicator output. E.g: SMA_20, MACD_signal_12_26_9
+    """
+    if frame is None or frame.empty or not indicators:
+        return frame
+    timestamps = get_timestamps(frame)
+    columns: Dict[str, np.ndarray] = {}
+    for name, params in indicators:
+        key = (ticker, interval, int(timestamps[0]), name, params)
+        series = indicator_cache.get_series(key, name, params, interval)
+        known = series.timestamps
+        columns.update(series.compute(frame, timestamps))
+        if series.timestamps is not known:
+            # completed bars were folded into the state
+            indicator_cache.store_series(key, series)
+    return pd.concat([frame, pd.DataFrame(columns, index=frame.index)], axis=1)
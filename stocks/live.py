@@ -0,0 +1,184 @@
+import asyncio
+import json
+import time
+from collections import deque
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Deque, Dict, List, Set, Tuple, Union
+
+import pandas as pd
+
+from stocks.bar_store import interval_to_seconds
+from stocks.serialization import to_columns
+from stocks.stock_script import StockPuller
+from utils.logger_script import logger
+
+
+class Constants(Enum):
+    # Interval of the bars pushed when a subscription does not specify one
+    default_interval = "1m"
+    # Seconds between polls of a subscribed ticker
+    poll_seconds = 5.0
+    # Messages waiting for a client before the oldest ones are dropped
+    client_queue_size = 100
+    # Seconds of history looked at on a ticker's first poll, only its latest bar is pushed
+    first_poll_lookback = 4 * 24 * 60 * 60
+
+class ClientQueue:
+    """
+    Bounded queue of messages to one client. When a slow client falls behind,
+    the oldest messages are dropped instead of blocking the poll that fans out to every client
+    """
+    def __init__(self, size: int = Constants.client_queue_size.value):
+        self.messages: Deque[str] = deque(maxlen=size)
+        self.ready: asyncio.Event = asyncio.Event()
+        self.dropped: int = 0
+
+    def put(self, message: str) -> None:
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped += 1
+        self.messages.append(message)
+        self.ready.set()
+
+    async def get(self) -> str:
+        while not self.messages:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.messages.popleft()
+
+class LiveFeed:
+    """
+    Pushes new bars of subscribed tickers to clients. Each (ticker, interval) is polled by one task
+    no matter how many clients subscribed to it, and every update is encoded once for all of them
+    """
+    def __init__(self, poll_seconds: float = Constants.poll_seconds.value):
+        self.poll_seconds: float = poll_seconds
+        # (ticker, interval) -> queues of the subscribed clients
+        self.subscribers: Dict[Tuple[str, str], Set[ClientQueue]] = {}
+        self.pollers: Dict[Tuple[str, str], asyncio.Task] = {}
+        # (ticker, interval) -> last message pushed, sent to new subscribers right away
+        self.latest: Dict[Tuple[str, str], str] = {}
+
+        # metrics
+        self.polls: int = 0
+        self.poll_errors: int = 0
+        self.messages: int = 0
+        self.clients: Set[ClientQueue] = set()
+
+    def subscribe(self, client: ClientQueue, ticker: str, interval: str) -> None:
+        key = (ticker, interval)
+        self.subscribers.setdefault(key, set()).add(client)
+        if key in self.latest:
+            client.put(self.latest[key])
+        if key not in self.pollers:
+            self.pollers[key] = asyncio.create_task(self.poll(ticker, interval))
+
+    def unsubscribe(self, client: ClientQueue, ticker: str, interval: str) -> None:
+        key = (ticker, interval)
+        clients = self.subscribers.get(key)
+        if clients is None:
+            return
+        clients.discard(client)
+        if not clients:
+            # nobody listens anymore, stop polling
+            del self.subscribers[key]
+            self.latest.pop(key, None)
+            poller = self.pollers.pop(key, None)
+            if poller is not None:
+                poller.cancel()
+
+    def unsubscribe_all(self, client: ClientQueue) -> None:
+        for ticker, interval in [key for key, clients in self.subscribers.items() if client in clients]:
+            self.unsubscribe(client, ticker, interval)
+
+    def publish(self, ticker: str, interval: str, message: dict) -> None:
+        """
+        Encode a message once and queue it for every subscriber of (ticker, interval) without waiting on any of them
+        """
+        key = (ticker, interval)
+        encoded = json.dumps(message, separators=(",", ":"))
+        self.latest[key] = encoded
+        for client in self.subscribers.get(key, ()):
+            client.put(encoded)
+            self.messages += 1
+
+    @staticmethod
+    def get_new_bars(frame: pd.DataFrame, last_sent: Union[Tuple[int, tuple], None]) -> Tuple[pd.DataFrame, Union[Tuple[int, tuple], None]]:
+        """
+        Pick the bars a poll has to push - bars after the last pushed one, and the last pushed one again if it
+        changed (it was still forming). On the first poll only the latest bar is pushed
+
+        :param frame: Dataframe from StockPuller.get_stock (time in the first column)
+        :param last_sent: (epoch seconds, values) of the last pushed bar, None before the first push
+        :returns: Dataframe of bars to push, the new last pushed bar
+        """
+        if frame is None or frame.empty:
+            return frame.iloc[0:0] if frame is not None else pd.DataFrame(), last_sent
+        times = pd.to_datetime(frame[frame.columns[0]], utc=True)
+        timestamps = ((times - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).to_numpy()
+        if last_sent is None:
+            new = frame.iloc[-1:]
+        else:
+            last_timestamp, last_values = last_sent
+            new = frame[timestamps >= last_timestamp]
+            if len(new) and timestamps[len(frame) - len(new)] == last_timestamp and tuple(new.iloc[0, 1:]) == last_values:
+                new = new.iloc[1:]
+        if new.empty:
+            return new, last_sent
+        return new, (int(timestamps[-1]), tuple(frame.iloc[-1, 1:]))
+
+    async def poll(self, ticker: str, interval: str) -> None:
+        """
+        Poll the bar cache for new bars of a ticker and publish them until cancelled
+        """
+        last_sent: Union[Tuple[int, tuple], None] = None
+        interval_seconds = interval_to_seconds(interval)
+        while True:
+            now = time.time()
+            start = last_sent[0] if last_sent is not None else now - max(Constants.first_poll_lookback.value, 2 * interval_seconds)
+            try:
+                frame = await StockPuller.get_stock_async(
+                    ticker=ticker, interval=interval, timeout=self.poll_seconds * 2,
+                    start=datetime.fromtimestamp(start, tz=timezone.utc), end=datetime.fromtimestamp(now, tz=timezone.utc),
+                )
+                self.polls += 1
+                new, last_sent = self.get_new_bars(frame, last_sent)
+                if new is not None and not new.empty:
+                    self.publish(ticker, interval, {"type": "bars", "ticker": ticker, "interval": interval, "bars": to_columns(new)})
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.poll_errors += 1
+                logger.error(f"Failed polling {ticker} ({interval}) for live updates: {error}")
+            await asyncio.sleep(self.poll_seconds)
+
+    def get_metrics(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "subscriptions": sum(len(clients) for clients in self.subscribers.values()),
+            "pollers": len(self.pollers),
+            "polls": self.polls,
+            "poll_errors": self.poll_errors,
+            "messages": self.messages,
+            "dropped": sum(client.dropped for client in self.clients),
+        }
+
+def parse_subscription(message: dict) -> Tuple[str, List[str], str]:
+    """
+    :param message: Client message. E.g: {"action": "subscribe", "tickers": ["AAPL", "MSFT"], "interval": "1m"}
+    :returns: action, tickers (upper case) and interval
+    :raises ValueError: If the message is not a valid subscription message
+    """
+    action = message.get("action")
+    if action not in ("subscribe", "unsubscribe"):
+        raise ValueError(f"Unknown action {action}, expected subscribe or unsubscribe")
+    tickers = message.get("tickers", [])
+    if isinstance(tickers, str):
+        tickers = tickers.split(",")
+    tickers = [ticker.strip().upper() for ticker in tickers if isinstance(ticker, str) and ticker.strip()]
+    interval = message.get("interval") or Constants.default_interval.value
+    interval_to_seconds(interval)
+    return action, tickers, interval
+
+# Feed the server's websocket clients subscribe to
+live_feed = LiveFeed()
@@ -0,0 +1,397 @@
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Deque, Dict, List, Literal, Self, Tuple
+
+import numpy as np
+import pandas as pd
+
+import data.database_models as db_m
+from stocks.bar_store import interval_to_seconds
+from stocks.stock_script import StockPuller
+from utils.logger_script import logger
+from utils.shared_cache import get_process_lock
+
+
+class Constants(Enum):
+    # Interval of the bars orders are matched against
+    matching_interval = "5m"
+    # Seconds between matching rounds of the background loop
+    matching_poll_seconds = 30.0
+    # Slippage of market and stop orders in basis points, always against the trader
+    slippage_bps = 5.0
+    # Part of a bar's volume the orders of a ticker may take, the rest of an order waits for the next bar
+    max_volume_participation = 0.1
+
+ORDER_TYPES = ("market", "limit", "stop", "stop_limit")
+
+@dataclass
+class Order:
+    id: str
+    user_id: str
+    ticker: str
+    side: Literal["buy", "sell"]
+    order_type: Literal["market", "limit", "stop", "stop_limit"]
+    amount: float
+    filled: float = 0.0
+    average_fill_price: float = 0.0
+    limit_price: float = None
+    stop_price: float = None
+    triggered: int = 0
+    status: Literal["open", "partially_filled", "filled", "cancelled"] = "open"
+    created_at: int = 0
+    updated_at: int = 0
+
+    @property
+    def remaining(self) -> float:
+        return self.amount - self.filled
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Self:
+        field_names: set[str] = {field.name for field in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in field_names})
+
+    @classmethod
+    def new(cls, user_id: str, ticker: str, side: str, order_type: str, amount: float, limit_price: float = None, stop_price: float = None) -> Self:
+        """
+        Create a validated open order
+
+        :raises ValueError: If the order is not valid
+        """
+        if side not in ("buy", "sell"):
+            raise ValueError(f"Side must be buy or sell, got {side}")
+        if order_type not in ORDER_TYPES:
+            raise ValueError(f"Order type must be one of {ORDER_TYPES}, got {order_type}")
+        if not amount or amount <= 0:
+            raise ValueError("Amount must be positive")
+        if order_type in ("limit", "stop_limit") and (limit_price is None or limit_price <= 0):
+            raise ValueError(f"A {order_type} order needs a positive limit price")
+        if order_type in ("stop", "stop_limit") and (stop_price is None or stop_price <= 0):
+            raise ValueError(f"A {order_type} order needs a positive stop price")
+        now = int(time.time())
+        return cls(
+            id=str(uuid.uuid4()), user_id=user_id, ticker=ticker.strip().upper(), side=side, order_type=order_type,
+            amount=float(amount), limit_price=limit_price if order_type in ("limit", "stop_limit") else None,
+            stop_price=stop_price if order_type in ("stop", "stop_limit") else None, created_at=now, updated_at=now,
+        )
+
+class TickerBook:
+    """
+    Resting orders of one ticker, indexed by price so a bar only touches the orders it can fill:
+    buy limits by highest limit, sell limits by lowest limit, buy stops by lowest stop and sell stops by highest stop.
+    Heap entries are (price key, sequence, order id), cancelled and filled orders are dropped lazily when they surface
+    """
+    def __init__(self, ticker: str):
+        self.ticker: str = ticker
+        self.orders: Dict[str, Order] = {}
+        self.market: Deque[str] = deque()
+        self.buy_limits: List[Tuple[float, int, str]] = []
+        self.sell_limits: List[Tuple[float, int, str]] = []
+        self.buy_stops: List[Tuple[float, int, str]] = []
+        self.sell_stops: List[Tuple[float, int, str]] = []
+        self.sequence = itertools.count()
+        # Epoch seconds of the last bar that was matched
+        self.last_bar: int = None
+        # Orders whose state changed since the changes were last taken
+        self.changed: Dict[str, Order] = {}
+
+    def add(self, order: Order) -> None:
+        self.orders[order.id] = order
+        self.push(order)
+
+    def push(self, order: Order) -> None:
+        """
+        Put an order on the structure matching its type (and whether its stop was triggered)
+        """
+        sequence = next(self.sequence)
+        if order.order_type == "market" or (order.order_type == "stop" and order.triggered):
+            self.market.append(order.id)
+        elif order.order_type == "limit" or (order.order_type == "stop_limit" and order.triggered):
+            if order.side == "buy":
+                heapq.heappush(self.buy_limits, (-order.limit_price, sequence, order.id))
+            else:
+                heapq.heappush(self.sell_limits, (order.limit_price, sequence, order.id))
+        elif order.side == "buy":
+            heapq.heappush(self.buy_stops, (order.stop_price, sequence, order.id))
+        else:
+            heapq.heappush(self.sell_stops, (-order.stop_price, sequence, order.id))
+
+    def remove(self, order_id: str) -> Order:
+        return self.orders.pop(order_id, None)
+
+    def take_changed(self) -> List[Order]:
+        changed = list(self.changed.values())
+        self.changed = {}
+        return changed
+
+    def match_bar(self, timestamp: int, bar_open: float, high: float, low: float, volume: float, slippage: float, participation: float) -> List[Tuple[Order, float, float]]:
+        """
+        Fill the resting orders a bar reaches. Market orders fill at the open, stops trigger when the bar
+        trades through them (stops then fill like market orders, stop limits rest as limits),
+        limits fill at their limit or a better open.
+        The bar's volume times the participation caps what all orders together may fill, the rest waits
+
+        :param timestamp: Epoch seconds of the bar's open, orders created after it are not matched
+        :param slippage: Fraction of the price market and stop fills lose
+        :returns: List of (order, amount, price) fills
+        """
+        fills: List[Tuple[Order, float, float]] = []
+        liquidity = volume * participation if volume and volume > 0 and not math.isnan(volume) else math.inf
+        waiting: List[Order] = []
+
+        def fill(order: Order, price: float) -> bool:
+            # returns False once the bar has no liquidity left
+            nonlocal liquidity
+            amount = min(order.remaining, liquidity)
+            if amount <= 0:
+                return False
+            liquidity -= amount
+            fills.append((order, amount, price))
+            self.changed[order.id] = order
+            order.average_fill_price = (order.average_fill_price * order.filled + price * amount) / (order.filled + amount)
+            order.filled += amount
+            if order.remaining <= 1e-12:
+                order.status = "filled"
+                self.orders.pop(order.id, None)
+            else:
+                order.status = "partially_filled"
+            return True
+
+        def active(order_id: str) -> Order:
+            order = self.orders.get(order_id)
+            if order is not None and order.created_at > timestamp:
+                waiting.append(order)
+                return None
+            return order
+
+        # market orders, first in first out
+        while self.market and liquidity > 0:
+            order = active(self.market[0])
+            self.market.popleft()
+            if order is None:
+                continue
+            fill(order, bar_open * (1 + slippage if order.side == "buy" else 1 - slippage))
+            if order.id in self.orders:
+                self.market.appendleft(order.id)
+                break
+
+        # stops the bar traded through
+        for heap, side in ((self.buy_stops, "buy"), (self.sell_stops, "sell")):
+            while heap and (heap[0][0] <= high if side == "buy" else -heap[0][0] >= low):
+                order = active(heapq.heappop(heap)[2])
+                if order is None:
+                    continue
+                order.triggered = 1
+                self.changed[order.id] = order
+                if order.order_type == "stop_limit":
+                    self.push(order)
+                    continue
+                price = max(bar_open, order.stop_price) * (1 + slippage) if side == "buy" else min(bar_open, order.stop_price) * (1 - slippage)
+                if not fill(order, price) or order.id in self.orders:
+                    self.push(order)
+                    break
+
+        # limits the bar reached
+        for heap, side in ((self.buy_limits, "buy"), (self.sell_limits, "sell")):
+            while heap and (-heap[0][0] >= low if side == "buy" else heap[0][0] <= high):
+                order = active(heapq.heappop(heap)[2])
+                if order is None:
+                    continue
+                price = min(bar_open, order.limit_price) if side == "buy" else max(bar_open, order.limit_price)
+                if not fill(order, price) or order.id in self.orders:
+                    self.push(order)
+                    break
+
+        for order in waiting:
+            if order.order_type != "market":
+                self.push(order)
+        # market orders that are not active yet went back to the queue's front in their order
+        self.market.extendleft(reversed([order.id for order in waiting if order.order_type == "market"]))
+        return fills
+
+class OrderMatcher:
+    """
+    Order books of every ticker with open orders, matched against the latest completed bars of the bar cache
+    """
+    def __init__(self, interval: str = Constants.matching_interval.value, reload_orders: bool = False):
+        """
+        :param reload_orders: Whether to load the open orders again every round - when other processes (the server's
+                              workers) place and cancel orders that never reach this matcher's books
+        """
+        self.interval: str = interval
+        self.books: Dict[str, TickerBook] = {}
+        self.lock = threading.Lock()
+        self.loaded: bool = False
+        self.reload_orders: bool = reload_orders
+
+    def load(self, keep_progress: bool = False) -> int:
+        """
+        Load the open orders from the database into the books
+
+        :param keep_progress: Whether the books skip the bars they were matched against already. Only when the
+                              database has every fill of them, i.e. not after recording fills failed
+        :returns: Number of orders loaded
+        """
+        orders = [Order.from_dict(order) for order in db_m.get_open_orders()]
+        with self.lock:
+            last_bars = {ticker: book.last_bar for ticker, book in self.books.items()} if keep_progress else {}
+            self.books = {}
+            for order in orders:
+                book = self.get_book(order.ticker)
+                book.add(order)
+                if order.filled > 0 or order.triggered:
+                    # every bar completed before the order's last update was matched already
+                    last_bar = order.updated_at - interval_to_seconds(self.interval)
+                    book.last_bar = last_bar if book.last_bar is None else max(book.last_bar, last_bar)
+            for ticker, last_bar in last_bars.items():
+                book = self.books.get(ticker)
+                if book is not None and last_bar is not None:
+                    book.last_bar = last_bar if book.last_bar is None else max(book.last_bar, last_bar)
+            self.loaded = True
+        if keep_progress:
+            logger.debug(f"Reloaded {len(orders)} open orders of {len(self.books)} tickers")
+        else:
+            logger.info(f"Loaded {len(orders)} open orders of {len(self.books)} tickers")
+        return len(orders)
+
+    def get_book(self, ticker: str) -> TickerBook:
+        book = self.books.get(ticker)
+        if book is None:
+            book = self.books[ticker] = TickerBook(ticker)
+        return book
+
+    def place(self, order: Order) -> bool:
+        """
+        Store a new order and put it on its ticker's book
+
+        :returns: True if the order was stored
+        """
+        if not db_m.add_order(order.to_dict()):
+            return False
+        with self.lock:
+            # books that were not loaded yet get the order with the other open orders
+            if self.loaded:
+                self.get_book(order.ticker).add(order)
+        logger.info(f"Placed {order.order_type} {order.side} order {order.id} of {order.amount} {order.ticker} for user {order.user_id}")
+        return True
+
+    def cancel(self, user_id: str, order_id: str) -> bool:
+        """
+        Cancel an open order of a user, the book drops it lazily
+
+        :returns: True if an open order was cancelled
+        """
+        if not db_m.cancel_order(user_id, order_id):
+            return False
+        with self.lock:
+            for book in self.books.values():
+                if book.remove(order_id) is not None:
+                    break
+        return True
+
+    def match_frame(self, book: TickerBook, frame: pd.DataFrame, now: float) -> List[Tuple[Order, float, float, int]]:
+        """
+        Match a book against the completed bars of a frame it did not see yet
+
+        :param frame: Dataframe from StockPuller.get_stocks
+        :returns: List of (order, amount, price, bar timestamp) fills
+        """
+        if frame.empty:
+            return []
+        times = pd.to_datetime(frame[frame.columns[0]], utc=True)
+        timestamps = ((times - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).to_numpy()
+        # the forming bar is matched once it is complete, so its high and low are final
+        new_bars = timestamps + interval_to_seconds(self.interval) <= now
+        if book.last_bar is not None:
+            new_bars &= timestamps > book.last_bar
+        slippage = Constants.slippage_bps.value / 10_000
+        participation = Constants.max_volume_participation.value
+
+        fills = []
+        bars = frame.loc[new_bars, ["Open", "High", "Low", "Volume"]].to_numpy(dtype=float)
+        for timestamp, (bar_open, high, low, volume) in zip(timestamps[new_bars], bars):
+            if np.isnan(bar_open):
+                continue
+            for order, amount, price in book.match_bar(int(timestamp), bar_open, high, low, volume, slippage, participation):
+                fills.append((order, amount, price, int(timestamp)))
+            book.last_bar = int(timestamp)
+        return fills
+
+    def run_once(self) -> dict:
+        """
+        One matching round: get the bars of every ticker with open orders (one batched lookup),
+        match them and write the fills, positions and order states in one transaction
+
+        :returns: Dict of tickers, fills and errors (ticker -> error)
+        """
+        # one process matches at a time, so no order is filled twice
+        with get_process_lock("order_matcher"):
+            return self.match_books()
+
+    def match_books(self) -> dict:
+        if not self.loaded or self.reload_orders:
+            self.load(keep_progress=self.loaded)
+        with self.lock:
+            books = [book for book in self.books.values() if book.orders]
+        if not books:
+            return {"tickers": 0, "fills": 0, "errors": {}}
+
+        now = time.time()
+        oldest_bar = min(
+            book.last_bar if book.last_bar is not None else min(order.created_at for order in book.orders.values())
+            for book in books
+        )
+        start = datetime.fromtimestamp(oldest_bar - interval_to_seconds(self.interval), tz=timezone.utc)
+        frames, errors = StockPuller.get_stocks(
+            tickers=[book.ticker for book in books], start=start, end=datetime.fromtimestamp(now, tz=timezone.utc), interval=self.interval
+        )
+
+        fills = []
+        changed: List[Order] = []
+        with self.lock:
+            for book in books:
+                if book.ticker in frames:
+                    fills.extend(self.match_frame(book, frames[book.ticker], now))
+                changed.extend(book.take_changed())
+        for order in changed:
+            order.updated_at = int(now)
+        trades = [
+            {"order_id": order.id, "user_id": order.user_id, "timestamp": timestamp, "ticker": order.ticker, "action": order.side, "amount": amount, "price": price}
+            for order, amount, price, timestamp in fills
+        ]
+        if not db_m.record_order_fills(trades, [order.to_dict() for order in changed]):
+            # the books moved ahead of the database, reload them so nothing is filled twice or lost
+            self.load()
+            return {"tickers": len(books), "fills": 0, "errors": errors}
+        if fills:
+            logger.info(f"Filled {len(fills)} orders of {len(books)} tickers")
+        return {"tickers": len(books), "fills": len(fills), "errors": errors}
+
+    async def run_forever(self, poll_seconds: float = Constants.matching_poll_seconds.value) -> None:
+        """
+        Match orders every poll_seconds until cancelled, on StockPuller's executor
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(StockPuller.executor, self.run_once)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f"Failed matching orders: {error}")
+            await asyncio.sleep(poll_seconds)
+
+# Matcher the server places orders on and runs in the background. The server's other workers place
+# and cancel orders in the database, so the open orders are loaded every round
+order_matcher = OrderMatcher(reload_orders=True)
@@ -0,0 +1,116 @@
+from typing import Dict, List, Union
+from datetime import datetime
+
+import yfinance as yf
+import pandas as pd
+
+from utils.logger_script import logger
+
+
+# Columns every provider returns, in this order
+OHLCV_COLUMNS = ["Open", "High", "Low", "Close", "Adj Close", "Volume"]
+
+class StockProvider:
+    """
+    Base class for market data providers.
+
+    A provider downloads bars for one or more tickers and returns a dict of
+    ticker -> dataframe indexed by datetime with the OHLCV_COLUMNS columns.
+    Swap StockPuller's provider (StockPuller.set_provider) to use another source.
+    """
+    def download(self, tickers: List[str], start: datetime, end: datetime, interval: str) -> Dict[str, pd.DataFrame]:
+        """
+        Download bars for tickers
+
+        :param tickers: List of stock tickers. E.g: [AMZN, AAPL]
+        :param start: Datetime of start (inclusive)
+        :param end: Datetime of end (exclusive)
+        :param interval: Interval (yFinance Interval). E.g: 1d, 30m
+        :returns: Dict of ticker -> dataframe of bars, tickers that failed are left out
+        """
+        raise NotImplementedError
+
+class YFinanceProvider(StockProvider):
+    """
+    Provider that pulls data from yfinance
+    """
+    def download(self, tickers: List[str], start: datetime, end: datetime, interval: str) -> Dict[str, pd.DataFrame]:
+        data: pd.DataFrame = yf.download(
+            tickers=tickers, start=start, end=end, interval=interval,
+            auto_adjust=False, group_by="ticker", progress=False
+        )
+        frames = split_by_ticker(data, tickers)
+        # yfinance does not raise for tickers that failed, their columns are missing (left out by split_by_ticker)
+        # or all NaN next to the rows of the other tickers instead. Its record of the failures (yf.shared._ERRORS)
+        # is global and shared by concurrent downloads, so it is not read.
+        # A download without any rows is a range without trading (e.g. a weekend), its empty frames are kept
+        if data is not None and not data.empty:
+            for ticker in tickers:
+                if ticker in frames and frames[ticker].empty:
+                    logger.warning(f"yfinance returned no data for {ticker}")
+                    del frames[ticker]
+        return frames
+
+class StaticProvider(StockProvider):
+    """
+    Offline provider that serves bars from in memory dataframes.
+    Counts the calls made to it so it can stand in for yfinance when testing.
+    """
+    def __init__(self, frames: Dict[str, pd.DataFrame]):
+        self.frames: Dict[str, pd.DataFrame] = frames
+        self.calls: List[tuple] = []
+
+    def download(self, tickers: List[str], start: datetime, end: datetime, interval: str) -> Dict[str, pd.DataFrame]:
+        self.calls.append((tuple(tickers), start, end, interval))
+        result: Dict[str, pd.DataFrame] = {}
+        for ticker in tickers:
+            frame = self.frames.get(ticker)
+            if frame is None:
+                continue
+            start_ts = to_utc_timestamp(start)
+            end_ts = to_utc_timestamp(end)
+            index = pd.DatetimeIndex(frame.index)
+            if index.tz is None:
+                index = index.tz_localize("UTC")
+            mask = (index >= start_ts) & (index < end_ts)
+            result[ticker] = frame[mask]
+        return result
+
+
+def to_utc_timestamp(moment: Union[datetime, pd.Timestamp]) -> pd.Timestamp:
+    """
+    Convert a datetime to a UTC timestamp. Naive datetimes are treated as
+    local time, the same way yfinance treats them.
+
+    :param moment: Datetime to convert
+    :returns: Tz aware (UTC) pandas timestamp
+    """
+    timestamp = pd.Timestamp(moment)
+    if timestamp.tzinfo is None:
+        return pd.Timestamp(timestamp.to_pydatetime().timestamp(), unit="s", tz="UTC")
+    return timestamp.tz_convert("UTC")
+
+def split_by_ticker(data: Union[pd.DataFrame, None], tickers: List[str]) -> Dict[str, pd.DataFrame]:
+    """
+    Split a (possibly multi index) yfinance dataframe into one dataframe per ticker
+
+    :param data: Dataframe returned from yf.download
+    :param tickers: Tickers that were requested
+    :returns: Dict of ticker -> dataframe with OHLCV_COLUMNS columns, tickers that could not be split are left out
+    """
+    result: Dict[str, pd.DataFrame] = {}
+    for ticker in tickers:
+        try:
+            if data is None or data.empty:
+                frame = pd.DataFrame(columns=OHLCV_COLUMNS)
+            elif isinstance(data.columns, pd.MultiIndex):
+                # group_by="ticker" puts the ticker on the first level
+                level = 0 if ticker in data.columns.get_level_values(0) else 1
+                frame = data.xs(ticker, axis=1, level=level)
+            else:
+                frame = data
+            frame = frame.reindex(columns=OHLCV_COLUMNS).dropna(how="all")
+            result[ticker] = frame
+        except Exception as error:
+            logger.error(f"Could not split provider data for {ticker}: {error}")
+    return result
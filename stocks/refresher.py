@@ -0,0 +1,203 @@
+import asyncio
+import random
+import threading
+import time
+from enum import Enum
+from os import getenv
+from typing import Callable, Dict, List, Tuple
+
+import data.database_models as db_m
+from stocks.bar_store import interval_to_seconds
+from stocks.stock_script import StockPuller
+from utils.logger_script import logger
+from utils.rate_limiter import RateLimiter
+
+
+class Constants(Enum):
+    # Tickers that are always refreshed, on top of the held ones. E.g: REFRESH_TICKERS=AAPL,MSFT
+    refresh_tickers = [ticker.strip().upper() for ticker in getenv("REFRESH_TICKERS", "").split(",") if ticker.strip()]
+    # Intervals to refresh -> seconds between refreshes. E.g: REFRESH_INTERVALS=5m:300,1d:3600
+    refresh_intervals = {
+        interval.strip(): float(seconds)
+        for interval, seconds in (item.split(":") for item in getenv("REFRESH_INTERVALS", "5m:300,1d:3600").split(",") if ":" in item)
+    }
+    # Seconds of history downloaded for a ticker the cache never saw, per interval
+    initial_lookback = {"1m": 7 * 24 * 60 * 60, "5m": 30 * 24 * 60 * 60, "1d": 365 * 24 * 60 * 60}
+    default_initial_lookback = 30 * 24 * 60 * 60
+    # Each refresh waits +-jitter of its period, so refreshes of many servers do not line up
+    jitter = 0.1
+    # Seconds to wait after the first failure of a ticker, doubled with every failure in a row
+    backoff_base = 60.0
+    backoff_max = 60.0 * 60
+    # Provider calls per second and the burst allowed
+    provider_rate = 0.5
+    provider_burst = 2
+    # Tickers that start within this many bars of each other are downloaded in one call
+    group_bars = 100
+
+class MarketDataRefresher:
+    """
+    Keeps the bar cache of a hot set of tickers up to date in the background, so requests for them
+    are served from the cache. Only bars after a ticker's covered range are downloaded
+    """
+    def __init__(self, intervals: Dict[str, float] = None, tickers: List[str] = None,
+                 sources: List[Callable[[], List[str]]] = None, rate_limiter: RateLimiter = None):
+        """
+        :param intervals: Interval (yFinance Interval) -> seconds between refreshes
+        :param tickers: Tickers that are always refreshed
+        :param sources: Functions returning more tickers to refresh, called before every refresh
+        :param rate_limiter: Limits the calls made to the provider
+        """
+        self.intervals: Dict[str, float] = dict(intervals if intervals is not None else Constants.refresh_intervals.value)
+        self.tickers: List[str] = list(tickers if tickers is not None else Constants.refresh_tickers.value)
+        self.sources: List[Callable[[], List[str]]] = list(sources if sources is not None else [db_m.get_held_tickers])
+        self.rate_limiter: RateLimiter = rate_limiter or RateLimiter(
+            "provider", Constants.provider_rate.value, Constants.provider_burst.value
+        )
+        self.lock: threading.Lock = threading.Lock()
+        # (ticker, interval) -> state of the ticker's refreshes
+        self.states: Dict[Tuple[str, str], dict] = {}
+        # interval -> state of the interval's refresh job
+        self.jobs: Dict[str, dict] = {
+            interval: {"period": period, "runs": 0, "last_run": None, "last_duration": None, "next_run": None}
+            for interval, period in self.intervals.items()
+        }
+        self.running: bool = False
+
+    def get_hot_tickers(self) -> List[str]:
+        """
+        :returns: Sorted list of the configured tickers and the tickers of every source
+        """
+        tickers = set(self.tickers)
+        for source in self.sources:
+            try:
+                tickers.update(source())
+            except Exception as error:
+                logger.error(f"Failed getting tickers to refresh from {getattr(source, '__name__', source)}: {error}")
+        return sorted(tickers)
+
+    def get_state(self, ticker: str, interval: str) -> dict:
+        state = self.states.get((ticker, interval))
+        if state is None:
+            state = self.states[(ticker, interval)] = {
+                "last_success": None, "last_error": None, "failures": 0, "retry_at": 0.0, "bars": 0,
+            }
+        return state
+
+    def record_result(self, ticker: str, interval: str, stored: int = None, error: str = None) -> None:
+        now = time.time()
+        with self.lock:
+            state = self.get_state(ticker, interval)
+            if error is None:
+                state.update(last_success=now, last_error=None, failures=0, retry_at=0.0, bars=state["bars"] + stored)
+                return
+            # exponential backoff with full jitter, so failing tickers do not retry in lock step
+            state["failures"] += 1
+            state["last_error"] = error
+            backoff = min(Constants.backoff_base.value * 2 ** (state["failures"] - 1), Constants.backoff_max.value)
+            state["retry_at"] = now + random.uniform(backoff / 2, backoff)
+
+    def plan(self, tickers: List[str], interval: str, now: float) -> List[Tuple[int, List[str]]]:
+        """
+        Group the tickers of an interval into downloads - tickers whose covered ranges end close to each other
+        are downloaded together from the earliest end. Tickers in backoff are skipped
+
+        :returns: List of (start epoch seconds, tickers), each at most max_tickers_per_download tickers
+        """
+        bar_store = StockPuller.bar_store
+        with self.lock:
+            due = [ticker for ticker in tickers if self.get_state(ticker, interval)["retry_at"] <= now]
+        due = [ticker for ticker in due if db_m.generate_stock_table_for_stocksbase_by_ticker(ticker, bar_store.engine)]
+        coverages = bar_store.get_coverages(due, interval)
+        lookback = Constants.initial_lookback.value.get(interval, Constants.default_initial_lookback.value)
+        group_seconds = interval_to_seconds(interval) * Constants.group_bars.value
+
+        groups: Dict[int, List[Tuple[int, str]]] = {}
+        for ticker in due:
+            start = coverages[ticker][1] if ticker in coverages else int(now - lookback)
+            groups.setdefault(start // group_seconds, []).append((start, ticker))
+
+        downloads = []
+        for group in groups.values():
+            group_tickers = [ticker for _, ticker in group]
+            start = min(start for start, _ in group)
+            for index in range(0, len(group_tickers), bar_store.max_tickers_per_download):
+                downloads.append((start, group_tickers[index:index + bar_store.max_tickers_per_download]))
+        return downloads
+
+    def refresh(self, interval: str) -> dict:
+        """
+        Refresh the hot tickers of an interval once (blocking)
+
+        :returns: Dict of tickers, downloads, bars (stored) and errors (ticker -> error)
+        """
+        now = time.time()
+        tickers = self.get_hot_tickers()
+        downloads = self.plan(tickers, interval, now)
+        bars = 0
+        errors: Dict[str, str] = {}
+        for start, chunk in downloads:
+            self.rate_limiter.acquire()
+            stored, chunk_errors = StockPuller.bar_store.update_bars(chunk, interval, start, int(time.time()))
+            for ticker in chunk:
+                if ticker in chunk_errors:
+                    self.record_result(ticker, interval, error=chunk_errors[ticker])
+                else:
+                    self.record_result(ticker, interval, stored=stored.get(ticker, 0))
+            bars += sum(stored.values())
+            errors.update(chunk_errors)
+        if downloads:
+            logger.info(f"Refreshed {len(tickers)} tickers ({interval}) with {len(downloads)} downloads, {bars} bars, {len(errors)} failed")
+        return {"tickers": len(tickers), "downloads": len(downloads), "bars": bars, "errors": errors}
+
+    def get_delay(self, interval: str) -> float:
+        period = self.intervals[interval]
+        return period * random.uniform(1 - Constants.jitter.value, 1 + Constants.jitter.value)
+
+    async def run_forever(self) -> None:
+        """
+        Refresh every interval on its own schedule until cancelled, on StockPuller's executor.
+        The first refreshes are spread over a jittered part of their period
+        """
+        if not self.intervals:
+            return
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        for interval, job in self.jobs.items():
+            job["next_run"] = now + random.uniform(0, Constants.jitter.value * job["period"])
+        self.running = True
+        try:
+            while True:
+                interval, job = min(self.jobs.items(), key=lambda item: item[1]["next_run"])
+                await asyncio.sleep(max(job["next_run"] - time.time(), 0.0))
+                started = time.time()
+                try:
+                    await loop.run_in_executor(StockPuller.executor, self.refresh, interval)
+                except Exception as error:
+                    logger.error(f"Failed refreshing {interval} market data: {error}")
+                job.update(runs=job["runs"] + 1, last_run=started, last_duration=time.time() - started)
+                job["next_run"] = started + self.get_delay(interval)
+        finally:
+            self.running = False
+
+    def get_status(self) -> dict:
+        """
+        :returns: Dict of running, jobs (interval -> schedule), tickers ((ticker, interval) states),
+                  failing (count) and rate_limiter metrics
+        """
+        now = time.time()
+        with self.lock:
+            tickers = [
+                {"ticker": ticker, "interval": interval, **state, "in_backoff": state["retry_at"] > now}
+                for (ticker, interval), state in sorted(self.states.items())
+            ]
+        return {
+            "running": self.running,
+            "jobs": {interval: dict(job) for interval, job in self.jobs.items()},
+            "tickers": tickers,
+            "failing": sum(1 for state in tickers if state["failures"] > 0),
+            "rate_limiter": self.rate_limiter.get_metrics(),
+        }
+
+# Refresher the server runs in the background
+market_data_refresher = MarketDataRefresher()
@@ -0,0 +1,196 @@
+import json
+from enum import Enum
+from io import BytesIO
+from typing import AsyncGenerator, AsyncIterator, Dict, Union
+
+import numpy as np
+import pandas as pd
+from fastapi import Response
+
+from utils.logger_script import logger
+
+
+class StreamFormats(Enum):
+    """
+    Streamed response formats of stock data -> media type
+    """
+    ndjson = "application/x-ndjson"
+    arrow = "application/vnd.apache.arrow.stream"
+
+class DataFormats(Enum):
+    """
+    Response formats of stock data -> media type
+    """
+    records = "application/json"
+    columns = "application/vnd.papertrading.columns+json"
+    arrow = "application/vnd.apache.arrow.stream"
+    parquet = "application/vnd.apache.parquet"
+
+def negotiate_format(requested_format: Union[str, None], accept: Union[str, None]) -> DataFormats:
+    """
+    Pick a response format from the format query parameter, or from the Accept header
+
+    :param requested_format: Name of a DataFormats member. E.g: columns
+    :param accept: Accept header of the request
+    :returns: The format to respond with, records if nothing matches
+    """
+    if requested_format:
+        try:
+            return DataFormats[requested_format.lower()]
+        except KeyError:
+            logger.warning(f"Unknown data format {requested_format}, defaulting to records")
+            return DataFormats.records
+    if accept:
+        media_types = [media_type.split(";")[0].strip() for media_type in accept.split(",")]
+        for media_type in media_types:
+            for data_format in DataFormats:
+                if media_type == data_format.value:
+                    return data_format
+    return DataFormats.records
+
+def to_columns(df: pd.DataFrame) -> dict:
+    """
+    Convert a dataframe to column oriented json - one array per column.
+    Datetime columns are sent as epoch milliseconds (UTC) and listed in "datetime_columns"
+
+    :param df: Dataframe of a stock
+    :returns: {"length": n, "datetime_columns": [...], "columns": {name: [values]}}
+    """
+    columns: Dict[str, list] = {}
+    datetime_columns = []
+    for name in df.columns:
+        series = df[name]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            datetime_columns.append(name)
+            values = series.dt.tz_convert("UTC").dt.tz_localize(None) if series.dt.tz is not None else series
+            columns[name] = values.to_numpy().astype("datetime64[ms]").astype("int64").tolist()
+        elif pd.api.types.is_float_dtype(series):
+            array = series.to_numpy()
+            nan_mask = np.isnan(array)
+            if nan_mask.any():
+                # NaN is not valid json
+                array = np.where(nan_mask, None, array)
+            columns[name] = array.tolist()
+        else:
+            columns[name] = series.tolist()
+    return {"length": len(df), "datetime_columns": datetime_columns, "columns": columns}
+
+def from_columns(payload: dict) -> pd.DataFrame:
+    """
+    Convert column oriented json (see to_columns) back to a dataframe
+
+    :param payload: Dict created by to_columns
+    :returns: Dataframe of a stock
+    """
+    df = pd.DataFrame(payload["columns"])
+    for name in payload.get("datetime_columns", []):
+        df[name] = pd.to_datetime(df[name], unit="ms", utc=True)
+    return df
+
+def to_arrow(df: pd.DataFrame) -> bytes:
+    """
+    :param df: Dataframe of a stock
+    :returns: Arrow IPC stream of the dataframe
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def from_arrow(content: bytes) -> pd.DataFrame:
+    """
+    :param content: Arrow IPC stream (see to_arrow)
+    :returns: Dataframe of a stock
+    """
+    import pyarrow as pa
+
+    return pa.ipc.open_stream(content).read_all().to_pandas()
+
+def to_parquet(df: pd.DataFrame) -> bytes:
+    """
+    :param df: Dataframe of a stock
+    :returns: Parquet file of the dataframe
+    """
+    buffer = BytesIO()
+    df.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+def dataframe_response(df: pd.DataFrame, data_format: DataFormats) -> Response:
+    """
+    Serialize a dataframe in a format without going through per row dicts
+
+    :param df: Dataframe of a stock
+    :param data_format: Format to respond with
+    :returns: Response with the serialized dataframe
+    """
+    if data_format in (DataFormats.arrow, DataFormats.parquet):
+        try:
+            content = to_arrow(df) if data_format == DataFormats.arrow else to_parquet(df)
+            return Response(content=content, media_type=data_format.value)
+        except ImportError as error:
+            logger.warning(f"pyarrow is not installed, responding with columns instead of {data_format.name}: {error}")
+            data_format = DataFormats.columns
+
+    if data_format == DataFormats.columns:
+        content = json.dumps(to_columns(df), separators=(",", ":"))
+    else:
+        content = df.to_json(orient="records", date_format="iso")
+    return Response(content=content, media_type=data_format.value)
+
+async def ndjson_stream(chunks: AsyncIterator[pd.DataFrame]) -> AsyncGenerator[bytes, None]:
+    """
+    Encode dataframe chunks as newline delimited json, one column oriented object (see to_columns) per line
+
+    :param chunks: Async iterator of dataframes
+    :returns: Async generator of encoded lines
+    """
+    async for chunk in chunks:
+        yield json.dumps(to_columns(chunk), separators=(",", ":")).encode("utf-8") + b"\n"
+
+class ChunkCollector:
+    """
+    Write only file object that keeps written bytes until they are taken out
+    """
+    def __init__(self):
+        self.parts: list = []
+        self.closed: bool = False
+
+    def write(self, data: bytes) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+async def arrow_stream(chunks: AsyncIterator[pd.DataFrame]) -> AsyncGenerator[bytes, None]:
+    """
+    Encode dataframe chunks as one Arrow IPC stream, one record batch per chunk
+
+    :param chunks: Async iterator of dataframes (all with the same columns)
+    :returns: Async generator of the stream's bytes
+    """
+    import pyarrow as pa
+
+    collector = ChunkCollector()
+    writer = None
+    async for chunk in chunks:
+        batch = pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            # the schema is known only once the first chunk arrives
+            writer = pa.ipc.new_stream(pa.PythonFile(collector, mode="w"), batch.schema)
+        writer.write_batch(batch)
+        yield collector.take()
+    if writer is not None:
+        writer.close()
+        yield collector.take()
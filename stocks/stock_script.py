@@ -1,14 +1,22 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial
 from enum import Enum
-from typing import Union, override, List, Literal
+from typing import Union, override, List, Literal, Dict, Tuple, AsyncGenerator
 from datetime import datetime, timedelta
 
-import yfinance as yf
 import pandas as pd
-import matplotlib.pyplot as plt
 from matplotlib import use as matplotlib_use
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.figure import Figure
 
 from utils.server_protocol import logger
+from stocks.providers import StockProvider, YFinanceProvider, to_utc_timestamp
+from data.database_models import generate_stock_table_for_stocksbase_by_ticker
+from stocks.bar_store import BarStore, interval_to_seconds, is_intraday_interval, to_epoch_seconds
+from utils.single_flight import SingleFlight
 
 
 matplotlib_use("svg")
@@ -16,37 +24,131 @@ matplotlib_use("svg")
 class Constants(Enum):
     default_start_time = datetime.now() - timedelta(days=10, hours=1)
     default_end_time = datetime.now()
+    # Threads dedicated to provider fetches, so they never take workers from other endpoints
+    provider_max_workers = 8
+    # Seconds a single stock data request may take before giving up
+    provider_timeout = 30.0
+    # Bars in each slice of a streamed range
+    stream_chunk_bars = 5000
+
+# Intervals coarser bars can be resampled from, finest first
+RESAMPLE_SOURCE_INTERVALS = ["1m", "2m", "5m", "15m", "30m", "60m", "1h", "1d"]
+# Calendar intervals -> pandas resample rule, they are resampled from daily bars
+CALENDAR_RESAMPLE_RULES = {"1wk": "W-MON", "1mo": "MS", "3mo": "QS"}
+# Column -> how bars are merged into a coarser bar
+OHLCV_AGGREGATIONS = {"Open": "first", "High": "max", "Low": "min", "Close": "last", "Adj Close": "last", "Volume": "sum"}
+
+def get_resample_sources(interval: str) -> List[str]:
+    """
+    :param interval: Interval (yFinance Interval). E.g: 1h, 1wk
+    :returns: Finer intervals that can be resampled to interval, coarsest (fewest bars to read) first
+    """
+    if interval in CALENDAR_RESAMPLE_RULES:
+        return ["1d"]
+    if not is_intraday_interval(interval):
+        # daily bars are not derived from intraday ones, their adjusted close and session differ
+        return []
+    seconds = interval_to_seconds(interval)
+    return [
+        source for source in reversed(RESAMPLE_SOURCE_INTERVALS)
+        if interval_to_seconds(source) < seconds and seconds % interval_to_seconds(source) == 0
+    ]
+
+def resample_ohlcv(bars: pd.DataFrame, interval: str) -> pd.DataFrame:
+    """
+    Merge bars into bars of a coarser interval - first open, highest high, lowest low, last close and summed volume.
+    Intraday buckets start at each day's first bar (the session's open, like yfinance's hourly bars start at 9:30),
+    calendar intervals start on mondays, months and quarters
+
+    :param bars: Dataframe of bars indexed by datetime (see BarStore.read_bars)
+    :param interval: Interval (yFinance Interval) to resample to. E.g: 1h, 1wk
+    :returns: Dataframe of the coarser bars, indexed like bars
+    """
+    aggregations = {column: how for column, how in OHLCV_AGGREGATIONS.items() if column in bars.columns}
+    if bars.empty:
+        return bars.copy()
+    if interval in CALENDAR_RESAMPLE_RULES:
+        grouped = bars.resample(CALENDAR_RESAMPLE_RULES[interval], label="left", closed="left")
+        resampled = grouped.agg(aggregations)
+        # calendar periods without any bar (e.g. a month the stock did not trade) are dropped
+        return resampled[grouped.size() > 0]
+
+    step = interval_to_seconds(interval)
+    index = pd.DatetimeIndex(bars.index)
+    utc_index = index.tz_convert("UTC") if index.tz is not None else index.tz_localize("UTC")
+    seconds = ((utc_index - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).to_numpy()
+    days = seconds - seconds % (24 * 60 * 60)
+    time_of_day = seconds - days
+    day_open = pd.Series(time_of_day).groupby(days).transform("min").to_numpy()
+    buckets = days + day_open + (time_of_day - day_open) // step * step
+
+    resampled = bars.groupby(buckets).agg(aggregations)
+    resampled_index = pd.to_datetime(resampled.index.to_numpy(), unit="s", utc=True)
+    if index.tz is None:
+        resampled_index = resampled_index.tz_localize(None)
+    elif str(index.tz) != "UTC":
+        resampled_index = resampled_index.tz_convert(index.tz)
+    resampled.index = pd.DatetimeIndex(resampled_index, name=bars.index.name)
+    return resampled
 
 class StockPuller:
+    # Bars are served from the local bar cache, which downloads missing ranges from the provider
+    bar_store: BarStore = BarStore(provider=YFinanceProvider())
+    # Bounded executor that runs blocking fetches for the async path
+    executor: ThreadPoolExecutor = ThreadPoolExecutor(
+        max_workers=Constants.provider_max_workers.value, thread_name_prefix="stock_puller"
+    )
+    # Coalesces identical concurrent requests into one fetch, results are shared and read only
+    flights: SingleFlight = SingleFlight("stock_data")
+
+    @staticmethod
+    def set_provider(provider: StockProvider) -> None:
+        """
+        Swap the market data provider. E.g: StaticProvider to work offline
+
+        :param provider: Provider that the bar cache downloads missing ranges from
+        """
+        StockPuller.bar_store.provider = provider
+
     @staticmethod
-    def get_stock(ticker: str = None, start: datetime = None, end: datetime = None, interval: str = None) -> Union[pd.DataFrame, None]:
+    def get_stock(ticker: str = None, start: datetime = None, end: datetime = None, interval: str = None, use_cache: bool = True) -> Union[pd.DataFrame, None]:
         """
-        Get a dataframe of a stock - pull data from yfinance
+        Get a dataframe of a stock - served from the local bar cache, missing ranges are pulled from yfinance.
+        Concurrent identical requests share one fetch, so the returned dataframe must be treated as read only
 
         :patam tickers: Stock ticker. E.g: AMZN, AAPL
         :param start: Datetime of start
         :param end: Datetime of end
         :param interval: Interval (yFinance Interval) for dataframe. E.g: 1d, 1m, 1s
+        :param use_cache: Whether to use the local bar cache or download the whole range
         :return: Dataframe of multiple stocks
         """
-        data = None
         # if there was no param specified, set default
         if ticker is None:
             ticker = "AAPL"
             logger.warning(f"No ticker specified defaulting to {ticker}")
-        if start is None:
-            start = Constants.default_start_time.value
-            logger.warning(f"No start date specified defaulting to {start}")
-        if end is None:
-            end = Constants.default_end_time.value
-            logger.warning(f"No end date specified defaulting to {end}")
-        if interval is None:
-            interval = "30m"
-            logger.warning(f"No interval specified defaulting to {interval}")
+        start, end, interval = StockPuller.get_default_range(start, end, interval)
+
+        # identical requests that are already in flight share its result
+        return StockPuller.flights.do(
+            ("stock", ticker, start, end, interval, use_cache),
+            partial(StockPuller.fetch_stock, ticker=ticker, start=start, end=end, interval=interval, use_cache=use_cache)
+        )
 
+    @staticmethod
+    def fetch_stock(ticker: str, start: datetime, end: datetime, interval: str, use_cache: bool = True) -> Union[pd.DataFrame, None]:
+        """
+        Fetch a dataframe of a stock without coalescing, see get_stock
+        """
+        data = None
         try:
-            data = yf.download(tickers=[ticker],start=start,end=end,interval=interval)
-            logger.info(f"Downloaded {ticker} data successfully")
+            if use_cache:
+                data = StockPuller.get_resampled_bars(ticker=ticker, start=start, end=end, interval=interval)
+                if data is None:
+                    data = StockPuller.bar_store.get_bars(ticker=ticker, start=start, end=end, interval=interval)
+            else:
+                data = StockPuller.bar_store.provider.download([ticker], start, end, interval)[ticker]
+            logger.info(f"Got {ticker} data successfully")
         except Exception as error:
             logger.exception(f"Error getting stocks, error: \n{error}")
         finally:
@@ -58,34 +160,221 @@ class StockPuller:
                 return data
     
     @staticmethod
-    def get_stock_plt_figure(df: pd.DataFrame, plot_type: str = "Adj Close") -> plt.Figure:
+    def get_stocks(tickers: List[str], start: datetime = None, end: datetime = None, interval: str = None) -> Tuple[Dict[str, pd.DataFrame], Dict[str, str]]:
+        """
+        Get dataframes of many stocks with one range and interval.
+        Missing ranges are downloaded with a single grouped provider call instead of one call per ticker.
+
+        :param tickers: List of stock tickers. E.g: [AMZN, AAPL]
+        :param start: Datetime of start
+        :param end: Datetime of end
+        :param interval: Interval (yFinance Interval) for dataframes. E.g: 1d, 1m
+        :returns: Dict of ticker -> dataframe, dict of ticker -> error for tickers that failed
+        """
+        start, end, interval = StockPuller.get_default_range(start, end, interval)
+        return StockPuller.flights.do(
+            ("stocks", tuple(tickers), start, end, interval),
+            partial(StockPuller.fetch_stocks, tickers=tickers, start=start, end=end, interval=interval)
+        )
+
+    @staticmethod
+    def fetch_stocks(tickers: List[str], start: datetime, end: datetime, interval: str) -> Tuple[Dict[str, pd.DataFrame], Dict[str, str]]:
+        """
+        Fetch dataframes of many stocks without coalescing, see get_stocks
+        """
+        frames: Dict[str, pd.DataFrame] = {}
+        for ticker in tickers:
+            resampled = StockPuller.get_resampled_bars(ticker=ticker, start=start, end=end, interval=interval)
+            if resampled is not None:
+                frames[ticker] = resampled
+        try:
+            missing = [ticker for ticker in tickers if ticker not in frames]
+            fetched, errors = StockPuller.bar_store.get_bars_many(tickers=missing, start=start, end=end, interval=interval)
+            frames.update(fetched)
+        except Exception as error:
+            logger.exception(f"Error getting stocks {tickers}, error: \n{error}")
+            return {}, {ticker: f"Failed getting data: {error}" for ticker in tickers}
+        logger.info(f"Got data of {len(frames)} stocks successfully, {len(errors)} failed")
+        return {ticker: frame.reset_index() for ticker, frame in frames.items()}, errors
+
+    @staticmethod
+    def get_resampled_bars(ticker: str, start: datetime, end: datetime, interval: str) -> Union[pd.DataFrame, None]:
+        """
+        Serve bars of an interval by resampling a finer interval that is cached for the whole range, without any download.
+        E.g: 1h bars after 5m bars of the range were requested
+
+        :returns: Dataframe of bars indexed by datetime, None if no finer cached interval covers the range
+        """
+        try:
+            sources = get_resample_sources(interval)
+            if not sources or not generate_stock_table_for_stocksbase_by_ticker(ticker, StockPuller.bar_store.engine):
+                return None
+            start_ts = to_epoch_seconds(start)
+            end_ts = to_epoch_seconds(end)
+            for source in sources:
+                coverage = StockPuller.bar_store.get_coverage(ticker, source)
+                # the source's forming bar is never covered, it is read like any cached bar
+                if coverage is None or coverage[0] > start_ts or coverage[1] < min(end_ts, time.time() - interval_to_seconds(source)):
+                    continue
+                # read from the start of the day when cached, so the first day's buckets start at the session's open
+                read_start = max(coverage[0], start_ts - start_ts % (24 * 60 * 60))
+                resampled = resample_ohlcv(StockPuller.bar_store.read_bars(ticker, source, read_start, end_ts), interval)
+                # like cached bars, only bars starting in the range are served
+                first = pd.Timestamp(start_ts, unit="s", tz="UTC")
+                resampled = resampled[resampled.index >= (first if resampled.index.tz is not None else first.tz_localize(None))]
+                logger.debug(f"Resampled {interval} bars of {ticker} from cached {source} bars")
+                return resampled
+        except Exception as error:
+            logger.error(f"Failed resampling {interval} bars of {ticker}: {error}")
+        return None
+
+    @staticmethod
+    async def get_stock_async(ticker: str = None, start: datetime = None, end: datetime = None, interval: str = None, timeout: float = None) -> Union[pd.DataFrame, None]:
         """
-        Generate a plt figure from a pandas dataframe, based on a plot type which is one of OHLCVT
+        Non blocking version of get_stock - runs the fetch on StockPuller's bounded executor.
+        Identical concurrent requests wait on one in flight fetch instead of taking executor threads.
+        Once every waiting request was cancelled or timed out, a fetch that did not start yet is dropped from the executor's queue.
 
-        CURRENTLY SUPPORTING ONLY Adj Close
+        :param timeout: Seconds to wait before raising TimeoutError, defaults to Constants.provider_timeout
+        :returns: Same as get_stock
+        """
+        if ticker is None:
+            ticker = "AAPL"
+            logger.warning(f"No ticker specified defaulting to {ticker}")
+        start, end, interval = StockPuller.get_default_range(start, end, interval)
+        if timeout is None:
+            timeout = Constants.provider_timeout.value
+        loop = asyncio.get_running_loop()
+        return await StockPuller.flights.do_async(
+            ("stock", ticker, start, end, interval, True),
+            lambda: loop.run_in_executor(
+                StockPuller.executor, partial(StockPuller.fetch_stock, ticker=ticker, start=start, end=end, interval=interval)
+            ),
+            timeout=timeout
+        )
+
+    @staticmethod
+    async def get_stocks_async(tickers: List[str], start: datetime = None, end: datetime = None, interval: str = None, timeout: float = None) -> Tuple[Dict[str, pd.DataFrame], Dict[str, str]]:
+        """
+        Non blocking version of get_stocks - runs the fetch on StockPuller's bounded executor
+
+        :param timeout: Seconds to wait before raising TimeoutError, defaults to Constants.provider_timeout
+        :returns: Same as get_stocks
+        """
+        start, end, interval = StockPuller.get_default_range(start, end, interval)
+        if timeout is None:
+            timeout = Constants.provider_timeout.value
+        loop = asyncio.get_running_loop()
+        return await StockPuller.flights.do_async(
+            ("stocks", tuple(tickers), start, end, interval),
+            lambda: loop.run_in_executor(
+                StockPuller.executor, partial(StockPuller.fetch_stocks, tickers=tickers, start=start, end=end, interval=interval)
+            ),
+            timeout=timeout
+        )
+
+    @staticmethod
+    def get_time_slices(start: datetime, end: datetime, interval: str, chunk_bars: int = None) -> List[Tuple[datetime, datetime]]:
+        """
+        Split a range into consecutive time slices of about chunk_bars bars each
+
+        :param start: Datetime of start
+        :param end: Datetime of end
+        :param interval: Interval (yFinance Interval). E.g: 1d, 1m
+        :param chunk_bars: Bars per slice, defaults to Constants.stream_chunk_bars
+        :returns: List of [start, end) slices covering the range
+        """
+        if chunk_bars is None or chunk_bars <= 0:
+            chunk_bars = Constants.stream_chunk_bars.value
+        slice_length = timedelta(seconds=interval_to_seconds(interval) * chunk_bars)
+        slices: List[Tuple[datetime, datetime]] = []
+        slice_start = start
+        while slice_start < end:
+            slice_end = min(slice_start + slice_length, end)
+            slices.append((slice_start, slice_end))
+            slice_start = slice_end
+        return slices
+
+    @staticmethod
+    async def stream_stock_async(ticker: str = None, start: datetime = None, end: datetime = None, interval: str = None, chunk_bars: int = None, timeout: float = None) -> AsyncGenerator[pd.DataFrame, None]:
+        """
+        Get a stock's range slice by slice, so only one slice is held in memory at a time.
+        Every slice is fetched through the bar cache on StockPuller's bounded executor.
+
+        :param chunk_bars: Bars per slice, defaults to Constants.stream_chunk_bars
+        :param timeout: Seconds each slice may take before raising TimeoutError, defaults to Constants.provider_timeout
+        :returns: Async generator of dataframes (same columns as get_stock), empty slices are skipped
+        """
+        if ticker is None:
+            ticker = "AAPL"
+            logger.warning(f"No ticker specified defaulting to {ticker}")
+        start, end, interval = StockPuller.get_default_range(start, end, interval)
+        if timeout is None:
+            timeout = Constants.provider_timeout.value
+        loop = asyncio.get_running_loop()
+        for slice_start, slice_end in StockPuller.get_time_slices(start, end, interval, chunk_bars):
+            chunk = await asyncio.wait_for(
+                loop.run_in_executor(
+                    StockPuller.executor,
+                    partial(StockPuller.bar_store.get_bars, ticker=ticker, start=slice_start, end=slice_end, interval=interval)
+                ),
+                timeout=timeout
+            )
+            if not chunk.empty:
+                yield chunk.reset_index()
+
+    @staticmethod
+    def get_default_range(start: datetime = None, end: datetime = None, interval: str = None) -> Tuple[datetime, datetime, str]:
+        """
+        Fill in defaults for a range and interval that were not specified.
+        Both bounds are returned tz aware (UTC), so a tz aware bound can be compared with a naive (local time) one
+
+        :returns: start, end, interval
+        """
+        if start is None:
+            start = Constants.default_start_time.value
+            logger.warning(f"No start date specified defaulting to {start}")
+        if end is None:
+            end = Constants.default_end_time.value
+            logger.warning(f"No end date specified defaulting to {end}")
+        if interval is None:
+            interval = "30m"
+            logger.warning(f"No interval specified defaulting to {interval}")
+        return to_utc_timestamp(start).to_pydatetime(), to_utc_timestamp(end).to_pydatetime(), interval
+
+    @staticmethod
+    def validate_range(start: datetime, end: datetime, interval: str) -> None:
+        """
+        Check a range before it is fetched, e.g. before a stream's response starts
+
+        :param start: Datetime of start, as returned by get_default_range
+        :param end: Datetime of end, as returned by get_default_range
+        :param interval: Interval (yFinance Interval). E.g: 1d, 1m
+        :raises ValueError: If the interval is not supported or the range is empty
+        """
+        interval_to_seconds(interval)
+        if start >= end:
+            raise ValueError(f"Start {start} must be before end {end}")
+
+    @staticmethod
+    def get_stock_plt_figure(df: pd.DataFrame, plot_type: str = "Adj Close") -> Figure:
+        """
+        Generate a figure from a pandas dataframe, based on a plot type which is one of OHLCV.
+        The figure is not registered with pyplot, so it is freed once it is not referenced anymore.
+        Prefer stocks.charts.get_chart_svg, which reuses figures and caches the rendered charts
 
         :param df: Pandas dataframe of a stock
-        :param plot_type: Plot type - one of OHLCVT
-        :returns: Plt figure (sv)
+        :param plot_type: Plot type - one of OHLCV (see stocks.charts.PLOT_TYPES)
+        :returns: Figure (svg)
         """
+        # charts uses StockPuller, so it is imported here
+        from stocks.charts import draw_chart, get_chart_series
+
         try:
-            # Create a new figure and axis object
-            fig, ax = plt.subplots(figsize=(10, 10))
-            
-            # Plot the data on the axis
-            ((df[plot_type].pct_change()+1).cumprod()).plot(ax=ax)
-            ax.legend()
-            ax.set_title(plot_type, fontsize=16)
-
-            # Define the labels
-            ax.set_ylabel(f"{plot_type} value", fontsize=14)
-            ax.set_xlabel('Time', fontsize=14)
-
-            # Plot the grid lines
-            ax.grid(which="major", color='k', linestyle='-.', linewidth=0.5)
-            
+            fig = Figure(figsize=(10, 10))
+            FigureCanvasSVG(fig)
+            draw_chart(fig, get_chart_series(df, plot_type), plot_type)
         except Exception as error:
-            logger.exception(f"Exception in getting plt stock figure: {error}")
-            fig = plt.figure()
+            logger.exception(f"Exception in getting stock figure: {error}")
             return None
-        return fig
\ No newline at end of file
+        return fig
@@ -0,0 +1,138 @@
+from typing import Dict, List, Tuple
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import data.database_models as db_m
+from stocks.stock_script import StockPuller
+from utils.logger_script import logger
+
+
+def latest_prices(frames: Dict[str, pd.DataFrame], price_column: str = "Close") -> pd.Series:
+    """
+    :param frames: Dict of ticker -> dataframe from StockPuller.get_stocks
+    :param price_column: Column to take the price from
+    :returns: Series of ticker -> last available price
+    """
+    prices = {
+        ticker: frame[price_column].dropna().iloc[-1]
+        for ticker, frame in frames.items() if not frame.empty and frame[price_column].notna().any()
+    }
+    return pd.Series(prices, dtype=float)
+
+def close_prices(frames: Dict[str, pd.DataFrame], price_column: str = "Close") -> pd.DataFrame:
+    """
+    Align the prices of many stocks on one time index
+
+    :param frames: Dict of ticker -> dataframe from StockPuller.get_stocks
+    :param price_column: Column to take the prices from
+    :returns: Dataframe indexed by epoch seconds with a column per ticker, gaps forward filled
+    """
+    series = {}
+    for ticker, frame in frames.items():
+        if frame.empty:
+            continue
+        time_column = frame.columns[0]
+        times = pd.to_datetime(frame[time_column], utc=True)
+        index = (times - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+        series[ticker] = pd.Series(frame[price_column].to_numpy(dtype=float), index=index.to_numpy())
+    if not series:
+        return pd.DataFrame()
+    prices = pd.DataFrame(series).sort_index()
+    return prices[~prices.index.duplicated(keep="last")].ffill()
+
+def value_positions(positions: pd.DataFrame, prices: pd.Series) -> Tuple[pd.DataFrame, dict]:
+    """
+    Mark positions to market, vectorized over all positions at once
+
+    :param positions: Dataframe of ticker, quantity, average_cost and realized_pnl
+    :param prices: Series of ticker -> latest price
+    :returns: Positions with price, market_value, cost_basis, unrealized_pnl and weight columns, and portfolio totals
+    """
+    valued = positions.copy()
+    valued["price"] = prices.reindex(valued["ticker"]).to_numpy()
+    valued["market_value"] = valued["quantity"] * valued["price"]
+    valued["cost_basis"] = valued["quantity"] * valued["average_cost"]
+    valued["unrealized_pnl"] = valued["market_value"] - valued["cost_basis"]
+    gross_exposure = valued["market_value"].abs().sum()
+    valued["weight"] = valued["market_value"] / gross_exposure if gross_exposure else 0.0
+
+    totals = {
+        "market_value": float(valued["market_value"].sum()),
+        "cost_basis": float(valued["cost_basis"].sum()),
+        "unrealized_pnl": float(valued["unrealized_pnl"].sum()),
+        "realized_pnl": float(valued["realized_pnl"].sum()),
+        "missing_prices": valued.loc[valued["price"].isna(), "ticker"].tolist(),
+    }
+    totals["total_pnl"] = totals["unrealized_pnl"] + totals["realized_pnl"]
+    return valued, totals
+
+def equity_curve(trades: pd.DataFrame, prices: pd.DataFrame) -> pd.DataFrame:
+    """
+    Value a user's holdings at every bar. Holdings at a bar are the sum of all trades up to (and including) it
+
+    :param trades: Dataframe of timestamp, ticker, action, amount and price (epoch seconds timestamps)
+    :param prices: Dataframe from close_prices - indexed by epoch seconds with a column per ticker
+    :returns: Dataframe indexed by epoch seconds with market_value, cash_flow (cash spent and received by trades)
+              and pnl (market_value + cash_flow) columns
+    """
+    if prices.empty:
+        return pd.DataFrame(columns=["market_value", "cash_flow", "pnl"])
+    bar_times = prices.index.to_numpy()
+    trades = trades.sort_values("timestamp", kind="stable")
+    signed_amounts = np.where(trades["action"].to_numpy() == "buy", 1.0, -1.0) * trades["amount"].to_numpy(dtype=float)
+    trade_times = trades["timestamp"].to_numpy()
+
+    # index of the last trade at or before every bar
+    last_trade = np.searchsorted(trade_times, bar_times, side="right") - 1
+
+    # cumulative quantity of every ticker after every trade, a row per trade (and a row of zeros before the first)
+    ticker_codes = pd.Categorical(trades["ticker"], categories=prices.columns).codes
+    changes = np.zeros((len(trades) + 1, len(prices.columns)))
+    has_price = ticker_codes >= 0
+    changes[np.arange(1, len(trades) + 1)[has_price], ticker_codes[has_price]] = signed_amounts[has_price]
+    held = np.cumsum(changes, axis=0)[last_trade + 1]
+    cash = np.concatenate([[0.0], np.cumsum(-signed_amounts * trades["price"].to_numpy(dtype=float))])[last_trade + 1]
+
+    market_value = np.nansum(held * prices.to_numpy(), axis=1)
+    return pd.DataFrame({
+        "market_value": market_value,
+        "cash_flow": cash,
+        "pnl": market_value + cash,
+    }, index=pd.Index(bar_times, name="timestamp"))
+
+def get_portfolio_valuation(user_id: str, start: datetime = None, end: datetime = None, interval: str = None) -> dict:
+    """
+    Value a user's portfolio: the user's positions are joined with the latest bars of all held
+    tickers (one batched lookup), and the equity curve is computed over the requested range
+
+    :param user_id: A user's GUID
+    :param start: Datetime of the equity curve's start
+    :param end: Datetime of the equity curve's end
+    :param interval: Interval (yFinance Interval) of the equity curve
+    :returns: Dict of positions (valued), totals, equity_curve (dataframe) and errors (ticker -> error)
+    """
+    positions = pd.DataFrame(
+        db_m.get_positions_by_id(user_id, include_closed=True),
+        columns=["ticker", "quantity", "average_cost", "realized_pnl", "updated_at"]
+    )
+    trades = pd.DataFrame(
+        db_m.get_users_stocks_by_id(user_id), columns=["timestamp", "ticker", "action", "amount", "price"]
+    )
+    tickers: List[str] = sorted(set(positions["ticker"]) | set(trades["ticker"]))
+    if not tickers:
+        return {"positions": positions, "totals": value_positions(positions, pd.Series(dtype=float))[1],
+                "equity_curve": equity_curve(trades, pd.DataFrame()), "errors": {}}
+
+    frames, errors = StockPuller.get_stocks(tickers=tickers, start=start, end=end, interval=interval)
+    if errors:
+        logger.warning(f"Could not get prices of {list(errors)} for the valuation of user {user_id}")
+
+    valued, totals = value_positions(positions, latest_prices(frames))
+    return {
+        "positions": valued,
+        "totals": totals,
+        "equity_curve": equity_curve(trades, close_prices(frames)),
+        "errors": errors,
+    }
@@ -0,0 +1,73 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+from sqlalchemy.engine import make_url
+
+# caches and locks shared by the worker processes stay out of the working directory
+os.environ.setdefault("SHARED_CACHE_DIRECTORY", tempfile.mkdtemp(prefix="shared_cache_"))
+# user whose tokens the admin endpoints accept
+os.environ.setdefault("ADMIN_USER_IDS", "admin")
+
+# the utils package is imported first, like the server does (its modules import data)
+import utils
+from data import database, database_models
+from data.database import create_database_engine, db_metadata
+
+
+def use_engine(monkeypatch: pytest.MonkeyPatch, engine) -> None:
+    """
+    Point every database (and the sessions and modules bound to them) at one engine
+    """
+    for name in database.DATABASE_ENGINES:
+        monkeypatch.setitem(database.DATABASE_ENGINES, name, engine)
+    monkeypatch.setattr(database, "async_sessionmakers", {})
+    for module in (database, database_models):
+        monkeypatch.setattr(module, "db_engine_users_stocks", engine)
+        monkeypatch.setattr(module, "db_engine_stocksbase", engine)
+    monkeypatch.setattr(database, "db_engine_userbase", engine)
+    for sessions in (database.db_sessionmaker_userbase, database.db_sessionmaker_users_stocks):
+        monkeypatch.setitem(sessions.kw, "bind", engine)
+
+@pytest.fixture(scope="session")
+def postgres_url():
+    """
+    Url of a Postgres database to test against - TEST_POSTGRES_URL, or an embedded server started with pgserver.
+    None when neither is available
+    """
+    url = os.getenv("TEST_POSTGRES_URL")
+    if url:
+        yield url
+        return
+    try:
+        import pgserver
+    except ImportError:
+        yield None
+        return
+    server = pgserver.get_server(tempfile.mkdtemp(prefix="pgdata_"), cleanup_mode="stop")
+    yield str(make_url(server.get_uri()).set(drivername="postgresql+psycopg"))
+    server.cleanup()
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def database_engine(request, tmp_path, monkeypatch):
+    """
+    Engine of an empty database with the schema created, used by every database of the application.
+    Tests run against sqlite and Postgres, Postgres is skipped when it is not available
+    """
+    if request.param == "sqlite":
+        url = f"sqlite:///{tmp_path / 'test.sqlite'}"
+    else:
+        url = request.getfixturevalue("postgres_url")
+        if url is None:
+            pytest.skip("No Postgres to test against, install pgserver or set TEST_POSTGRES_URL")
+    engine = create_database_engine(url)
+    db_metadata.drop_all(bind=engine)
+    use_engine(monkeypatch, engine)
+    database_models.create_schema()
+    yield engine
+    for sessions in database.async_sessionmakers.values():
+        # the async connections belong to a loop that is closed by now, they are dropped without closing them
+        asyncio.run(sessions.kw["bind"].dispose(close=False))
+    db_metadata.drop_all(bind=engine)
+    engine.dispose()
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from stocks import backtest
+
+
+def test_rolling_mean_skips_windows_with_missing_prices():
+    prices = np.array([[np.nan], [np.nan], [1.0], [2.0], [3.0], [np.nan], [5.0]])
+    means = backtest.rolling_mean(prices, 2)[:, 0]
+    assert np.isnan(means[:3]).all()
+    assert means[3] == 1.5 and means[4] == 2.5
+    assert np.isnan(means[5]) and np.isnan(means[6])
+
+def test_sma_crossover_waits_for_real_prices():
+    # a ticker whose history starts later has leading NaNs (close_prices only forward fills)
+    prices = np.array([[np.nan]] * 5 + [[100.0]] * 10)
+    targets = backtest.sma_crossover(prices, fast=2, slow=4)
+    assert not targets.any()
+
+def test_sweep_reuses_one_process_pool():
+    prices = pd.DataFrame({"AAPL": np.linspace(100.0, 120.0, 200) + np.sin(np.arange(200))})
+    try:
+        first = backtest.sweep(prices, "sma_crossover", {"fast": [2, 5], "slow": [10, 20]}, interval="1d", max_workers=2)
+        executor = backtest.sweep_executor
+        second = backtest.sweep(prices, "sma_crossover", {"fast": [2, 5], "slow": [10, 20]}, interval="1d", max_workers=2)
+        assert executor is not None and backtest.sweep_executor is executor
+    finally:
+        backtest.shutdown_sweep_executor()
+    in_process = backtest.sweep(prices, "sma_crossover", {"fast": [2, 5], "slow": [10, 20]}, interval="1d", max_workers=1)
+    pd.testing.assert_frame_equal(first, second)
+    pd.testing.assert_frame_equal(first, in_process)
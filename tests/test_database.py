@@ -0,0 +1,102 @@
+from datetime import datetime, timezone
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import inspect
+
+from data import database_models
+from data.database import DATABASE_ENGINES, get_upsert_insert
+from stocks.bar_store import BarStore
+from stocks.providers import OHLCV_COLUMNS, StaticProvider
+from utils import auth
+import utils.server_protocol as sp
+
+
+def make_bars(start: str, periods: int, scale: float = 1.0) -> pd.DataFrame:
+    index = pd.date_range(start, periods=periods, freq="D", tz="UTC")
+    return pd.DataFrame({column: [scale * (day + 1) for day in range(periods)] for column in OHLCV_COLUMNS}, index=index)
+
+def test_create_schema_is_idempotent(database_engine):
+    database_models.create_schema()
+    for name, engine in DATABASE_ENGINES.items():
+        tables = {table.name for table in database_models.db_metadata.sorted_tables if table.info.get("database") == name}
+        assert tables <= set(inspect(engine).get_table_names())
+    # email and username are looked up through their unique constraints, without a second index
+    unique = {tuple(constraint["column_names"]) for constraint in inspect(database_engine).get_unique_constraints("Userbase")}
+    assert {("email",), ("username",)} <= unique
+    indexes = inspect(database_engine).get_indexes("Userbase")
+    assert not [index for index in indexes if index["column_names"] in (["email"], ["username"]) and "duplicates_constraint" not in index]
+
+def test_upserts_replace_bars_and_coverage(database_engine):
+    assert get_upsert_insert(database_engine) is not None
+    store = BarStore(provider=StaticProvider({}), engine=database_engine)
+    assert database_models.generate_stock_table_for_stocksbase_by_ticker("AAPL", database_engine)
+    assert store.store_bars("AAPL", "1d", make_bars("2024-01-01", 3)) == 3
+    assert store.store_bars("AAPL", "1d", make_bars("2024-01-02", 3, scale=10.0)) == 3
+    store.set_coverage("AAPL", "1d", (1, 2))
+    store.set_coverage("AAPL", "1d", (1, 3))
+    assert store.get_coverage("AAPL", "1d") == (1, 3)
+    bars = store.read_bars("AAPL", "1d", 0, 2 ** 31 - 1)
+    assert bars["Close"].tolist() == [1.0, 10.0, 20.0, 30.0]
+
+def test_missing_ranges_are_downloaded_once(database_engine):
+    provider = StaticProvider({"AAPL": make_bars("2024-01-01", 10)})
+    store = BarStore(provider=provider, engine=database_engine)
+    start, end = datetime(2024, 1, 2, tzinfo=timezone.utc), datetime(2024, 1, 6, tzinfo=timezone.utc)
+    first = store.get_bars("AAPL", start, end, "1d")
+    second = store.get_bars("AAPL", start, end, "1d")
+    assert len(provider.calls) == 1
+    assert first["Close"].tolist() == second["Close"].tolist() == [2.0, 3.0, 4.0, 5.0]
+
+@pytest.fixture
+def client(database_engine, monkeypatch):
+    """
+    Client of the app without its background tasks (order matching, market data and emails)
+    """
+    import server
+    monkeypatch.setattr(server.papertrading_app.router, "on_startup", [])
+    monkeypatch.setattr(server.papertrading_app.router, "on_shutdown", [])
+    with TestClient(server.papertrading_app) as client:
+        yield client
+
+def test_database_pages_through_async_session(client, database_engine):
+    with database_engine.begin() as connection:
+        connection.execute(database_models.Userbase.__table__.insert(), [
+            {"id": f"{index:04d}", "email": f"user{index}@example.org", "username": f"user{index}", "password": "hash"}
+            for index in range(5)
+        ])
+    headers = {"Authorization": f"Bearer {auth.token_signer.issue('admin')[0]}"}
+    first = client.get("/database", params={"limit": 3}, headers=headers).json()
+    assert [user["id"] for user in first["users"]] == ["0000", "0001", "0002"]
+    assert all(set(user) == {"id", "email", "username"} for user in first["users"])
+    second = client.get("/database", params={"limit": 3, "after": first["next_after"]}, headers=headers).json()
+    assert [user["id"] for user in second["users"]] == ["0003", "0004"]
+    assert second["next_after"] is None
+
+def test_database_is_for_admins_only(client):
+    assert client.get("/database").status_code == 401
+    headers = {"Authorization": f"Bearer {auth.token_signer.issue('0000')[0]}"}
+    assert client.get("/database", headers=headers).status_code == 403
+
+def test_update_user_with_token_changes_only_a_new_password(client, database_engine):
+    with database_engine.begin() as connection:
+        connection.execute(database_models.Userbase.__table__.insert(), {
+            "id": "0000", "email": "user@example.org", "username": sp.encode_string("user"), "password": auth.hash_password("old")
+        })
+    token = auth.token_signer.issue("0000")[0]
+    headers = {"Authorization": f"Bearer {token}"}
+    renamed = client.put("/update_user", params={"user_id": "0000", "username": "user", "new_username": "renamed"}, headers=headers).json()
+    assert renamed["success"]
+    # the current password is not a change, the token keeps working
+    unchanged = client.put("/update_user", params={"user_id": "0000", "username": "renamed", "new_password": "old"}, headers=headers).json()
+    assert not unchanged["success"]
+    assert auth.token_signer.verify(token) is not None
+
+    changed = client.put("/update_user", params={"user_id": "0000", "username": "renamed", "new_password": "new"}, headers=headers).json()
+    assert changed["success"]
+    with database_engine.connect() as connection:
+        stored = connection.execute(database_models.Userbase.__table__.select()).one()
+    assert stored.username == sp.encode_string("renamed")
+    assert auth.verify_password("new", stored.password)[0]
+    assert auth.token_signer.verify(token) is None
@@ -0,0 +1,62 @@
+import asyncio
+from typing import Dict, List, Union
+
+import dns.asyncresolver
+import dns.resolver
+
+from utils.email_validation import DNSResolver, EmailValidator
+
+
+class StubResolver:
+    """
+    Resolver answering from a dict of domain -> mail hosts, counting its lookups
+    """
+    def __init__(self, hosts: Dict[str, Union[List[str], None]]):
+        self.hosts: Dict[str, Union[List[str], None]] = hosts
+        self.lookups: List[str] = []
+
+    async def resolve_mx(self, domain: str) -> Union[List[str], None]:
+        self.lookups.append(domain)
+        return self.hosts.get(domain, [])
+
+def validate(validator: EmailValidator, email: str):
+    async def main():
+        verdict = await validator.validate(email)
+        # let background verifications finish
+        await asyncio.gather(*validator.background.values())
+        return verdict
+    return asyncio.run(main())
+
+def test_domain_without_mail_hosts_is_rejected():
+    resolver = StubResolver({})
+    validator = EmailValidator(resolver=resolver)
+    verdict = validate(validator, "someone@example.org")
+    assert (verdict.valid, verdict.reason, verdict.probed) == (False, "no_mx", False)
+    # the verdict is cached
+    assert validate(validator, "someone@example.org") == verdict
+    assert resolver.lookups == ["example.org"]
+
+def test_failed_lookup_is_unverified_and_accepted():
+    validator = EmailValidator(resolver=StubResolver({"example.org": None}))
+    verdict = validate(validator, "someone@example.org")
+    assert (verdict.valid, verdict.reason) == (True, "unverified")
+
+def test_well_known_domain_is_accepted_and_verified_in_the_background():
+    resolver = StubResolver({"gmail.com": None})
+    validator = EmailValidator(resolver=resolver)
+    verdict = validate(validator, "Someone@Gmail.com ")
+    assert (verdict.valid, verdict.reason) == (True, "well_known")
+    assert resolver.lookups == ["gmail.com"]
+    assert validator.background == {}
+
+def test_no_nameservers_is_no_definite_answer(monkeypatch):
+    async def resolve(self, domain, record_type, *args, **kwargs):
+        raise dns.resolver.NoNameservers()
+    monkeypatch.setattr(dns.asyncresolver.Resolver, "resolve", resolve)
+    assert asyncio.run(DNSResolver().resolve_mx("example.org")) is None
+
+def test_nxdomain_is_a_definite_answer(monkeypatch):
+    async def resolve(self, domain, record_type, *args, **kwargs):
+        raise dns.resolver.NXDOMAIN()
+    monkeypatch.setattr(dns.asyncresolver.Resolver, "resolve", resolve)
+    assert asyncio.run(DNSResolver().resolve_mx("example.org")) == []
@@ -0,0 +1,37 @@
+import time
+
+from data import database_models
+from stocks.orders import Order
+
+
+def add_open_order(user_id: str = "user") -> Order:
+    order = Order.new(user_id, "AAPL", "buy", "market", 2.0)
+    assert database_models.add_order(order.to_dict())
+    return order
+
+def fill(order: Order, amount: float, price: float) -> dict:
+    return {"order_id": order.id, "user_id": order.user_id, "timestamp": int(time.time()), "ticker": order.ticker,
+            "action": order.side, "amount": amount, "price": price}
+
+def filled_state(order: Order) -> dict:
+    return {**order.to_dict(), "filled": order.amount, "average_fill_price": 10.0, "status": "filled", "updated_at": int(time.time())}
+
+def test_fills_of_open_order_are_recorded(database_engine):
+    order = add_open_order()
+    assert database_models.record_order_fills([fill(order, 2.0, 10.0)], [filled_state(order)])
+    assert database_models.get_orders_by_id("user")[0]["status"] == "filled"
+    assert len(database_models.get_users_stocks_by_id("user")) == 1
+    assert database_models.get_positions_by_id("user")[0]["quantity"] == 2.0
+
+def test_fills_of_order_cancelled_after_matching_are_skipped(database_engine):
+    cancelled = add_open_order()
+    other = add_open_order()
+    # the user cancels (e.g. through another worker) between matching and recording the fills
+    assert database_models.cancel_order("user", cancelled.id)
+    assert database_models.record_order_fills(
+        [fill(cancelled, 2.0, 10.0), fill(other, 2.0, 10.0)], [filled_state(cancelled), filled_state(other)]
+    )
+    statuses = {order["id"]: order["status"] for order in database_models.get_orders_by_id("user")}
+    assert statuses == {cancelled.id: "cancelled", other.id: "filled"}
+    assert len(database_models.get_users_stocks_by_id("user")) == 1
+    assert database_models.get_positions_by_id("user")[0]["quantity"] == 2.0
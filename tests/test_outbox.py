@@ -0,0 +1,111 @@
+import socket
+import time
+
+import pytest
+from sqlalchemy import insert, select, update
+
+from data.database_models import email_outbox_table
+from emails.outbox import Constants, EmailOutbox, SMTPSession
+
+controller_module = pytest.importorskip("aiosmtpd.controller")
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.recipients = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.recipients.extend(envelope.rcpt_tos)
+        return "250 OK"
+
+@pytest.fixture
+def smtp_server():
+    """
+    Local SMTP stand-in that records the recipients of the emails it receives
+    """
+    handler = RecordingHandler()
+    with socket.socket() as free:
+        free.bind(("127.0.0.1", 0))
+        port = free.getsockname()[1]
+    controller = controller_module.Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    yield controller, handler
+    controller.stop()
+
+@pytest.fixture
+def outbox(database_engine, smtp_server):
+    controller, _ = smtp_server
+    session = SMTPSession(host=controller.hostname, port=controller.port, username=None, password=None, starttls=False, sender="server@example.com")
+    outbox = EmailOutbox(engine=database_engine, session=session)
+    yield outbox
+    session.close()
+    outbox.executor.shutdown()
+
+def get_rows(engine) -> dict:
+    with engine.connect() as connection:
+        return {row.email: row for row in connection.execute(select(email_outbox_table))}
+
+def test_due_emails_are_sent_on_one_session(outbox, smtp_server):
+    _, handler = smtp_server
+    for index in range(3):
+        assert outbox.enqueue(f"user{index}@example.com", "sign_up") is not None
+    assert outbox.send_due() == {"claimed": 3, "sent": 3, "retried": 0, "failed": 0}
+    assert sorted(handler.recipients) == ["user0@example.com", "user1@example.com", "user2@example.com"]
+    assert outbox.session.connections == 1
+    assert {row.status for row in get_rows(outbox.engine).values()} == {"sent"}
+    # nothing is due anymore
+    assert outbox.send_due()["claimed"] == 0
+
+def test_email_without_message_fails_on_its_own(outbox, smtp_server):
+    _, handler = smtp_server
+    outbox.enqueue("good@example.com", "sign_up")
+    now = time.time()
+    with outbox.engine.begin() as connection:
+        connection.execute(insert(email_outbox_table).values(
+            email="bad@example.com", message_type="unknown", status="pending", attempts=0, next_attempt_at=now, created_at=now
+        ))
+    assert outbox.send_due() == {"claimed": 2, "sent": 1, "retried": 1, "failed": 0}
+    assert handler.recipients == ["good@example.com"]
+    rows = get_rows(outbox.engine)
+    assert rows["good@example.com"].status == "sent"
+    assert rows["bad@example.com"].status == "pending"
+    assert rows["bad@example.com"].attempts == 1
+    assert "Failed creating message" in rows["bad@example.com"].last_error
+
+class ProgressSession:
+    """
+    Session that sends nothing, sending an email is during_send(on_progress)
+    """
+    def __init__(self, during_send):
+        self.during_send = during_send
+
+    def send(self, messages, on_progress=None) -> dict:
+        for _ in messages:
+            self.during_send(on_progress)
+        return {}
+
+    def close(self) -> None:
+        pass
+
+def test_sending_renews_the_claim(database_engine, monkeypatch):
+    monkeypatch.setattr(Constants.claim_renew_seconds, "_value_", 0.0)
+    other = EmailOutbox(engine=database_engine, session=SMTPSession(host="127.0.0.1", port=1))
+    renewals = []
+
+    def during_send(on_progress):
+        # the email takes longer than the claim timeout to send
+        stale = time.time() - Constants.claim_timeout.value - 1
+        with database_engine.begin() as connection:
+            connection.execute(update(email_outbox_table).values(claimed_at=stale))
+        on_progress()
+        claimed_at = get_rows(database_engine)["user@example.com"].claimed_at
+        # another worker does not take over the emails of a batch that is still being sent
+        renewals.append((claimed_at > stale, other.claim(time.time())))
+
+    outbox = EmailOutbox(engine=database_engine, session=ProgressSession(during_send))
+    outbox.enqueue("user@example.com", "sign_up")
+    assert outbox.send_due()["sent"] == 1
+    assert renewals == [(True, [])]
+    assert get_rows(database_engine)["user@example.com"].status == "sent"
+    outbox.executor.shutdown()
+    other.executor.shutdown()
@@ -0,0 +1,49 @@
+from data import database_models
+from data.positions import fold_trades
+
+
+USER_ID = "user"
+
+def get_stored_positions() -> dict:
+    return {position["ticker"]: position for position in database_models.get_positions_by_id(USER_ID, include_closed=True)}
+
+def test_fold_trades_opens_adds_and_reduces():
+    positions = fold_trades({}, [(1, "AAPL", "buy", 10, 10.0), (2, "AAPL", "buy", 10, 20.0), (3, "AAPL", "sell", 5, 30.0)])
+    assert positions["AAPL"]["quantity"] == 15
+    assert positions["AAPL"]["average_cost"] == 15.0
+    assert positions["AAPL"]["realized_pnl"] == 75.0
+    assert positions["AAPL"]["updated_at"] == 3
+
+def test_backfilled_trade_matches_rebuild(database_engine):
+    assert database_models.add_stock_to_users_stocks_table(USER_ID, [
+        {"timestamp": 100, "ticker": "AAPL", "action": "buy", "amount": 10, "price": 10.0},
+        {"timestamp": 200, "ticker": "AAPL", "action": "sell", "amount": 10, "price": 20.0},
+        {"timestamp": 150, "ticker": "MSFT", "action": "buy", "amount": 1, "price": 300.0},
+    ])
+    # imported history older than the positions
+    result = database_models.bulk_add_stock_records_to_users_stocks_table(USER_ID, [
+        {"timeframe": 50, "ticker": "AAPL", "action": "buy", "amount": 10, "price": 5.0},
+        {"timeframe": 300, "ticker": "MSFT", "action": "buy", "amount": 1, "price": 310.0},
+    ])
+    assert result["success"] and result["inserted"] == 2
+
+    incremental = get_stored_positions()
+    assert incremental["AAPL"]["average_cost"] == 7.5
+    assert incremental["AAPL"]["realized_pnl"] == 125.0
+    assert incremental["AAPL"]["quantity"] == 10
+    assert incremental["MSFT"]["average_cost"] == 305.0
+
+    assert database_models.rebuild_positions(USER_ID) == {}
+    assert get_stored_positions() == incremental
+
+def test_backfilled_fill_matches_rebuild(database_engine):
+    assert database_models.add_stock_to_users_stocks_table(USER_ID, [
+        {"timestamp": 100, "ticker": "AAPL", "action": "buy", "amount": 2, "price": 10.0},
+        {"timestamp": 200, "ticker": "AAPL", "action": "sell", "amount": 1, "price": 12.0},
+    ])
+    assert database_models.record_order_fills(
+        [{"user_id": USER_ID, "timestamp": 150, "ticker": "AAPL", "action": "buy", "amount": 1, "price": 16.0}], []
+    )
+    incremental = get_stored_positions()
+    assert database_models.rebuild_positions(USER_ID) == {}
+    assert get_stored_positions() == incremental
@@ -0,0 +1,63 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+import yfinance as yf
+
+from stocks.bar_store import BarStore
+from stocks.providers import OHLCV_COLUMNS, YFinanceProvider
+
+
+FRIDAY_OPEN = datetime(2024, 1, 5, 14, 30, tzinfo=timezone.utc)
+FRIDAY_CLOSE = datetime(2024, 1, 5, 21, 0, tzinfo=timezone.utc)
+SUNDAY = datetime(2024, 1, 7, 12, 0, tzinfo=timezone.utc)
+
+def yfinance_frame(frames: dict) -> pd.DataFrame:
+    """
+    Dataframe like yf.download(group_by="ticker") returns, ticker on the first column level
+    """
+    return pd.concat(frames, axis=1)
+
+def friday_bars() -> pd.DataFrame:
+    index = pd.date_range(FRIDAY_OPEN, FRIDAY_CLOSE, freq="30min", inclusive="left")
+    return pd.DataFrame({column: np.arange(1.0, len(index) + 1) for column in OHLCV_COLUMNS}, index=index)
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """
+    Stubbed yf.download serving Friday's 30m AAPL bars, and nothing (an empty dataframe) for ranges without trading
+    """
+    calls = []
+
+    def download(tickers, start, end, interval, **kwargs):
+        calls.append((tuple(tickers), start, end))
+        bars = friday_bars()
+        bars = bars[(bars.index >= pd.Timestamp(start)) & (bars.index < pd.Timestamp(end))]
+        return yfinance_frame({"AAPL": bars}) if not bars.empty else pd.DataFrame()
+    monkeypatch.setattr(yf, "download", download)
+    return calls
+
+def test_range_without_trading_is_not_a_failure(database_engine, downloads):
+    store = BarStore(provider=YFinanceProvider(), engine=database_engine)
+    assert len(store.get_bars("AAPL", FRIDAY_OPEN, FRIDAY_CLOSE, "30m")) == 13
+    # the weekend after the cached bars downloads nothing, the cached bars are served
+    assert len(store.get_bars("AAPL", FRIDAY_OPEN, SUNDAY, "30m")) == 13
+    assert len(downloads) == 2
+    # the weekend is covered now
+    assert len(store.get_bars("AAPL", FRIDAY_OPEN, SUNDAY, "30m")) == 13
+    assert len(downloads) == 2
+
+def test_failed_tickers_are_left_out(monkeypatch):
+    bars = friday_bars()
+    failed = pd.DataFrame(np.nan, index=bars.index, columns=OHLCV_COLUMNS)
+    monkeypatch.setattr(yf, "download", lambda *args, **kwargs: yfinance_frame({"AAPL": bars, "BAD": failed}))
+    frames = YFinanceProvider().download(["AAPL", "BAD", "MISSING"], FRIDAY_OPEN, FRIDAY_CLOSE, "30m")
+    assert list(frames) == ["AAPL"]
+    assert len(frames["AAPL"]) == 13
+
+def test_empty_download_keeps_empty_frames(monkeypatch):
+    monkeypatch.setattr(yf, "download", lambda *args, **kwargs: pd.DataFrame())
+    frames = YFinanceProvider().download(["AAPL", "MSFT"], FRIDAY_CLOSE, SUNDAY, "30m")
+    assert set(frames) == {"AAPL", "MSFT"}
+    assert all(frame.empty for frame in frames.values())
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.single_flight import SingleFlight
+
+
+def test_thread_and_coroutine_share_one_call():
+    flights = SingleFlight("test")
+    executions = []
+    started = threading.Event()
+
+    def fetch():
+        executions.append("sync")
+        started.set()
+        time.sleep(0.2)
+        return "bars"
+
+    thread_results = []
+    thread = threading.Thread(target=lambda: thread_results.append(flights.do("key", fetch)))
+    thread.start()
+    started.wait()
+
+    async def fetch_async():
+        executions.append("async")
+        return "other bars"
+
+    async def main():
+        return await flights.do_async("key", fetch_async)
+
+    assert asyncio.run(main()) == "bars"
+    thread.join()
+    assert thread_results == ["bars"]
+    assert executions == ["sync"]
+    assert flights.get_metrics()["coalesced"] == 1
+
+
+def test_thread_joins_call_started_by_coroutine():
+    flights = SingleFlight("test")
+    executions = []
+
+    async def fetch_async():
+        executions.append("async")
+        await asyncio.sleep(0.2)
+        return "bars"
+
+    async def main():
+        task = asyncio.ensure_future(flights.do_async("key", fetch_async))
+        await asyncio.sleep(0.05)
+        thread_result = await asyncio.to_thread(flights.do, "key", lambda: executions.append("sync"))
+        return thread_result, await task
+
+    assert asyncio.run(main()) == ("bars", "bars")
+    assert executions == ["async"]
+
+
+def test_caller_after_cancel_starts_a_new_call():
+    flights = SingleFlight("test")
+    executions = []
+
+    async def fetch_async():
+        executions.append(len(executions))
+        await asyncio.sleep(0.2)
+        return len(executions)
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await flights.do_async("key", fetch_async, timeout=0.05)
+        # the abandoned call is cancelled, a new caller must not get its CancelledError
+        return await flights.do_async("key", fetch_async)
+
+    assert asyncio.run(main()) == 2
+    assert executions == [0, 1]
+    assert flights.get_metrics()["in_flight"] == 0
+
+
+def test_error_is_shared():
+    flights = SingleFlight("test")
+
+    async def fetch_async():
+        await asyncio.sleep(0.05)
+        raise ValueError("provider failed")
+
+    async def main():
+        return await asyncio.gather(
+            flights.do_async("key", fetch_async), flights.do_async("key", fetch_async), return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flights.get_metrics()["executions"] == 1
+    assert flights.get_metrics()["errors"] == 1
@@ -0,0 +1,44 @@
+from datetime import datetime, timezone
+
+# the utils package is imported first, like the server does (its modules import data)
+import utils
+from data.stock_record import StockRecord, stock_records_to_frame, validate_stock_records
+
+
+EPOCH = 1704196800  # 2024-01-02 12:00 UTC
+
+def record(timeframe) -> dict:
+    return {"timeframe": timeframe, "action": "buy", "amount": 1.0, "price": 10.0, "ticker": "aapl"}
+
+def test_timeframes_of_every_kind_are_epoch_seconds():
+    valid, rejected = validate_stock_records(stock_records_to_frame([
+        record(datetime(2024, 1, 2, 12, tzinfo=timezone.utc)),
+        # naive datetimes are UTC
+        record(datetime(2024, 1, 2, 12)),
+        StockRecord(timeframe=datetime(2024, 1, 2, 12, tzinfo=timezone.utc), action="buy", amount=1.0, price=10.0, ticker="AAPL"),
+        record("2024-01-02T12:00:00Z"),
+        record("2024-01-02T14:00:00+02:00"),
+        record(EPOCH),
+        record(float(EPOCH)),
+    ]))
+    assert rejected == {}
+    assert valid["timestamp"].tolist() == [EPOCH] * 7
+    assert valid["ticker"].tolist() == ["AAPL"] * 7
+
+def test_datetime_column_is_not_read_as_numbers():
+    # records of datetimes only make a datetime64 column, whose values are numbers (nanoseconds) to pandas
+    valid, rejected = validate_stock_records(stock_records_to_frame([
+        record(datetime(2024, 1, 2, 12, tzinfo=timezone.utc)), record(datetime(2024, 1, 2, 13, tzinfo=timezone.utc)),
+    ]))
+    assert rejected == {}
+    assert valid["timestamp"].tolist() == [EPOCH, EPOCH + 3600]
+
+def test_iso_string_column_is_parsed():
+    valid, rejected = validate_stock_records(stock_records_to_frame([record("2024-01-02T12:00:00Z"), record("2024-01-02 12:00:00")]))
+    assert rejected == {}
+    assert valid["timestamp"].tolist() == [EPOCH, EPOCH]
+
+def test_invalid_timeframes_are_rejected():
+    valid, rejected = validate_stock_records(stock_records_to_frame([record(True), record("not a date"), record(None)]))
+    assert valid.empty
+    assert rejected == {0: "Invalid timeframe", 1: "Invalid timeframe", 2: "Invalid timeframe"}
@@ -0,0 +1,39 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+
+import utils
+from stocks.bar_store import BarStore
+from stocks.providers import OHLCV_COLUMNS, StaticProvider
+from stocks.stock_script import Constants, StockPuller
+
+
+def test_default_range_mixes_aware_and_naive_bounds():
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    start, end, interval = StockPuller.get_default_range(start=start, end=None, interval="30m")
+    assert start.tzinfo is not None and end.tzinfo is not None
+    assert end.timestamp() == pytest.approx(Constants.default_end_time.value.timestamp(), abs=1e-3)
+    assert StockPuller.get_time_slices(start, end, interval)
+
+def test_stream_with_aware_start_and_default_end(database_engine, monkeypatch):
+    monkeypatch.setattr(StockPuller, "bar_store", BarStore(
+        provider=StaticProvider({"AAPL": pd.DataFrame(columns=OHLCV_COLUMNS, index=pd.DatetimeIndex([], tz="UTC"))}), engine=database_engine
+    ))
+
+    async def stream():
+        start = datetime.now(timezone.utc) - timedelta(days=1)
+        return [chunk async for chunk in StockPuller.stream_stock_async(ticker="AAPL", start=start, interval="30m")]
+    assert asyncio.run(stream()) == []
+
+@pytest.mark.parametrize("start, interval", [
+    (datetime.now(timezone.utc) + timedelta(days=1), "30m"),
+    (datetime.now(timezone.utc) - timedelta(days=1), "7x"),
+])
+def test_stream_rejects_bad_ranges_before_responding(database_engine, start, interval):
+    import server
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(server.stream_stock_data(request=None, ticker="AAPL", start=start, interval=interval, data_format=None))
+    assert raised.value.status_code == 400
@@ -1,2 +1,2 @@
-__all__ = ["logger_script", "server_protocol"]
+__all__ = ["logger_script", "server_protocol", "single_flight", "rate_limiter", "auth", "email_validation", "shared_cache"]
 from . import *
\ No newline at end of file
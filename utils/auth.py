@@ -0,0 +1,212 @@
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from os import getenv
+from typing import Dict, Tuple, Union
+
+from fastapi import Header, HTTPException
+
+from utils.logger_script import logger
+from utils.shared_cache import SharedCache
+from utils.server_protocol import encode_string
+
+
+class Constants(Enum):
+    # Key tokens are signed with, tokens stop verifying when it changes. Random (per process) if not set
+    TOKEN_SECRET = getenv("TOKEN_SECRET")
+    # Seconds a token is valid after login
+    token_ttl = 15 * 60
+    # scrypt cost (n), block size (r) and parallelization (p) - n * r * 128 bytes of memory per hash (16MB)
+    scrypt_n = 2 ** 14
+    scrypt_r = 8
+    scrypt_p = 1
+    salt_bytes = 16
+    key_bytes = 32
+    # Verified tokens whose claims are kept in memory
+    claims_cache_size = 4096
+    # Seconds between taking over the revocations of the server's other worker processes
+    revocation_sync_seconds = 5.0
+    # Users allowed to call the admin endpoints (e.g. listing every user), comma separated user ids
+    ADMIN_USER_IDS = frozenset(user_id.strip() for user_id in getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip())
+
+# Stored passwords are "scrypt$n$r$p$salt$key" (hex salt and key), older ones are a plain SHA-256 hex digest
+PASSWORD_HASH_PREFIX = "scrypt"
+
+def hash_password(password: str) -> str:
+    """
+    Hash a password with scrypt (salted and memory hard). Slow on purpose - used at sign up and login only
+
+    :returns: Stored form of the password, with its parameters and salt
+    """
+    salt = secrets.token_bytes(Constants.salt_bytes.value)
+    n, r, p = Constants.scrypt_n.value, Constants.scrypt_r.value, Constants.scrypt_p.value
+    key = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, dklen=Constants.key_bytes.value)
+    return f"{PASSWORD_HASH_PREFIX}${n}${r}${p}${salt.hex()}${key.hex()}"
+
+def verify_password(password: str, stored: str) -> Tuple[bool, bool]:
+    """
+    Check a password against its stored form, in constant time
+
+    :param stored: Stored form of the password (see hash_password) or a legacy SHA-256 digest
+    :returns: Whether the password matches, whether the stored form is legacy and should be replaced by hash_password
+    """
+    if password is None or not stored:
+        return False, False
+    if not stored.startswith(f"{PASSWORD_HASH_PREFIX}$"):
+        return hmac.compare_digest(encode_string(password), stored), True
+    try:
+        _, n, r, p, salt, key = stored.split("$")
+        expected = bytes.fromhex(key)
+        derived = hashlib.scrypt(password.encode("utf-8"), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p), dklen=len(expected))
+    except ValueError as error:
+        logger.error(f"Malformed stored password: {error}")
+        return False, False
+    # parameters weaker than the current ones are upgraded too
+    outdated = (int(n), int(r), int(p)) < (Constants.scrypt_n.value, Constants.scrypt_r.value, Constants.scrypt_p.value)
+    return hmac.compare_digest(derived, expected), outdated
+
+def encode_base64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def decode_base64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class TokenSigner:
+    """
+    Issues and verifies short lived HMAC-SHA256 signed tokens ("payload.signature", base64url json claims).
+    Verified claims are kept in a least recently used cache, so an authenticated call costs a dict lookup
+    and an expiry check instead of a password hash or a database query
+    """
+    def __init__(self, secret: Union[str, None] = Constants.TOKEN_SECRET.value, ttl: float = Constants.token_ttl.value,
+                 cache_size: int = Constants.claims_cache_size.value):
+        if not secret:
+            logger.warning("TOKEN_SECRET is not set, tokens are signed with a random key and will not survive a restart")
+            secret = secrets.token_hex(32)
+        self.key: bytes = secret.encode("utf-8")
+        self.ttl: float = ttl
+        self.cache_size: int = cache_size
+        self.lock: threading.Lock = threading.Lock()
+        self.claims: OrderedDict[str, dict] = OrderedDict()
+        # user id -> tokens issued before this time are rejected (password changed, user deleted)
+        self.revoked_before: Dict[str, float] = {}
+        # revocations of every worker process, as (user id, revoked at)
+        self.revocations: SharedCache = SharedCache("token_revocations", cache_size)
+        self.synced_at: float = 0.0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def sign(self, payload: str) -> str:
+        return encode_base64(hmac.new(self.key, payload.encode("ascii"), hashlib.sha256).digest())
+
+    def issue(self, user_id: str) -> Tuple[str, float]:
+        """
+        :returns: Token of the user, epoch seconds it expires at
+        """
+        now = time.time()
+        claims = {"sub": user_id, "iat": now, "exp": now + self.ttl}
+        payload = encode_base64(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+        return f"{payload}.{self.sign(payload)}", claims["exp"]
+
+    def verify(self, token: str) -> Union[dict, None]:
+        """
+        :returns: Claims of the token ({"sub": user id, "iat", "exp"}), None if it is invalid, expired or revoked
+        """
+        now = time.time()
+        with self.lock:
+            claims = self.claims.get(token)
+            if claims is not None:
+                self.claims.move_to_end(token)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if claims is None:
+            payload, _, signature = token.partition(".")
+            if not hmac.compare_digest(self.sign(payload), signature):
+                return None
+            try:
+                claims = json.loads(decode_base64(payload))
+            except ValueError:
+                return None
+            with self.lock:
+                self.claims[token] = claims
+                while len(self.claims) > self.cache_size:
+                    self.claims.popitem(last=False)
+        self.sync_revocations(now)
+        if claims["exp"] <= now or claims["iat"] < self.revoked_before.get(claims["sub"], 0.0):
+            with self.lock:
+                self.claims.pop(token, None)
+            return None
+        return claims
+
+    def revoke(self, user_id: str) -> None:
+        """
+        Reject every token of a user issued until now
+        """
+        now = time.time()
+        with self.lock:
+            self.revoked_before[user_id] = now
+            for token in [token for token, claims in self.claims.items() if claims["sub"] == user_id]:
+                del self.claims[token]
+        # tokens issued before the revocation expire within ttl, so it is shared for as long
+        self.revocations.set(user_id, (user_id, now), ttl=self.ttl)
+
+    def sync_revocations(self, now: float) -> None:
+        """
+        Take over the revocations of the server's other worker processes, at most every revocation_sync_seconds
+        """
+        with self.lock:
+            if now - self.synced_at < Constants.revocation_sync_seconds.value:
+                return
+            since, self.synced_at = self.synced_at, now
+        # overlaps the last sync, revocations stored while it ran are not missed
+        revocations = self.revocations.get_stored_since(since - Constants.revocation_sync_seconds.value)
+        with self.lock:
+            for user_id, revoked_at in revocations:
+                if revoked_at > self.revoked_before.get(user_id, 0.0):
+                    self.revoked_before[user_id] = revoked_at
+            # every token issued before these revocations expired
+            self.revoked_before = {user_id: revoked_at for user_id, revoked_at in self.revoked_before.items() if revoked_at > now - self.ttl}
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return {"cached_claims": len(self.claims), "hits": self.hits, "misses": self.misses, "revoked_users": len(self.revoked_before)}
+
+# Signer of the server's tokens
+token_signer = TokenSigner()
+
+def get_token_claims(authorization: str = Header(None)) -> Union[dict, None]:
+    """
+    FastAPI dependency reading an "Authorization: Bearer <token>" header
+
+    :returns: Claims of the token, None if there is no token
+    :raises HTTPException: 401 if a token was sent but is invalid, expired or revoked
+    """
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Authorization header must be: Bearer <token>")
+    claims = token_signer.verify(token.strip())
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return claims
+
+def get_admin_claims(authorization: str = Header(None)) -> dict:
+    """
+    FastAPI dependency of the admin endpoints, a valid token of a user in ADMIN_USER_IDS is required
+
+    :returns: Claims of the token
+    :raises HTTPException: 401 without a valid token, 403 if the token's user is not an admin
+    """
+    claims = get_token_claims(authorization)
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Authorization header with a token is required")
+    if claims["sub"] not in Constants.ADMIN_USER_IDS.value:
+        raise HTTPException(status_code=403, detail="Only admins can do this")
+    return claims
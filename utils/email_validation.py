@@ -0,0 +1,280 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from enum import Enum
+from typing import Dict, Hashable, List, Protocol, Union
+
+from validate_email import validate_email
+
+from utils.logger_script import logger
+from utils.server_protocol import Constants as ServerConstants
+
+
+class Constants(Enum):
+    # Seconds a whole check may take, and each dns lookup and smtp conversation within it
+    check_timeout = 5.0
+    dns_timeout = 1.5
+    smtp_timeout = 3.0
+    smtp_port = 25
+    # Mail hosts of a domain probed at the same time, by preference
+    probe_hosts = 2
+    # Seconds verdicts and mail hosts stay cached - definite answers for long, unknown ones shortly
+    valid_ttl = 24 * 60 * 60.0
+    invalid_ttl = 60 * 60.0
+    unknown_ttl = 5 * 60.0
+    mx_ttl = 60 * 60.0
+    cache_size = 10000
+
+# Domains whose addresses are accepted right away when well formed, and verified in the background
+WELL_KNOWN_DOMAINS = frozenset({
+    "gmail.com", "googlemail.com", "outlook.com", "hotmail.com", "live.com", "msn.com", "yahoo.com",
+    "icloud.com", "me.com", "aol.com", "proton.me", "protonmail.com", "gmx.com", "gmx.net", "yandex.com",
+})
+
+@dataclass
+class EmailVerdict:
+    valid: bool
+    # format (malformed or blacklisted), no_mx, rejected, accepted, unverified (no definite answer, accepted) or well_known
+    reason: str
+    # whether the mail server was asked about the address
+    probed: bool = False
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+class Resolver(Protocol):
+    async def resolve_mx(self, domain: str) -> Union[List[str], None]:
+        """
+        :returns: Mail hosts of a domain by preference ([] if it has none), None if the lookup failed
+        """
+
+class DNSResolver:
+    """
+    Resolver using dnspython's async resolver (installed with validate_email). Domains without
+    MX records fall back to their own A record (implicit MX)
+    """
+    def __init__(self, timeout: float = Constants.dns_timeout.value):
+        self.timeout: float = timeout
+
+    async def resolve_mx(self, domain: str) -> Union[List[str], None]:
+        import dns.asyncresolver
+        import dns.exception
+        import dns.resolver
+
+        resolver = dns.asyncresolver.Resolver()
+        resolver.lifetime = self.timeout
+        try:
+            answer = await resolver.resolve(domain, "MX")
+            return [str(record.exchange).rstrip(".") for record in sorted(answer, key=lambda record: record.preference)]
+        except dns.resolver.NXDOMAIN:
+            return []
+        except dns.resolver.NoAnswer:
+            pass
+        except dns.exception.DNSException as error:
+            # includes NoNameservers (SERVFAIL or every nameserver failing), which is no definite answer
+            logger.warning(f"MX lookup of {domain} failed: {error}")
+            return None
+        try:
+            await resolver.resolve(domain, "A")
+            return [domain]
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return []
+        except dns.exception.DNSException as error:
+            logger.warning(f"A lookup of {domain} failed: {error}")
+            return None
+
+class TTLCache:
+    """
+    Least recently used cache whose entries expire after their own ttl
+    """
+    def __init__(self, size: int = Constants.cache_size.value):
+        self.size: int = size
+        self.lock: threading.Lock = threading.Lock()
+        self.entries: OrderedDict[Hashable, tuple] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: Hashable) -> object:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: object, ttl: float) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class EmailValidator:
+    """
+    Checks that email addresses can receive mail: format and blacklist, the domain's mail hosts (MX) and
+    asking the mail hosts about the address (SMTP RCPT). Mail hosts are cached per domain and verdicts per
+    address, probes of a domain's hosts run concurrently with tight timeouts. Only a definite answer
+    rejects an address - lookups that time out or servers that defer accept it
+    """
+    def __init__(self, resolver: Resolver = None, smtp_port: int = Constants.smtp_port.value,
+                 helo_host: str = ServerConstants.SMTP_SERVER_URL.value, from_address: str = ServerConstants.SERVER_EMAIL.value,
+                 well_known_domains: frozenset = WELL_KNOWN_DOMAINS):
+        """
+        :param resolver: Resolves mail hosts, a stand-in can be injected for testing
+        :param smtp_port: Port mail hosts are probed on
+        """
+        self.resolver: Resolver = resolver or DNSResolver()
+        self.smtp_port: int = smtp_port
+        self.helo_host: str = helo_host or "localhost"
+        self.from_address: str = from_address or ""
+        self.well_known_domains: frozenset = well_known_domains
+        self.mx_cache: TTLCache = TTLCache()
+        self.verdicts: TTLCache = TTLCache()
+        # addresses verified in the background -> task, kept so the tasks are not garbage collected
+        self.background: Dict[str, asyncio.Task] = {}
+        self.probes: int = 0
+
+    async def get_mail_hosts(self, domain: str) -> Union[List[str], None]:
+        hosts = self.mx_cache.get(domain)
+        if hosts is not None:
+            return hosts
+        try:
+            hosts = await asyncio.wait_for(self.resolver.resolve_mx(domain), timeout=Constants.dns_timeout.value)
+        except asyncio.TimeoutError:
+            logger.warning(f"MX lookup of {domain} timed out")
+            hosts = None
+        if hosts is not None:
+            self.mx_cache.set(domain, hosts, Constants.mx_ttl.value)
+        return hosts
+
+    async def probe(self, host: str, email: str) -> Union[bool, None]:
+        """
+        Ask a mail host whether it accepts mail to an address, without sending any
+
+        :returns: True if the address was accepted, False if it was rejected (5xx), None without a definite answer
+        """
+        self.probes += 1
+        writer = None
+
+        async def command(line: Union[str, None]) -> int:
+            if line is not None:
+                writer.write(f"{line}\r\n".encode("ascii"))
+                await writer.drain()
+            # multi line replies continue with "250-", the last line is "250 "
+            while True:
+                reply = await reader.readline()
+                if not reply:
+                    raise ConnectionError("Mail host closed the connection")
+                if reply[3:4] != b"-":
+                    return int(reply[:3])
+
+        async def conversation() -> Union[bool, None]:
+            if await command(None) != 220:
+                return None
+            if await command(f"EHLO {self.helo_host}") != 250 and await command(f"HELO {self.helo_host}") != 250:
+                return None
+            if await command(f"MAIL FROM:<{self.from_address}>") != 250:
+                return None
+            code = await command(f"RCPT TO:<{email}>")
+            try:
+                await command("QUIT")
+            except (ConnectionError, OSError, ValueError):
+                pass
+            if code in (250, 251):
+                return True
+            return False if 500 <= code < 600 else None
+
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, self.smtp_port), timeout=Constants.smtp_timeout.value)
+            return await asyncio.wait_for(conversation(), timeout=Constants.smtp_timeout.value)
+        except (asyncio.TimeoutError, ConnectionError, OSError, ValueError) as error:
+            logger.debug(f"SMTP probe of {host} for {email} gave no answer: {error}")
+            return None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def verify(self, email: str) -> EmailVerdict:
+        """
+        Check an address against its domain's mail hosts, probing the first probe_hosts of them at the same time.
+        The first definite answer wins
+        """
+        domain = email.rsplit("@", 1)[1]
+        hosts = await self.get_mail_hosts(domain)
+        if hosts == []:
+            verdict = EmailVerdict(False, "no_mx")
+        elif hosts is None:
+            verdict = EmailVerdict(True, "unverified")
+        else:
+            verdict = EmailVerdict(True, "unverified", probed=True)
+            probes = [asyncio.ensure_future(self.probe(host, email)) for host in hosts[:Constants.probe_hosts.value]]
+            try:
+                for probe in asyncio.as_completed(probes):
+                    answer = await probe
+                    if answer is not None:
+                        verdict = EmailVerdict(answer, "accepted" if answer else "rejected", probed=True)
+                        break
+            finally:
+                for probe in probes:
+                    probe.cancel()
+        ttl = Constants.unknown_ttl.value if verdict.reason == "unverified" else Constants.valid_ttl.value if verdict.valid else Constants.invalid_ttl.value
+        self.verdicts.set(email, verdict, ttl)
+        return verdict
+
+    async def verify_in_background(self, email: str) -> None:
+        try:
+            verdict = await asyncio.wait_for(self.verify(email), timeout=Constants.check_timeout.value)
+            if not verdict.valid:
+                logger.warning(f"Accepted {email} by its well known domain, but it failed verification: {verdict.reason}")
+        except Exception as error:
+            logger.error(f"Failed verifying {email} in the background: {error}")
+        finally:
+            self.background.pop(email, None)
+
+    async def validate(self, email: str) -> EmailVerdict:
+        """
+        Validate an address. Addresses at well known domains are accepted when well formed and verified in the
+        background, others wait for verification (at most check_timeout seconds)
+        """
+        email = (email or "").strip().lower()
+        cached = self.verdicts.get(email)
+        if cached is not None:
+            return cached
+        try:
+            # format and the blacklist of disposable domains, both checked locally
+            well_formed = validate_email(email_address=email, check_format=True, check_blacklist=True, check_dns=False, check_smtp=False)
+        except Exception as error:
+            logger.error(f"Failed checking format of {email}: {error}")
+            well_formed = False
+        if not well_formed or "@" not in email:
+            return EmailVerdict(False, "format")
+
+        if email.rsplit("@", 1)[1] in self.well_known_domains:
+            if email not in self.background:
+                self.background[email] = asyncio.create_task(self.verify_in_background(email))
+            return EmailVerdict(True, "well_known")
+        try:
+            return await asyncio.wait_for(self.verify(email), timeout=Constants.check_timeout.value)
+        except asyncio.TimeoutError:
+            logger.warning(f"Verifying {email} timed out, accepting it")
+            return EmailVerdict(True, "unverified")
+
+    def get_metrics(self) -> dict:
+        return {
+            "mx_cache": self.mx_cache.get_metrics(),
+            "verdicts": self.verdicts.get_metrics(),
+            "probes": self.probes,
+            "background": len(self.background),
+        }
+
+# Validator of the server's sign ups
+email_validator = EmailValidator()
@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket shared between threads.
+
+    Tokens refill at rate per second up to burst, every call takes one token
+    and waits for it when the bucket is empty.
+    """
+    def __init__(self, name: str, rate: float, burst: int = 1):
+        self.name: str = name
+        self.rate: float = rate
+        self.burst: int = max(int(burst), 1)
+        self.lock: threading.Lock = threading.Lock()
+        self.tokens: float = float(self.burst)
+        self.updated: float = time.monotonic()
+
+        # metrics
+        self.acquired: int = 0
+        self.waited_seconds: float = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        Take a token, waiting until one is available (blocking)
+
+        :param timeout: Seconds to wait at most, None to wait as long as needed
+        :returns: True if a token was taken, False if the timeout passed first
+        """
+        started = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    self.waited_seconds += now - started
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if timeout is not None and now + wait - started > timeout:
+                return False
+            time.sleep(wait)
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            self.refill(time.monotonic())
+            return {
+                "name": self.name,
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": self.tokens,
+                "acquired": self.acquired,
+                "waited_seconds": self.waited_seconds,
+            }
@@ -1,12 +1,14 @@
+import asyncio
 from enum import Enum
 from hashlib import sha256
 from sys import stdout
 from os import getenv
 from dataclasses import dataclass, asdict, fields
-from typing import Self
+from typing import Self, Awaitable, Any
 
 from validate_email import validate_email
 from dotenv import load_dotenv
+from fastapi import Request
 
 from utils.logger_script import logger
 from data.database import get_db_userbase, get_db_users_stock
@@ -19,8 +21,12 @@ def get_db_users_stock():
    
 class Constants(Enum):
     load_dotenv()
-    HOST_IP = "127.0.0.1"
-    HOST_PORT = 5555
+    HOST_IP = getenv("HOST_IP", "127.0.0.1")
+    HOST_PORT = int(getenv("HOST_PORT", "5555"))
+    # Worker processes of the server, 0 for one per CPU
+    SERVER_WORKERS = int(getenv("SERVER_WORKERS", "0"))
+    # Seconds a stopping worker (shutdown or reload) gives its requests in flight to finish
+    SERVER_GRACEFUL_SHUTDOWN_SECONDS = int(getenv("SERVER_GRACEFUL_SHUTDOWN_SECONDS", "30"))
 
     SERVER_EMAIL = getenv("SERVER_EMAIL")
     SERVER_PASSWORD = getenv("SERVER_PASSWORD")
@@ -46,6 +52,36 @@ class Response:
         return cls(**filtered_data)
 
 
+class ClientDisconnected(Exception):
+    """
+    Raised when a client disconnects before its request was answered
+    """
+
+async def run_until_disconnected(request: Request, awaitable: Awaitable, poll_interval: float = 0.5) -> Any:
+    """
+    Await something while watching the client's connection, cancel it if the client disconnects
+
+    Parameters:
+        request (Request): The request of the client
+        awaitable (Awaitable): The work to do for the client
+        poll_interval (float): Seconds between connection checks
+
+    Returns:
+        The result of the awaitable, raises ClientDisconnected if the client disconnected first
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
 def encode_string(string: str) -> str:
     """
     Encode a given string using the SHA-256 hashing algorithm.
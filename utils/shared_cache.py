@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import threading
+import time
+from enum import Enum
+from os import getenv
+from typing import Awaitable, Callable, Dict, Hashable, List
+
+from sqlalchemy import Column, Float, Index, LargeBinary, MetaData, String, Table, and_, delete, func, select
+from sqlalchemy.engine import Engine
+
+from data.database import create_sqlite_engine, get_upsert_insert
+from utils.logger_script import logger
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (Windows) - locks only hold within a process, run a single worker there
+    fcntl = None
+
+
+class Constants(Enum):
+    # Directory of the caches and locks shared by the server's worker processes on one host
+    SHARED_CACHE_DIRECTORY = getenv("SHARED_CACHE_DIRECTORY", "./shared_cache")
+    # Sets between removals of the expired entries and the least recently stored ones over a cache's size
+    trim_every = 64
+    # Seconds between attempts to take a lock another process holds
+    lock_poll_seconds = 1.0
+
+# Entries of every shared cache, in a sqlite file of the shared directory (not in the application's databases)
+shared_cache_metadata = MetaData()
+shared_cache_table = Table(
+    "shared_cache",
+    shared_cache_metadata,
+    Column("cache", String, primary_key=True),
+    Column("key", String, primary_key=True),
+    Column("value", LargeBinary, nullable=False),
+    Column("expires_at", Float),
+    Column("stored_at", Float, nullable=False),
+    Index("ix_shared_cache_cache_stored_at", "cache", "stored_at"),
+)
+
+def hash_key(key: Hashable) -> str:
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+class ProcessLock:
+    """
+    Lock held by one thread of one of the host's processes at a time (a locked file in the shared directory).
+    The operating system releases it when its holder exits, also when it crashed
+    """
+    def __init__(self, name: str, directory: str = Constants.SHARED_CACHE_DIRECTORY.value):
+        self.name: str = name
+        self.path: str = os.path.join(directory, "locks", f"{hash_key(name)}.lock")
+        # threads of this process wait here, the file lock is taken once per process
+        self.thread_lock: threading.Lock = threading.Lock()
+        self.file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        :param blocking: Whether to wait for the lock, otherwise give up right away when it is held
+        :returns: True if the lock was taken
+        """
+        if not self.thread_lock.acquire(blocking):
+            return False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            file = open(self.path, "a+")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    file.close()
+                    self.thread_lock.release()
+                    return False
+            self.file = file
+            return True
+        except BaseException:
+            self.thread_lock.release()
+            raise
+
+    def release(self) -> None:
+        file, self.file = self.file, None
+        # closing the file releases its lock
+        file.close()
+        self.thread_lock.release()
+
+    def __enter__(self) -> "ProcessLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+process_locks: Dict[str, ProcessLock] = {}
+process_locks_lock = threading.Lock()
+
+def get_process_lock(name: str) -> ProcessLock:
+    """
+    :returns: The process' lock of a name, the same one for every thread
+    """
+    with process_locks_lock:
+        lock = process_locks.get(name)
+        if lock is None:
+            lock = process_locks[name] = ProcessLock(name)
+        return lock
+
+async def run_exclusively(name: str, coroutine_functions: List[Callable[[], Awaitable]], poll_seconds: float = Constants.lock_poll_seconds.value) -> None:
+    """
+    Run coroutines in one of the host's processes only - the one that holds the lock of a name. The others wait to
+    take the lock over, e.g. when its holder exits during a reload. Runs until cancelled
+
+    :param coroutine_functions: Functions returning the coroutines to run. E.g: [order_matcher.run_forever]
+    """
+    lock = get_process_lock(name)
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(poll_seconds)
+    logger.info(f"Process {os.getpid()} took the {name} lock, running {len(coroutine_functions)} tasks")
+    try:
+        await asyncio.gather(*(coroutine_function() for coroutine_function in coroutine_functions))
+    finally:
+        lock.release()
+
+shared_engines: Dict[str, Engine] = {}
+shared_engines_lock = threading.Lock()
+
+def get_shared_engine(directory: str = Constants.SHARED_CACHE_DIRECTORY.value) -> Engine:
+    """
+    :returns: Engine of the shared directory's cache file, its table is created on first use
+    """
+    with shared_engines_lock:
+        engine = shared_engines.get(directory)
+        if engine is None:
+            os.makedirs(directory, exist_ok=True)
+            engine = create_sqlite_engine(f"sqlite:///{os.path.join(directory, 'shared_cache.sqlite')}")
+            shared_cache_metadata.create_all(bind=engine)
+            shared_engines[directory] = engine
+        return engine
+
+class SharedCache:
+    """
+    Cache of picklable values shared by the worker processes of a host through a sqlite file (WAL, memory mapped),
+    so what one worker computed is served by all of them and the memory is not multiplied by the workers.
+    Entries with a ttl expire, the least recently stored entries over the size are removed
+    """
+    def __init__(self, name: str, size: int, directory: str = Constants.SHARED_CACHE_DIRECTORY.value):
+        self.name: str = name
+        self.size: int = size
+        self.directory: str = directory
+        self.lock: threading.Lock = threading.Lock()
+        self.sets: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.errors: int = 0
+
+    @property
+    def engine(self) -> Engine:
+        return get_shared_engine(self.directory)
+
+    def count(self, hit: bool) -> None:
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: Hashable) -> object:
+        """
+        :returns: Value of a key, None if it is not cached or expired
+        """
+        table = shared_cache_table
+        stmt = select(table.c.value, table.c.expires_at).where(and_(table.c.cache == self.name, table.c.key == hash_key(key)))
+        try:
+            with self.engine.connect() as connection:
+                row = connection.execute(stmt).first()
+            if row is None or (row.expires_at is not None and row.expires_at < time.time()):
+                self.count(False)
+                return None
+            value = pickle.loads(row.value)
+        except Exception as error:
+            logger.error(f"Failed reading {self.name} shared cache: {error}")
+            with self.lock:
+                self.errors += 1
+            return None
+        self.count(True)
+        return value
+
+    def set(self, key: Hashable, value: object, ttl: float = None) -> None:
+        """
+        :param ttl: Seconds the value is cached, None until it is removed for being over the size
+        """
+        now = time.time()
+        table = shared_cache_table
+        stmt = get_upsert_insert(self.engine)(table).values(
+            cache=self.name, key=hash_key(key), value=pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+            expires_at=now + ttl if ttl is not None else None, stored_at=now,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["cache", "key"],
+            set_={"value": stmt.excluded.value, "expires_at": stmt.excluded.expires_at, "stored_at": stmt.excluded.stored_at},
+        )
+        with self.lock:
+            self.sets += 1
+            trim = self.sets % Constants.trim_every.value == 0
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(stmt)
+                if trim:
+                    self.trim(connection, now)
+        except Exception as error:
+            logger.error(f"Failed writing {self.name} shared cache: {error}")
+            with self.lock:
+                self.errors += 1
+
+    def trim(self, connection, now: float) -> None:
+        table = shared_cache_table
+        mine = table.c.cache == self.name
+        connection.execute(delete(table).where(and_(mine, table.c.expires_at < now)))
+        # stored_at of the newest entry over the size, it and everything older is removed
+        oldest_kept = select(table.c.stored_at).where(mine).order_by(table.c.stored_at.desc()).offset(self.size).limit(1).scalar_subquery()
+        connection.execute(delete(table).where(and_(mine, table.c.stored_at <= oldest_kept)))
+
+    def get_stored_since(self, timestamp: float) -> List[object]:
+        """
+        :returns: Values stored (or stored again) after timestamp that did not expire, oldest first
+        """
+        table = shared_cache_table
+        now = time.time()
+        stmt = select(table.c.value).where(and_(
+            table.c.cache == self.name, table.c.stored_at > timestamp,
+            table.c.expires_at.is_(None) | (table.c.expires_at >= now),
+        )).order_by(table.c.stored_at)
+        try:
+            with self.engine.connect() as connection:
+                return [pickle.loads(value) for value in connection.execute(stmt).scalars()]
+        except Exception as error:
+            logger.error(f"Failed reading {self.name} shared cache: {error}")
+            return []
+
+    def get_metrics(self) -> dict:
+        """
+        :returns: Entries in the shared cache, and hits, misses and errors of this process
+        """
+        stmt = select(func.count()).select_from(shared_cache_table).where(shared_cache_table.c.cache == self.name)
+        try:
+            with self.engine.connect() as connection:
+                size = connection.execute(stmt).scalar_one()
+        except Exception as error:
+            logger.error(f"Failed counting {self.name} shared cache: {error}")
+            size = None
+        with self.lock:
+            return {"size": size, "hits": self.hits, "misses": self.misses, "errors": self.errors, "pid": os.getpid()}
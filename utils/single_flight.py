@@ -0,0 +1,174 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class SingleFlightCall:
+    """
+    A call that is in flight, either on a thread or as a task of an event loop.
+    Threads wait on its event, coroutines on futures of their own loop that are resolved when it finishes
+    """
+    def __init__(self):
+        self.event: threading.Event = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+        # task that runs the call when it was started by a coroutine
+        self.task: asyncio.Future | None = None
+        # futures of the coroutines waiting for the call
+        self.futures: List[asyncio.Future] = []
+        # callers (threads and coroutines) waiting for the call, a task is cancelled once none is left
+        self.waiters: int = 0
+
+    def finish(self, result: Any, error: BaseException | None) -> None:
+        """
+        Share the call's outcome with its waiters, the call must already be out of the in flight calls
+        """
+        self.result = result
+        self.error = error
+        self.event.set()
+        for future in self.futures:
+            try:
+                future.get_loop().call_soon_threadsafe(resolve_future, future, result, error)
+            except RuntimeError:
+                # the waiter's loop was closed, nothing waits there anymore
+                pass
+
+def resolve_future(future: asyncio.Future, result: Any, error: BaseException | None) -> None:
+    if future.done():
+        return
+    if isinstance(error, asyncio.CancelledError):
+        future.cancel()
+    elif error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls into one execution.
+
+    While a call with some key is in flight, other callers with the same key
+    wait for it and share its result instead of executing it again - threads and
+    coroutines alike, whichever of them started the call.
+    The result is shared between callers, so it must be treated as read only.
+    """
+    def __init__(self, name: str):
+        self.name: str = name
+        self.lock: threading.Lock = threading.Lock()
+        self.calls: Dict[Hashable, SingleFlightCall] = {}
+
+        # metrics
+        self.requests: int = 0
+        self.executions: int = 0
+        self.coalesced: int = 0
+        self.errors: int = 0
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        """
+        Call function, or wait for an in flight call with the same key (blocking).
+        Must not be called from an event loop's thread, use do_async there
+
+        :param key: Key that identifies identical calls
+        :param function: Function to execute if no identical call is in flight
+        :returns: Result of the (shared) call, raises its exception if it failed
+        """
+        with self.lock:
+            self.requests += 1
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = SingleFlightCall()
+                self.calls[key] = call
+                self.executions += 1
+            else:
+                self.coalesced += 1
+            call.waiters += 1
+
+        if not is_leader:
+            try:
+                call.event.wait()
+            finally:
+                with self.lock:
+                    call.waiters -= 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        result, error = None, None
+        try:
+            result = function()
+        except BaseException as caught:
+            error = caught
+            raise
+        finally:
+            self.finish_call(key, call, result, error)
+        return result
+
+    async def do_async(self, key: Hashable, coroutine_function: Callable[[], Awaitable], timeout: float = None) -> Any:
+        """
+        Await coroutine_function(), or wait for an in flight call with the same key.
+        A caller that times out or is cancelled leaves without cancelling the shared call,
+        a call started here is cancelled only once no caller waits for it.
+
+        :param key: Key that identifies identical calls
+        :param coroutine_function: Function that returns the awaitable to run if no identical call is in flight
+        :param timeout: Seconds this caller waits before raising TimeoutError, None to wait forever
+        :returns: Result of the (shared) call, raises its exception if it failed
+        """
+        future = asyncio.get_running_loop().create_future()
+        with self.lock:
+            self.requests += 1
+            call = self.calls.get(key)
+            if call is None:
+                call = SingleFlightCall()
+                call.task = asyncio.ensure_future(coroutine_function())
+                self.calls[key] = call
+                self.executions += 1
+                call.task.add_done_callback(lambda task: self.finish_task(key, call, task))
+            else:
+                self.coalesced += 1
+            call.futures.append(future)
+            call.waiters += 1
+
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            with self.lock:
+                call.waiters -= 1
+                is_abandoned = call.waiters == 0 and call.task is not None and not call.event.is_set()
+                if is_abandoned and self.calls.get(key) is call:
+                    # out of the in flight calls before it is cancelled, so no new caller joins a cancelled call
+                    del self.calls[key]
+            if is_abandoned:
+                call.task.get_loop().call_soon_threadsafe(call.task.cancel)
+
+    def finish_task(self, key: Hashable, call: SingleFlightCall, task: asyncio.Future) -> None:
+        if task.cancelled():
+            self.finish_call(key, call, None, asyncio.CancelledError())
+        elif task.exception() is not None:
+            self.finish_call(key, call, None, task.exception())
+        else:
+            self.finish_call(key, call, task.result(), None)
+
+    def finish_call(self, key: Hashable, call: SingleFlightCall, result: Any, error: BaseException | None) -> None:
+        with self.lock:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+            if error is not None and not isinstance(error, asyncio.CancelledError):
+                self.errors += 1
+        call.finish(result, error)
+
+    def get_metrics(self) -> dict:
+        """
+        :returns: Request, execution and coalesced counts, and how many calls are in flight right now
+        """
+        with self.lock:
+            return {
+                "name": self.name,
+                "requests": self.requests,
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "in_flight": len(self.calls),
+                "coalesced_ratio": self.coalesced / self.requests if self.requests else 0.0,
+            }